@@ -0,0 +1,126 @@
+"""
+Levenberg-Marquardt fits of many least-squares problems of the same shape in lockstep.
+
+The systematic models of the grid are all fits of the same transit model to the same data, they only differ in which
+parameters are free. lockstep_lm() takes a stack of parameter vectors, one row per fit, with a mask of the free
+parameters of every row. Every iteration evaluates the residuals of all fits that are still running in one call, solves
+their damped normal equations together with one stacked np.linalg.solve(), and retires every fit that has converged,
+so the calls into the model amortise their overhead over the whole grid instead of paying it once per model and
+iteration.
+"""
+
+import numpy as np
+
+from exoticism.least_squares import EPSILON, XTOL, covariance
+
+LAMBDA_START = 1e-3   # initial damping, relative to the Marquardt scaling
+LAMBDA_MAX = 1e16     # damping at which a fit that does not improve any more is given up
+
+
+def lockstep_lm(fcn, jac, x0, free, ftol=EPSILON, xtol=XTOL, gtol=EPSILON, maxfev=None):
+    """
+    Levenberg-Marquardt minimisation of the sums of squares of many residual vectors at once.
+
+    Every row is an independent fit with its own damping, which goes down tenfold after a step that lowers its sum of
+    squares and up tenfold otherwise. A rejected step is solved again from the same Jacobian, so the Jacobian is only
+    evaluated for the rows whose last step was accepted. The damped normal equations are scaled by the norms of the
+    columns of the Jacobian like MINPACK's lmder, and the tolerances have the same meaning as in
+    least_squares.lsq().
+    :param fcn: function of an array of parameter vectors of shape (number of rows, number of parameters) and the
+                indices of these rows, returns the residuals, shape (number of rows, number of residuals)
+    :param jac: function with the same arguments as fcn, returns the Jacobian of the residuals, shape (number of rows,
+                number of parameters, number of residuals); the entries of parameters that are not free are ignored
+    :param x0: array of shape (number of fits, number of parameters), starting values of all parameters of every fit
+    :param free: array of bool of the same shape as x0, which parameters are fit in every row
+    :param ftol: float, tolerance on the relative change of the sum of squares
+    :param xtol: float, tolerance on the change of the scaled parameters, relative to their norm
+    :param gtol: float, tolerance on the cosine between the residuals and the columns of the Jacobian
+    :param maxfev: int, maximum number of evaluations of the residuals per fit; None means 256 per free parameter
+    :return: list with a dict per fit: best-fit parameters (x), sum of squares (fval), success, message, covariance
+             matrix of the free parameters (covar), number of evaluations of the residuals (nfev) and of the Jacobian
+             (njev)
+    """
+    x = np.array(x0, dtype=float)
+    free = np.broadcast_to(np.asarray(free, dtype=bool), x.shape)
+    nfit, npar = x.shape
+    nfree = np.count_nonzero(free, axis=1)
+    if maxfev is None:
+        maxfev = 256 * nfree
+    maxfev = np.broadcast_to(maxfev, (nfit,))
+    all_rows = np.arange(nfit)
+
+    resid = fcn(x, all_rows)
+    cost = np.sum(resid ** 2, axis=1)
+    nfev = np.ones(nfit, dtype=int)
+    njev = np.zeros(nfit, dtype=int)
+    jacobian = np.zeros((nfit, npar, resid.shape[1]))
+    scale = np.zeros((nfit, npar))
+    lam = np.full(nfit, LAMBDA_START)
+    status = np.zeros(nfit, dtype=int)   # 0 while running, see MESSAGES for the others
+    stale = all_rows                     # rows whose Jacobian is not up to date
+
+    while True:
+        if stale.size > 0:
+            jacobian[stale] = jac(x[stale], stale) * free[stale, :, np.newaxis]
+            njev[stale] += 1
+            norms = np.linalg.norm(jacobian[stale], axis=2)
+            scale[stale] = np.maximum(scale[stale], norms)   # never shrinks, like the diagonal of lmder
+            # Converged if the residuals are orthogonal to all columns of the Jacobian
+            cosine = np.abs(np.einsum('kpn,kn->kp', jacobian[stale], resid[stale]))
+            cosine /= np.where(norms > 0, norms, 1.) * np.sqrt(np.maximum(cost[stale], np.finfo(float).tiny))[:, None]
+            running = status[stale] == 0
+            status[stale[running & (np.max(cosine, axis=1) <= gtol)]] = 4
+
+        rows = np.flatnonzero(status == 0)
+        if rows.size == 0:
+            break
+
+        # Damped normal equations of all running rows; fixed parameters get a unit row, so that their step is zero
+        jac_rows = jacobian[rows]
+        diag = np.where(free[rows] & (scale[rows] > 0), scale[rows], 1.) ** 2
+        normal = np.einsum('kpn,kqn->kpq', jac_rows, jac_rows)
+        normal[:, np.arange(npar), np.arange(npar)] += lam[rows, None] * diag + ~free[rows]
+        gradient = np.einsum('kpn,kn->kp', jac_rows, resid[rows])
+        step = -np.linalg.solve(normal, gradient[:, :, np.newaxis])[:, :, 0]
+
+        trial = x[rows] + step
+        trial_resid = fcn(trial, rows)
+        trial_cost = np.sum(trial_resid ** 2, axis=1)
+        nfev[rows] += 1
+
+        # Reductions of the sum of squares relative to the current one: actual and predicted by the linear model
+        predicted = (np.sum(np.einsum('kpn,kp->kn', jac_rows, step) ** 2, axis=1) +
+                     2 * lam[rows] * np.sum(diag * step ** 2, axis=1)) / np.maximum(cost[rows], np.finfo(float).tiny)
+        actual = (cost[rows] - trial_cost) / np.maximum(cost[rows], np.finfo(float).tiny)
+        accepted = trial_cost < cost[rows]
+        scaled_step = np.linalg.norm(np.sqrt(diag) * step * free[rows], axis=1)
+        scaled_x = np.linalg.norm(np.sqrt(diag) * x[rows] * free[rows], axis=1)
+
+        done = rows[accepted]
+        x[done], resid[done], cost[done] = trial[accepted], trial_resid[accepted], trial_cost[accepted]
+        lam[done] /= 10.
+        lam[rows[~accepted]] *= 10.
+
+        ftol_met = (predicted <= ftol) & ((actual <= ftol) | ~accepted)
+        xtol_met = scaled_step <= xtol * (scaled_x + xtol)
+        new_status = np.select([ftol_met & xtol_met, ftol_met, xtol_met, lam[rows] > LAMBDA_MAX,
+                                nfev[rows] >= maxfev[rows]], [3, 1, 2, 6, 5], 0)
+        status[rows] = new_status
+        stale = rows[accepted]   # also for the rows that just converged, for their covariance at the best fit
+
+    results = []
+    for k in range(nfit):
+        covar = covariance(jacobian[k][free[k]].T) if nfree[k] > 0 else np.zeros((0, 0))
+        results.append({'x': x[k], 'fval': cost[k], 'success': status[k] in (1, 2, 3, 4),
+                        'message': MESSAGES[status[k]], 'covar': covar,
+                        'nfev': nfev[k], 'njev': njev[k]})
+    return results
+
+
+MESSAGES = {1: 'Both actual and predicted relative reductions in the sum of squares are at most ftol',
+            2: 'Relative error between two consecutive iterates is at most xtol',
+            3: 'Both actual and predicted relative reductions in the sum of squares are at most ftol and the relative '
+               'error between two consecutive iterates is at most xtol',
+            4: 'The cosine of the angle between the residuals and any column of the Jacobian is at most gtol',
+            5: 'Number of calls to the function has reached maxfev',
+            6: 'The damping grew too large, the sum of squares does not decrease any more'}
@@ -0,0 +1,217 @@
+"""
+Numba-compiled versions of the numerical kernels in margmodule.py: occultuniform, occultnl (and one refinement level of
+it, for the chunked evaluation), sys_model, phase_calc and impact_param.
+
+The kernels work on plain float arrays in fixed units (days, seconds, radians, stellar radii); the public functions in
+margmodule.py take care of astropy units and hand off to these kernels when the compiled backend is enabled
+(use_numba in the [transit_model] section of the configfile) and Numba can be imported. They follow the NumPy
+implementations step by step, so both backends agree to rounding.
+
+Compiled functions are cached on disk (cache=True), so the compilation is only paid on the very first run. They
+release the GIL (nogil=True), so fits running on several threads evaluate their kernels at the same time.
+Without Numba, this module can still be imported, but NUMBA_AVAILABLE is False and margmodule.py never calls it.
+"""
+
+import numpy as np
+
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+    def njit(*args, **kwargs):
+        """Stand-in for numba.njit that leaves the decorated function as it is."""
+        def decorator(function):
+            return function
+        return decorator
+
+
+@njit(cache=True, nogil=True)
+def _occultuniform_point(z, w):
+    """
+    Uniform-source occultation of a single impact parameter z by a disk of radius w, see margmodule.occultuniform().
+    """
+    if abs(w - 0.5) < 1.0e-3:
+        w = 0.5
+
+    if z >= 1 + w:
+        return 1.0
+    if w >= 1 and z <= w - 1:
+        return 0.0
+    if z <= 1 - w:
+        return 1 - w ** 2
+
+    kap1 = np.arccos(min((1 - w ** 2 + z ** 2) / 2 / z, 1.))
+    kap0 = np.arccos(min((w ** 2 + z ** 2 - 1) / 2 / w / z, 1.))
+    lambdae = w ** 2 * kap0 + kap1
+    lambdae = (lambdae - 0.5 * np.sqrt(max(4. * z ** 2 - (1 + z ** 2 - w ** 2) ** 2, 0.))) / np.pi
+    return 1 - lambdae
+
+
+@njit(cache=True, nogil=True)
+def occultuniform(z, w):
+    """
+    Compute the lightcurve for occultation of a uniform source without microlensing (Mandel & Agol 2002).
+    :param z: 1D array, impact parameter in units of stellar radii
+    :param w: 1D array of the same length as z, occulting star size in units of stellar radius
+    :return: muo1: array, fraction of flux at each z for a uniform source
+    """
+    muo1 = np.empty(z.size)
+    for j in range(z.size):
+        muo1[j] = _occultuniform_point(z[j], w[j])
+    return muo1
+
+
+@njit(cache=True, nogil=True)
+def occultnl_level(rl, b0, mulimb0, r, th, nr):
+    """
+    Integrate the four limb darkening components of the points in transit for one occultnl refinement level, see
+    margmodule._occultnl_level(). Every point only depends on itself, so chunks of points can run on several threads.
+    :param rl: float, transit depth (Rp/R*)
+    :param b0: 1D array, impact parameters (in stellar radii) of the points that are in transit
+    :param mulimb0: 1D array, uniform-source occultation of these points
+    :param r: 1D array, radii of the annuli of this refinement level (length nr+1)
+    :param th: 1D array, midpoint angles of the annuli of this refinement level (length nr+1)
+    :param nr: int, number of annuli of this refinement level
+    :return: sums: array of shape (4, b0.size), sums of the four components (not yet multiplied by dt)
+    """
+    ni = b0.size
+    sums = np.empty((4, ni))
+    sig = np.sqrt(np.cos(th[nr - 1]))
+    for j in range(ni):
+        edge = mulimb0[j] / (1 - r[nr - 1])
+        for k in range(4):
+            sums[k, j] = sig ** (k + 3) * edge
+
+    weights = np.empty(4)
+    for i in range(1, nr):
+        sig1 = np.sqrt(np.cos(th[i - 1]))
+        sig2 = np.sqrt(np.cos(th[i]))
+        for k in range(4):
+            weights[k] = r[i] ** 2 * (sig1 ** (k + 3) / (r[i] - r[i - 1]) - sig2 ** (k + 3) / (r[i + 1] - r[i]))
+        for j in range(ni):
+            mu = _occultuniform_point(b0[j] / r[i], rl / r[i])
+            for k in range(4):
+                sums[k, j] += weights[k] * mu
+    return sums
+
+
+@njit(cache=True, nogil=True)
+def occultnl(rl, c1, c2, c3, c4, b0):
+    """
+    MANDEL & AGOL (2002) transit model, with the global convergence test of margmodule.occultnl().
+    :param rl: float, transit depth (Rp/R*)
+    :param c1: float, limb darkening parameter 1
+    :param c2: float, limb darkening parameter 2
+    :param c3: float, limb darkening parameter 3
+    :param c4: float, limb darkening parameter 4
+    :param b0: 1D array, impact parameter in stellar radii
+    :return: mulimb0: limb-darkened transit model, mulimbf: lightcurves for each component, nr: number of annuli
+    """
+    nb = b0.size
+    mulimb0 = np.empty(nb)
+    for j in range(nb):
+        mulimb0[j] = _occultuniform_point(b0[j], rl)
+
+    fac = np.max(np.abs(mulimb0 - 1))
+    if fac == 0:
+        fac = 1e-6  # DKS edit
+
+    omega = 4 * ((1 - c1 - c2 - c3 - c4) / 4 + c1 / 5 + c2 / 6 + c3 / 7 + c4 / 8)
+    indx = np.where(mulimb0 != 1.0)[0]
+    if indx.size == 0:
+        indx = np.array([nb - 1])
+    ni = indx.size
+
+    mulimbf = np.empty((5, nb))
+    mulimbf[0, :] = 1.
+    mulimbf[1, :] = 0.8
+    mulimbf[2, :] = 2 / 3
+    mulimbf[3, :] = 4 / 7
+    mulimbf[4, :] = 0.5
+
+    b0_in = b0[indx]
+    mulimb0_in = mulimb0[indx]
+    mulimb = mulimb0_in.copy()
+    mulimbp = mulimb.copy()
+    sums = np.zeros((4, ni))
+    nr = 2
+    dt = 0.
+    dmumax = 1.0
+
+    while dmumax > fac * 1.e-3 and nr <= 131072:
+        mulimbp[:] = mulimb
+        nr = nr * 2
+        dt = 0.5 * np.pi / nr
+        t = dt * np.arange(nr + 1)
+        th = t + 0.5 * dt
+        r = np.sin(t)
+        sums = occultnl_level(rl, b0_in, mulimb0_in, r, th, nr)
+
+        dmumax = 0.
+        for j in range(ni):
+            mulimb[j] = ((1 - c1 - c2 - c3 - c4) * mulimb0[indx[j]] + c1 * sums[0, j] * dt + c2 * sums[1, j] * dt
+                         + c3 * sums[2, j] * dt + c4 * sums[3, j] * dt) / omega
+            if mulimb[j] + mulimbp[j] != 0.:
+                dmumax = max(dmumax, abs(mulimb[j] - mulimbp[j]) / (mulimb[j] + mulimbp[j]))
+
+    for j in range(ni):
+        mulimbf[0, indx[j]] = mulimb0[indx[j]]
+        for k in range(4):
+            mulimbf[k + 1, indx[j]] = sums[k, j] * dt
+        mulimb0[indx[j]] = mulimb[j]
+
+    return mulimb0, mulimbf, nr
+
+
+@njit(cache=True, nogil=True)
+def sys_model(phase, hst_phase, sh, m_fac, hstp1, hstp2, hstp3, hstp4, xshift1, xshift2, xshift3, xshift4):
+    """
+    Systematic model for WFC3 data, see margmodule.sys_model().
+    :return: sys_m: array
+    """
+    sys_m = np.empty(phase.size)
+    for j in range(phase.size):
+        hp = hst_phase[j]
+        s = sh[j]
+        sys_m[j] = (phase[j] * m_fac + 1.0) * (
+                hp * hstp1 + hp ** 2. * hstp2 + hp ** 3. * hstp3 + hp ** 4. * hstp4 + 1.0) * (
+                s * xshift1 + s ** 2. * xshift2 + s ** 3. * xshift3 + s ** 4. * xshift4 + 1.0)
+    return sys_m
+
+
+@njit(cache=True, nogil=True)
+def phase_calc(data, epoch, period):
+    """
+    Convert time array data in terms of phase in the interval [-0.5, 0.5], see margmodule.phase_calc().
+    :param data: 1D array, times in days
+    :param epoch: float, center of period in days
+    :param period: float, phase period in days
+    :return: phase: array
+    """
+    phase = np.empty(data.size)
+    for j in range(data.size):
+        phase1 = (data[j] - epoch) / period
+        phase[j] = phase1 - np.floor(phase1)
+        if phase[j] > 0.5:
+            phase[j] -= 1.0
+    return phase
+
+
+@njit(cache=True, nogil=True)
+def impact_param(period, msmpr, phase, incl, grav):
+    """
+    Calculate impact parameter, see margmodule.impact_param().
+    :param period: float, period in seconds
+    :param msmpr: float, MsMpR
+    :param phase: 1D array, phase
+    :param incl: float, inclination in radians
+    :param grav: float, gravitational constant in SI units
+    :return: b0: array
+    """
+    scale = (grav * period * period / (4 * np.pi * np.pi)) ** (1 / 3.) * (msmpr ** (1 / 3.))
+    b0 = np.empty(phase.size)
+    for j in range(phase.size):
+        b0[j] = scale * np.sqrt(np.sin(phase[j] * 2 * np.pi) ** 2 + (np.cos(incl) * np.cos(phase[j] * 2 * np.pi)) ** 2)
+    return b0
@@ -0,0 +1,132 @@
+"""
+Sherpa optimiser running scipy.optimize.least_squares with the analytic Jacobian of the transit model.
+
+Sherpa's LevMar builds the Jacobian of the fit by forward differences, which costs one model evaluation per free
+parameter and iteration. The LeastSquares optimiser takes a function returning the Jacobian of the residuals instead
+(residual_jacobian() builds it from Transit.jacobian()) and derives the covariance matrix of the best fit from the same
+Jacobian, so tres.extra_output['covar'] is available just like with LevMar.
+"""
+
+import numpy as np
+from scipy import optimize
+from sherpa.optmethods import OptMethod
+
+EPSILON = np.float64(np.finfo(np.float32).eps)   # same default tolerances as sherpa.optmethods.LevMar
+# The step tolerance is relative to the norm of the scaled parameter vector, which the epoch in MJD dominates; with
+# the LevMar default the fit would stop long before rl and the systematics have converged
+XTOL = 1e-12
+HUGE = np.finfo(np.float32).max                  # Sherpa's hard parameter limits, which mean "unbounded"
+
+
+def lsq(fcn, x0, xmin, xmax, jac=None, ftol=EPSILON, xtol=XTOL, gtol=EPSILON, maxfev=None, method=None, verbose=0):
+    """
+    Least-squares minimisation with scipy.optimize.least_squares, with the call signature of a Sherpa optimiser.
+    :param fcn: function, returns the statistic and the residuals (fvec) for a list of parameter values
+    :param x0: array, starting values of the thawed parameters
+    :param xmin: array, lower limits of the thawed parameters
+    :param xmax: array, upper limits of the thawed parameters
+    :param jac: function, returns the Jacobian of the residuals, shape (number of residuals, number of parameters),
+                for a list of parameter values; None means finite differences
+    :param ftol: float, tolerance on the change of the statistic
+    :param xtol: float, tolerance on the change of the parameters
+    :param gtol: float, tolerance on the gradient
+    :param maxfev: int, maximum number of function evaluations; None means 256 per parameter like LevMar
+    :param method: string, 'lm' or 'trf' (see scipy.optimize.least_squares); None picks 'lm' for unbounded parameters
+                   and 'trf' otherwise
+    :param verbose: int, verbosity of scipy.optimize.least_squares
+    :return: tuple of success, best-fit parameters, statistic, message and a dict with the covariance matrix (covar),
+             the number of function (nfev) and Jacobian (njev) evaluations
+    """
+    x0 = np.asarray(x0, dtype=float)
+    lower = np.where(np.asarray(xmin) <= -HUGE, -np.inf, xmin)
+    upper = np.where(np.asarray(xmax) >= HUGE, np.inf, xmax)
+    if method is None:
+        method = 'lm' if np.all(np.isinf(lower)) and np.all(np.isinf(upper)) else 'trf'
+    if maxfev is None:
+        maxfev = 256 * x0.size
+
+    def residuals(pars):
+        return np.asarray(fcn(pars)[1], dtype=float)
+
+    result = optimize.least_squares(residuals, x0, jac='2-point' if jac is None else jac,
+                                    bounds=(lower, upper), method=method, ftol=ftol, xtol=xtol, gtol=gtol,
+                                    x_scale='jac', max_nfev=maxfev, verbose=verbose)
+
+    # The Jacobian returned by 'lm' is not the one at the solution, so it is evaluated there once more
+    final_jac = result.jac if jac is None else jac(result.x)
+    fval = 2 * result.cost   # chi squared
+    extra = {'covar': covariance(final_jac), 'nfev': result.nfev, 'njev': result.njev, 'info': result.status}
+
+    return result.success, result.x, fval, result.message, extra
+
+
+class LeastSquares(OptMethod):
+    """Sherpa optimiser running scipy.optimize.least_squares, see lsq().
+
+    Set opt.config['jac'] to a function returning the Jacobian of the residuals to use it instead of finite
+    differences, e.g. residual_jacobian(tmodel, tdata)."""
+
+    def __init__(self, name='least_squares'):
+        OptMethod.__init__(self, name, lsq)
+
+
+def residual_jacobian(model, data):
+    """
+    Jacobian of the chi residuals (model - data) / staterror of a fit, as used by Sherpa's Chi2 statistic.
+    :param model: Sherpa model with a jacobian(pars, x) method, e.g. margmodule.Transit
+    :param data: sherpa.data.Data1D with staterror
+    :return: function of the thawed parameter values returning an array of shape (len(data.x), number of thawed
+             parameters)
+    """
+    def jac(thawedpars):
+        model.thawedpars = thawedpars
+        return (model.jacobian([par.val for par in model.pars], data.x) / data.staterror).T
+
+    return jac
+
+
+def covariance(jac):
+    """
+    Covariance matrix (J^T J)^-1 of the parameters of a least-squares fit from the Jacobian J of its residuals.
+
+    The columns of J are normalised first, as the parameters of the transit model cover many orders of magnitude, and
+    singular directions (e.g. a parameter the model does not depend on) are dropped instead of blowing up the inverse.
+    :param jac: array of shape (number of residuals, number of parameters)
+    :return: covar: array of shape (number of parameters, number of parameters)
+    """
+    jac = np.atleast_2d(jac)
+    norms = np.linalg.norm(jac, axis=0)
+    norms[norms == 0] = 1.
+    _u, singular, vt = np.linalg.svd(jac / norms, full_matrices=False)
+    keep = singular > np.finfo(float).eps * max(jac.shape) * singular[0]
+    covar = (vt[keep].T / singular[keep] ** 2) @ vt[keep]
+
+    return covar / np.outer(norms, norms)
+
+
+def linearised_fit(jac, resid, free, offset):
+    """
+    Best fit of a least-squares problem linearised around a point, with the parameters that are not free held at
+    given values.
+
+    Around a best fit with residuals r and Jacobian J, moving the parameters by a step d changes the residuals to
+    r + J d. Holding some parameters at a fixed offset from the point and minimising over the others is a linear
+    least-squares problem, solved here on the normalised columns of J like in covariance().
+    :param jac: array of shape (number of residuals, number of parameters), Jacobian of the residuals at the point
+    :param resid: array, residuals at the point
+    :param free: array of bool, which parameters are fit
+    :param offset: array, offsets of the parameters that are not free from the point, ignored for the free ones
+    :return: step: array, step from the point to the linearised best fit, its predicted sum of squares, and the
+             covariance matrix of the free parameters
+    """
+    jac = np.atleast_2d(jac)
+    free = np.asarray(free, dtype=bool)
+    step = np.where(free, 0., offset)
+    fixed_resid = resid + jac @ step
+    free_jac = jac[:, free]
+    norms = np.linalg.norm(free_jac, axis=0)
+    norms[norms == 0] = 1.
+    step[free] = -np.linalg.lstsq(free_jac / norms, fixed_resid, rcond=None)[0] / norms
+    predicted = np.sum((fixed_resid + free_jac @ step[free]) ** 2)
+
+    return step, predicted, covariance(free_jac)
@@ -0,0 +1,412 @@
+"""
+Analytic transit light curves for the quadratic and the four-parameter nonlinear limb darkening laws, as an alternative
+engine to the numerical integration in margmodule.occultnl().
+
+The terms of the nonlinear law with integer powers of mu (c2, c4, and with that the full quadratic law) are computed
+with the closed-form solutions of Mandel & Agol (2002), Section 3 and Table 1, using Bulirsch's complete elliptic
+integral. The half-integer powers of mu (c1, c3) have no closed form in elementary functions and elliptic integrals;
+they are computed from the closed-form overlap area of the planet and the stellar disk with a fixed-order Gauss-Legendre
+rule between the radii where the planet limb crosses the stellar annuli. Every evaluation is therefore a fixed number
+of vectorized array operations, without any adaptive loop.
+
+occultnl_quadrature() integrates all components with the same rule, with the order chosen per point to meet a user-set
+tolerance, and reports its error estimate.
+
+The outputs follow the conventions of margmodule.occultnl(), so that both engines can be swapped freely.
+"""
+
+import functools
+import numpy as np
+import astropy.units as u
+
+
+def occultnl_analytic(rl, c1, c2, c3, c4, b0, order=12):
+    """
+    Analytic MANDEL & AGOL (2002) transit model for the four-parameter nonlinear limb darkening law.
+    :param rl: float or array, transit depth (Rp/R*); an array gets broadcast against b0
+    :param c1: float, limb darkening parameter 1
+    :param c2: float, limb darkening parameter 2
+    :param c3: float, limb darkening parameter 3
+    :param c4: float, limb darkening parameter 4
+    :param b0: impact parameter in stellar radii
+    :param order: int, default=12; order of the Gauss-Legendre rule used for the half-integer terms (c1, c3)
+    :return: mulimb0: limb-darkened transit model, mulimbf: lightcurves for each component that you put in the model
+    """
+
+    if isinstance(b0, u.Quantity):
+        b0 = b0.value
+    if isinstance(rl, u.Quantity):
+        rl = rl.value
+
+    z = np.atleast_1d(np.asarray(b0, dtype=float))
+    p = np.asarray(rl, dtype=float)
+    p, z = np.broadcast_arrays(p, z)
+
+    # Flux deficits of the components mu^(n/2), n = 0 ... 4, normalised such that a fully occulted star gives 4/(n+4)
+    deficit = np.zeros((5,) + z.shape)
+    lambdae, lambdad, etad = occultquad_components(p, z)
+    deficit[0] = lambdae
+    deficit[2] = lambdad + 2. / 3. * (p > z) * (lambdae > 0)
+    deficit[4] = lambdae - etad
+
+    # The closed forms of lambda^d lose precision to cancellation when the planet limb is very close to the stellar
+    # centre (z -> p), so these few points are integrated instead
+    near_centre = (np.abs(z - p) < 1e-6) & (lambdae > 0)
+    if np.any(near_centre):
+        deficit[2::2, near_centre] = _integrated_deficits((2, 4), p[near_centre], z[near_centre], order)
+
+    if c1 != 0 or c3 != 0:
+        deficit[1::2] = _integrated_deficits((1, 3), p, z, order)
+
+    n = np.arange(5).reshape((5,) + (1,) * z.ndim)
+    mulimbf = 4. / (n + 4.) - deficit
+
+    c0 = 1 - c1 - c2 - c3 - c4
+    omega = 4 * (c0 / 4 + c1 / 5 + c2 / 6 + c3 / 7 + c4 / 8)
+    mulimb0 = (c0 * mulimbf[0] + c1 * mulimbf[1] + c2 * mulimbf[2] + c3 * mulimbf[3] + c4 * mulimbf[4]) / omega
+    mulimb0[lambdae == 0] = 1.
+
+    return mulimb0, mulimbf
+
+
+def occultnl_quadrature(rl, c1, c2, c3, c4, b0, rtol=1e-8, atol=1e-10, max_order=1024, return_error=False):
+    """
+    MANDEL & AGOL (2002) transit model for the nonlinear limb darkening law by error-controlled quadrature.
+
+    All four limb darkening components are integrated with the Gauss-Legendre rule of _integrated_deficits(). For every
+    point the order is doubled until two consecutive orders agree within the tolerance, and converged points are
+    dropped from further refinement. Because the substitution removes the square-root behaviour at the ends of the
+    integration interval, the rule converges quickly and typically needs 16 to 64 nodes where occultnl() needs
+    thousands of annuli for a much larger tolerance.
+    :param rl: float or array, transit depth (Rp/R*); an array gets broadcast against b0
+    :param c1: float, limb darkening parameter 1
+    :param c2: float, limb darkening parameter 2
+    :param c3: float, limb darkening parameter 3
+    :param c4: float, limb darkening parameter 4
+    :param b0: impact parameter in stellar radii
+    :param rtol: float, default=1e-8; tolerance relative to the transit depth 1 - mulimb0 at each point
+    :param atol: float, default=1e-10; absolute tolerance of mulimb0
+    :param max_order: int, default=1024; highest order of the Gauss-Legendre rule
+    :param return_error: bool, default=False; if True, also return the error estimate of every point
+    :return: mulimb0: limb-darkened transit model, mulimbf: lightcurves for each component that you put in the model,
+             error: estimated absolute error of mulimb0 at each point (the change between the last two orders, which
+             bounds the error of the returned higher order), only if return_error=True
+    """
+
+    if isinstance(b0, u.Quantity):
+        b0 = b0.value
+    if isinstance(rl, u.Quantity):
+        rl = rl.value
+
+    z = np.atleast_1d(np.asarray(b0, dtype=float))
+    p = np.asarray(rl, dtype=float)
+    p, z = np.broadcast_arrays(p, z)
+    shape = z.shape
+    p, z = p.ravel(), z.ravel()
+
+    c0 = 1 - c1 - c2 - c3 - c4
+    omega = 4 * (c0 / 4 + c1 / 5 + c2 / 6 + c3 / 7 + c4 / 8)
+    coeffs = np.array([c1, c2, c3, c4])[:, np.newaxis] / omega
+
+    deficit = np.zeros((5, z.size))
+    deficit[0] = _overlap_area(1., p, z) / np.pi
+    error = np.zeros(z.size)
+
+    active = np.where((z < 1 + p) & (p > 0))[0]
+    order = 8
+    previous = _integrated_deficits((1, 2, 3, 4), p[active], z[active], order)
+    while active.size > 0 and order < max_order:
+        order *= 2
+        current = _integrated_deficits((1, 2, 3, 4), p[active], z[active], order)
+        deficit[1:, active] = current
+        error[active] = np.abs(np.sum(coeffs * (current - previous), axis=0))
+
+        depth = c0 / omega * deficit[0, active] + np.sum(coeffs * current, axis=0)
+        pending = error[active] > np.maximum(atol, rtol * np.abs(depth))
+        active = active[pending]
+        previous = current[:, pending]
+
+    n = np.arange(5)[:, np.newaxis]
+    mulimbf = 4. / (n + 4.) - deficit
+    mulimb0 = (c0 * mulimbf[0] + c1 * mulimbf[1] + c2 * mulimbf[2] + c3 * mulimbf[3] + c4 * mulimbf[4]) / omega
+    mulimb0[deficit[0] == 0] = 1.
+
+    mulimb0 = mulimb0.reshape(shape)
+    mulimbf = mulimbf.reshape((5,) + shape)
+    if return_error:
+        return mulimb0, mulimbf, error.reshape(shape)
+    return mulimb0, mulimbf
+
+
+def occultquad(rl, u1, u2, b0):
+    """
+    Analytic MANDEL & AGOL (2002) transit model for the quadratic limb darkening law
+    I(mu) = 1 - u1 * (1 - mu) - u2 * (1 - mu)^2.
+    :param rl: float or array, transit depth (Rp/R*)
+    :param u1: float, linear limb darkening coefficient
+    :param u2: float, quadratic limb darkening coefficient
+    :param b0: impact parameter in stellar radii
+    :return: mulimb0: limb-darkened transit model, mulimbf: lightcurves for each component that you put in the model
+    """
+    return occultnl_analytic(rl, 0., u1 + 2 * u2, 0., -u2, b0)
+
+
+def occultquad_components(p, z):
+    """
+    Closed-form flux deficits lambda^e, lambda^d and eta^d of Mandel & Agol (2002), Table 1.
+
+    :param p: array, radius ratio (Rp/R*), same shape as z
+    :param z: array, impact parameter in stellar radii
+    :return: lambdae, lambdad, etad; arrays of the shape of z
+    """
+
+    p = np.asarray(p, dtype=float)
+    z = np.asarray(z, dtype=float)
+    lambdae = np.zeros(z.shape)
+    lambdad = np.zeros(z.shape)
+    etad = np.zeros(z.shape)
+
+    tol = 1e-13
+    transit = (z < 1 + p) & (p > 0)
+
+    # Star fully occulted (case 11)
+    full = transit & (p >= 1) & (z <= p - 1)
+    lambdae[full] = 1.
+    etad[full] = 0.5
+
+    # Planet crossing the stellar limb (cases 2, 7, 8)
+    limb = transit & ~full & (z > np.abs(1 - p) - tol * (p > 0.5))
+    if np.any(limb):
+        pl, zl = p[limb], z[limb]
+        lambdae[limb] = _overlap_area(1., pl, zl) / np.pi
+        etad[limb] = _eta1(pl, zl)
+        lam = np.empty(pl.shape)
+        centre = np.abs(pl - zl) < tol   # case 7, only possible for p > 0.5
+        lam[centre] = _lambda3(pl[centre])
+        lam[~centre] = _lambda1(pl[~centre], zl[~centre])
+        lambdad[limb] = lam
+
+    # Planet fully inside the stellar disk (cases 3, 4, 5, 6, 9, 10)
+    inside = transit & ~full & ~limb
+    if np.any(inside):
+        pi_, zi = p[inside], z[inside]
+        lambdae[inside] = pi_ ** 2
+        etad[inside] = _eta2(pi_, zi)
+        lam = np.empty(pi_.shape)
+        origin = zi < tol                                   # case 10
+        edge = ~origin & (np.abs(zi - (1 - pi_)) < tol)     # case 4
+        centre = ~origin & ~edge & (np.abs(zi - pi_) < tol)  # cases 5 and 6
+        rest = ~origin & ~edge & ~centre                    # cases 3 and 9
+        lam[origin] = _lambda6(pi_[origin])
+        lam[edge] = _lambda5(pi_[edge])
+        lam[centre] = _lambda4(pi_[centre])
+        lam[rest] = _lambda2(pi_[rest], zi[rest])
+        lambdad[inside] = lam
+
+    return lambdae, lambdad, etad
+
+
+def _lambda1(p, z):
+    """lambda_1 of Mandel & Agol (2002), planet crossing the stellar limb."""
+    a = (z - p) ** 2
+    b = (z + p) ** 2
+    q = p ** 2 - z ** 2
+    k = np.sqrt((1 - a) / (4 * z * p))
+    kc = np.sqrt(np.maximum(1 - k ** 2, 0.))
+    ellk, elle, ellpi = _complete_elliptic(kc, 1. / a)
+    return (((1 - b) * (2 * b + a - 3) - 3 * q * (b - 2)) * ellk + 4 * p * z * (z ** 2 + 7 * p ** 2 - 4) * elle
+            - 3 * q / a * ellpi) / (9 * np.pi * np.sqrt(p * z))
+
+
+def _lambda2(p, z):
+    """lambda_2 of Mandel & Agol (2002), planet fully inside the stellar disk."""
+    a = (z - p) ** 2
+    b = (z + p) ** 2
+    q = p ** 2 - z ** 2
+    kinv = np.sqrt(4 * z * p / (1 - a))
+    kc = np.sqrt(np.maximum(1 - kinv ** 2, 0.))
+    ellk, elle, ellpi = _complete_elliptic(kc, b / a)
+    return 2 * ((1 - 5 * z ** 2 + p ** 2 + q ** 2) * ellk + (1 - a) * (z ** 2 + 7 * p ** 2 - 4) * elle
+                - 3 * q / a * ellpi) / (9 * np.pi * np.sqrt(1 - a))
+
+
+def _lambda3(p):
+    """lambda_3 of Mandel & Agol (2002), planet edge on the stellar centre, p > 0.5."""
+    kc = np.sqrt(1 - 1 / (4 * p ** 2))
+    ellk, elle, _ = _complete_elliptic(kc, 1.)
+    return (1. / 3. + 16 * p / (9 * np.pi) * (2 * p ** 2 - 1) * elle
+            - (1 - 4 * p ** 2) * (3 - 8 * p ** 2) / (9 * np.pi * p) * ellk)
+
+
+def _lambda4(p):
+    """lambda_4 of Mandel & Agol (2002), planet edge on the stellar centre, p <= 0.5."""
+    kc = np.sqrt(np.maximum(1 - 4 * p ** 2, 0.))
+    ellk, elle, _ = _complete_elliptic(kc, 1.)
+    return 1. / 3. + 2 / (9 * np.pi) * (4 * (2 * p ** 2 - 1) * elle + (1 - 4 * p ** 2) * ellk)
+
+
+def _lambda5(p):
+    """lambda_5 of Mandel & Agol (2002), planet touching the stellar limb from inside."""
+    return (2 / (3 * np.pi) * np.arccos(1 - 2 * p) - 4 / (9 * np.pi) * (3 + 2 * p - 8 * p ** 2) * np.sqrt(p * (1 - p))
+            - 2. / 3. * (p > 0.5))
+
+
+def _lambda6(p):
+    """lambda_6 of Mandel & Agol (2002), planet centred on the stellar disk."""
+    return -2. / 3. * (1 - p ** 2) ** 1.5
+
+
+def _eta1(p, z):
+    """eta_1 of Mandel & Agol (2002), planet crossing the stellar limb."""
+    a = (z - p) ** 2
+    b = (z + p) ** 2
+    kap1 = np.arccos(np.clip((1 - p ** 2 + z ** 2) / (2 * z), -1., 1.))
+    kap0 = np.arccos(np.clip((p ** 2 + z ** 2 - 1) / (2 * p * z), -1., 1.))
+    return (kap1 + 2 * _eta2(p, z) * kap0 - 0.25 * (1 + 5 * p ** 2 + z ** 2) * np.sqrt(np.maximum((1 - a) * (b - 1), 0.))) \
+        / (2 * np.pi)
+
+
+def _eta2(p, z):
+    """eta_2 of Mandel & Agol (2002), planet fully inside the stellar disk."""
+    return p ** 2 / 2 * (p ** 2 + 2 * z ** 2)
+
+
+def _integrated_deficits(powers, p, z, order):
+    """
+    Flux deficits of the limb darkening components mu^(n/2), normalised like the occultnl() components, by integration.
+
+    With mu = s^2, the deficit is n/pi * integral_0^1 s^(n-1) A(r(s)) ds, where A(r) is the area of the planet that
+    falls onto the stellar disk of radius r = sqrt(1 - s^4). A(r) has a closed form everywhere and is a simple power of r
+    except between the radii |z-p| and z+p, where the planet limb cuts through the annuli. Only this part is integrated
+    numerically, with a Gauss-Legendre rule on a substitution that smooths the square-root behaviour at both ends.
+
+    :param powers: tuple of ints, powers n of mu in units of 1/2, all n >= 1
+    :param p: array, radius ratio (Rp/R*), same shape as z
+    :param z: array, impact parameter in stellar radii
+    :param order: int, order of the Gauss-Legendre rule
+    :return: array of shape (len(powers),) + z.shape, flux deficits for each power and z
+    """
+
+    deficits = np.zeros((len(powers),) + z.shape)
+    transit = (z < 1 + p) & (p > 0)
+    if not np.any(transit):
+        return deficits
+    p = p[transit]
+    z = z[transit]
+
+    r_outer = np.minimum(z + p, 1.)
+    r_inner = np.minimum(np.abs(z - p), 1.)
+    s_outer = (1 - r_outer ** 2) ** 0.25
+    s_inner = (1 - r_inner ** 2) ** 0.25
+    covered = p > z
+
+    # Overlap area at the nodes of the part where the planet limb cuts through the annuli, shared by all powers
+    lens = s_inner > s_outer
+    nodes, weights = _smoothed_gauss_legendre(order)
+    width = (s_inner - s_outer)[lens]
+    s = s_outer[lens, np.newaxis] + width[:, np.newaxis] * nodes
+    area = _lens_area(np.sqrt(1 - s ** 4), p[lens, np.newaxis], z[lens, np.newaxis])
+
+    for j, n in enumerate(powers):
+        # r > z+p: the whole planet falls onto the disk of radius r, A = pi p^2
+        result = p ** 2 * s_outer ** n
+        # r < |z-p|: disk of radius r fully covered by the planet if p > z (A = pi r^2), otherwise not at all (A = 0)
+        result += covered * (1 - s_inner ** n - n / (n + 4.) * (1 - s_inner ** (n + 4)))
+        # |z-p| < r < z+p: planet limb cuts through the annuli
+        result[lens] += n / np.pi * width * np.sum(weights * s ** (n - 1) * area, axis=-1)
+        deficits[j, transit] = result
+
+    return deficits
+
+
+def _lens_area(r, p, z):
+    """
+    Area of the lens-shaped overlap of a disk of radius r centred on the star and the planet disk of radius p at
+    distance z, for |r - p| <= z <= r + p.
+    """
+    kap1 = np.arccos(np.clip((r ** 2 - p ** 2 + z ** 2) / (2 * r * z), -1., 1.))
+    kap0 = np.arccos(np.clip((p ** 2 + z ** 2 - r ** 2) / (2 * p * z), -1., 1.))
+    return r ** 2 * kap1 + p ** 2 * kap0 - 0.5 * np.sqrt(np.maximum(4 * z ** 2 * r ** 2 - (r ** 2 + z ** 2 - p ** 2) ** 2, 0.))
+
+
+def _overlap_area(r, p, z):
+    """
+    Area of the overlap of a disk of radius r centred on the star and the planet disk of radius p at distance z.
+    :param r: float or array, radius of the centred disk
+    :param p: array, radius of the planet
+    :param z: array, distance between the two centres
+    :return: array, overlap area
+    """
+
+    r, p, z = np.broadcast_arrays(np.asarray(r, dtype=float), p, z)
+    area = np.zeros(r.shape)
+
+    lens = (z < r + p) & (z > np.abs(r - p))
+    area[lens] = _lens_area(r[lens], p[lens], z[lens])
+
+    inner = z <= np.abs(r - p)
+    area[inner] = np.pi * np.minimum(r[inner], p[inner]) ** 2
+
+    return area
+
+
+@functools.lru_cache(maxsize=None)
+def _smoothed_gauss_legendre(order):
+    """
+    Nodes and weights on [0, 1] of a Gauss-Legendre rule of the given order, composed with the substitution
+    t -> t^2 (3 - 2t), which has a vanishing derivative at both ends of the interval.
+    """
+    x, w = np.polynomial.legendre.leggauss(order)
+    t = 0.5 * (x + 1)
+    nodes = t ** 2 * (3 - 2 * t)
+    weights = 0.5 * w * 6 * t * (1 - t)
+    nodes.flags.writeable = weights.flags.writeable = False   # shared by all callers
+    return nodes, weights
+
+
+def _complete_elliptic(kc, pi_p):
+    """
+    Complete elliptic integrals K(k), E(k) and Pi(n, k) with one vectorized call of Bulirsch's cel.
+    :param kc: array, complementary modulus sqrt(1 - k^2)
+    :param pi_p: float or array, 1 - n for the integral of the third kind
+    :return: K, E, Pi; arrays of the shape of kc
+    """
+    kc = np.asarray(kc, dtype=float)
+    ones = np.ones(kc.shape)
+    result = _cel(np.stack([kc, kc, kc]), np.stack([ones, ones, pi_p * ones]), 1., np.stack([ones, kc ** 2, ones]))
+    return result[0], result[1], result[2]
+
+
+def _cel(kc, p, a, b):
+    """
+    Bulirsch's general complete elliptic integral, vectorized,
+    cel(kc, p, a, b) = int_0^(pi/2) (a cos^2 + b sin^2) / ((cos^2 + p sin^2) sqrt(cos^2 + kc^2 sin^2)) dphi, for p > 0.
+
+    K(k) = cel(kc, 1, 1, 1), E(k) = cel(kc, 1, 1, kc^2) and Pi(n, k) = cel(kc, 1 - n, 1, 1), with kc = sqrt(1 - k^2).
+    """
+
+    kc, p, a, b = [np.array(arg, dtype=float) for arg in np.broadcast_arrays(kc, p, a, b)]
+    ca = np.sqrt(np.finfo(float).eps)
+
+    kc = np.maximum(np.abs(kc), np.finfo(float).tiny)
+    e = kc.copy()
+    m = np.ones(kc.shape)
+    p = np.sqrt(p)
+    b = b / p
+
+    done = np.zeros(kc.shape, dtype=bool)
+    for _ in range(100):
+        f = a
+        a = np.where(done, a, a + b / p)
+        g = e / p
+        b = np.where(done, b, 2 * (b + f * g))
+        p = np.where(done, p, g + p)
+        g = m
+        m = np.where(done, m, kc + m)
+        done = done | (np.abs(g - kc) <= g * ca)
+        if np.all(done):
+            break
+        kc = np.where(done, kc, 2 * np.sqrt(e))
+        e = np.where(done, e, kc * m)
+
+    return 0.5 * np.pi * (a * m + b) / (m * (m + p))
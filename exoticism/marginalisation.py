@@ -17,7 +17,10 @@ Continued translation and implementation of Sherpa by Iva Laginja (@ivalaginja).
 
 import csv
 import os
+import threading
 import time
+from types import SimpleNamespace
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from shutil import copy
 import numpy as np
 import matplotlib.pyplot as plt
@@ -30,19 +33,733 @@ from sherpa.stats import Chi2
 from sherpa.fit import Fit
 from sherpa.estmethods import Confidence
 
+from exoticism.batched_lm import lockstep_lm
 from exoticism.config import CONFIG_INI
+from exoticism.least_squares import LeastSquares, covariance, linearised_fit, residual_jacobian
 from exoticism.limb_darkening import limb_dark_fit
+from exoticism.mandel_agol import occultnl_quadrature
+from exoticism.reparameterisation import Reparameterised, transit_transforms
 import exoticism.margmodule as marg
 
 
-def total_marg(exoplanet, x, y, err, sh, wavelength, ld_model, grating, grid_selection, output_dir, run_name, plotting=True, report=True):
+class GridFitter:
+    """Sherpa data, transit model and fit object for fitting the rows of the grid of systematic models.
+
+    total_marg() uses one of these in the main process and every worker process builds its own from the same
+    arguments, as Sherpa models keep their parameter values in the model object itself."""
+
+    def __init__(self, x, y, err, sh, tzero, msmpr, c1, c2, c3, c4, flux0, optimizer='least_squares',
+                 profile_flux0=False, reparameterise=False):
+        """
+        :param x: array, times of the exposures in MJD
+        :param y: array, normalised flux
+        :param err: array, error on the normalised flux
+        :param sh: array, x-shifts of the spectra
+        :param tzero: astropy Quantity, time of the first exposure
+        :param msmpr: float, density of the system
+        :param c1: float, limb darkening coefficient
+        :param c2: float, limb darkening coefficient
+        :param c3: float, limb darkening coefficient
+        :param c4: float, limb darkening coefficient
+        :param flux0: float, starting value of the flux normalisation
+        :param optimizer: string, 'least_squares', 'levmar' or 'batched_lm'; 'batched_lm' fits many rows in lockstep
+                          with fit_batch() and uses 'least_squares' for single fits
+        :param profile_flux0: bool, whether flux0 is solved for analytically instead of being fit
+        :param reparameterise: bool, whether the optimizer fits internal coordinates of the parameters, see
+                               reparameterisation.Reparameterised; fit_batch() always fits the physical parameters
+        """
+        # Instantiate a data object
+        self.tdata = Data1D('Data', x, y, staterror=err)
+
+        # Set up the Sherpa transit model
+        self.tmodel = marg.Transit(tzero, msmpr, c1, c2, c3, c4, flux0, name="TransitModel", sh=sh)
+        self.profile_flux0 = profile_flux0
+        if profile_flux0:
+            self.tmodel.profile_flux0(self.tdata)
+
+        # Set up statistics and optimizer
+        stat = Chi2()
+        self.batched = optimizer == 'batched_lm'
+        if optimizer in ('least_squares', 'batched_lm'):
+            opt = LeastSquares()
+            opt.config['jac'] = residual_jacobian(self.tmodel, self.tdata)   # analytic Jacobian, which also gives the covariance
+        elif optimizer == 'levmar':
+            opt = LevMar()
+            opt.config['epsfcn'] = np.finfo(float).eps
+        else:
+            raise ValueError("optimizer has to be 'least_squares', 'levmar' or 'batched_lm', not '{}'.".format(optimizer))
+
+        self.transforms = None
+        if reparameterise:
+            self.transforms = transit_transforms(self.tmodel, x)
+            opt = Reparameterised(opt)
+
+        # Set up the fit object
+        self.tfit = Fit(self.tdata, self.tmodel, stat=stat, method=opt)  # Instantiate fit object
+        self.tfit.estmethod = Confidence()    # Set up error estimator we want. Need to define one even if we rely on the Hessian onyly.
+
+    def set_system(self, system, start=None):
+        """
+        Thaw and freeze the model parameters for one systematic model.
+        :param system: array, row of the systematic grid, 0 for a free and 1 for a fixed parameter
+        :param start: array, optional values of all model parameters the free ones start the fit from; they start
+                      from the input parameters if None
+        :return:
+        """
+        for k, select in enumerate(system):
+            if select == 0:
+                self.tmodel.pars[k].thaw()
+            elif select == 1:
+                self.tmodel.pars[k].freeze()
+        if self.profile_flux0:
+            self.tmodel.flux0.freeze()   # solved for analytically in every model evaluation instead
+        if self.transforms is not None:
+            self.tfit.method.transforms = [self.transforms.get(par.name) for par in self.tmodel.pars if not par.frozen]
+
+        # Only the free parameters are moved, and like a fit does it, so that reset() still goes back to the inputs
+        if start is not None:
+            self.tmodel.thawedpars = [start[k] for k, par in enumerate(self.tmodel.pars) if not par.frozen]
+
+    def fit(self, system, start=None, solution=None):
+        """
+        Fit one systematic model, or take over its solution from fit_batch().
+        :param system: array, row of the systematic grid
+        :param start: array, optional starting values of all parameters, see set_system()
+        :param solution: dict, optional result of fit_batch() for this row; the model is set to its best fit instead
+                         of fitting again
+        :return: sherpa.fit.FitResults, or an object with the same attributes used here for a solution
+        """
+        self.set_system(system, start)
+        if solution is None:
+            tres = self.tfit.fit()
+            self.tmodel.set_profiled_flux0()
+            return tres
+
+        self.tmodel.thawedpars = [solution['x'][k] for k, par in enumerate(self.tmodel.pars) if not par.frozen]
+        self.tmodel.set_profiled_flux0()
+        statval = self.tfit.calc_stat()
+        return SimpleNamespace(statval=statval, dof=len(self.tdata.x) - len(self.tmodel.thawedpars),
+                               succeeded=solution['success'], message=solution['message'], nfev=solution['nfev'],
+                               extra_output={'covar': solution['covar'], 'njev': solution.get('njev')})
+
+    def fit_batch(self, grid, starts=None):
+        """
+        Fit several systematic models at once with batched_lm.lockstep_lm(), on the batch evaluation of the transit
+        model (Transit.calc_batch()), which calls the limb darkening engine once for all of them.
+        :param grid: array, rows of the systematic grid
+        :param starts: list, optional starting values of all parameters for every row, None entries for the inputs;
+                       like in set_system() only the free parameters start from them
+        :return: list of dicts, one per row, see lockstep_lm(); pass them on to fit()
+        """
+        tdata, tmodel = self.tdata, self.tmodel
+        inputs = np.array([par.val for par in tmodel.pars])
+        free = (np.asarray(grid) == 0) & ~np.array([par.alwaysfrozen for par in tmodel.pars])
+        if self.profile_flux0:
+            free[:, 1] = False
+        x0 = np.tile(inputs, (len(free), 1))
+        if starts is not None:
+            for k, start in enumerate(starts):
+                if start is not None:
+                    x0[k, free[k]] = np.asarray(start)[free[k]]
+
+        def residuals(pars, rows):
+            return (tmodel.calc_batch(pars, tdata.x, free[rows]) - tdata.y) / tdata.staterror
+
+        def jacobian(pars, rows):
+            return tmodel.jacobian_batch(pars, tdata.x, free[rows]) / tdata.staterror
+
+        return lockstep_lm(residuals, jacobian, x0, free)
+
+    def covariance(self, tres):
+        """
+        Covariance matrix of the free parameters at the best fit.
+        :param tres: sherpa.fit.FitResults of the last fit
+        :return: array
+        """
+        if not self.profile_flux0:
+            return tres.extra_output['covar']
+
+        # flux0 was not a parameter of the fit, the covariance of all free parameters at the best fit follows from
+        # the Jacobian of the full model
+        self.tmodel.flux0.thaw()
+        covar = covariance(residual_jacobian(self.tmodel, self.tdata)(self.tmodel.thawedpars))
+        self.tmodel.flux0.freeze()
+        return covar
+
+
+def first_fit(fitter, system, start_params=None, solution=None):
+    """
+    First fit of one systematic model, which only serves as a starting point of the second one.
+    :param fitter: GridFitter
+    :param system: array, row of the systematic grid
+    :param start_params: array, optional starting values of all parameters, see GridFitter.set_system()
+    :param solution: dict, optional solution of GridFitter.fit_batch() for this row, see GridFitter.fit()
+    :return: dict with the best-fit parameters, the error on rl, the AIC, whether the fit succeeded, its message,
+             the number of model evaluations and of Jacobian evaluations (None if the optimizer does not count them)
+             and how long it took
+    """
+    start = time.time()
+    tmodel = fitter.tmodel
+    tres = fitter.fit(system, start_params, solution)  # do the fit
+
+    # Extract the error on rl from the Hessian
+    calc_errors = np.sqrt(tres.extra_output['covar'].diagonal())
+    result = {'params': np.array([par.val for par in tmodel.pars]), 'rl_err': calc_errors[0],
+              'AIC': tres.statval + np.count_nonzero(system == 0),
+              'succeeded': tres.succeeded, 'message': tres.message, 'nfev': tres.nfev,
+              'njev': tres.extra_output.get('njev')}
+
+    # Reset the model parameters to the input parameters
+    # Note on resetting: https://sherpa.readthedocs.io/en/latest/models/index.html#resetting-parameter-values
+    tmodel.reset()
+
+    result['time'] = time.time() - start
+    return result
+
+
+def second_fit(fitter, system, start_params, grid_selection, resolution, half_range, smooth_engine,
+               smooth_kernel_kwargs, solution=None):
+    """
+    Second fit of one systematic model and everything total_marg() saves about it.
+    :param fitter: GridFitter
+    :param system: array, row of the systematic grid
+    :param start_params: array, starting values of all parameters, see GridFitter.set_system(); None for the inputs
+    :param grid_selection: string, which grid of systematic models is used, see wfc3_systematic_model_grid_selection()
+    :param resolution: float, phase step of the smooth model
+    :param half_range: float, half range in phase of the smooth model
+    :param smooth_engine: string, limb darkening engine of the smooth model
+    :param smooth_kernel_kwargs: dict, keyword arguments of the smooth model engine
+    :param solution: dict, optional solution of GridFitter.fit_batch() for this row, see GridFitter.fit()
+    :return: dict with the fit results of this systematic model; ld_error is the largest error estimate of the
+             transit if the fit or the smooth model use the quadrature engine, NaN otherwise
+    """
+    start = time.time()
+    tdata, tmodel = fitter.tdata, fitter.tmodel
+    img_date = tdata.x * u.d
+    img_flux = tdata.y
+
+    tres = fitter.fit(system, start_params, solution)  # do the fit
+
+    # Getting errors directly from the covariance matrix in the fit, rl is always thawed.
+    calc_errors = np.sqrt(fitter.covariance(tres).diagonal())
+
+    rl_err = calc_errors[0]
+
+    # These are the only errors we might need, depending on "grid_selection"
+    epoch_err = None
+    incl_err = None
+    msmpr_err = None
+    ecc_err = None
+
+    # Read errors from Hessian depending on which parameters actually got fit
+    if grid_selection == 'fix_time':
+        pass
+    elif grid_selection == 'fit_time':
+        epoch_err = calc_errors[2]
+    elif grid_selection == 'fit_inclin':
+        incl_err = calc_errors[2]
+    elif grid_selection == 'fit_msmpr':
+        msmpr_err = calc_errors[2]
+    elif grid_selection == 'fit_ecc':
+        ecc_err = calc_errors[2]
+    elif grid_selection == 'fit_all':
+        epoch_err = calc_errors[2]
+        incl_err = calc_errors[3]
+        msmpr_err = calc_errors[4]
+
+    # We only really need the errors on rl, epoch, inclination, MsMpR and ecc, so I only save those. The rest
+    # of the errors in this array will be zero (and hence false, but we don't need them).
+    params_err = np.zeros(len(tmodel.pars))
+    params_err[0] = rl_err
+    if not tmodel.epoch.frozen:
+        params_err[2] = epoch_err
+    if not tmodel.inclin.frozen:
+        params_err[3] = incl_err
+    if not tmodel.msmpr.frozen:
+        params_err[4] = msmpr_err
+    if not tmodel.ecc.frozen:
+        params_err[5] = ecc_err
+
+    # Count free parameters by figuring out how many zeros we have in the current systematics
+    nfree = np.count_nonzero(system == 0)
+
+    # From the fit define the DOF, BIC, AIC & CHI
+    CHI = tres.statval  # chi squared of resulting fit
+    BIC = CHI + nfree * np.log(len(img_date))
+    AIC = CHI + nfree
+    DOF = tres.dof - 1 if fitter.profile_flux0 else tres.dof   # a profiled flux0 is still a free parameter
+
+    # EVIDENCE BASED on the AIC and BIC
+    Npoint = len(img_date)
+    sigma_points = np.median(tdata.staterror)
+
+    evidence_BIC = - Npoint * np.log(sigma_points) - 0.5 * Npoint * np.log(2 * np.pi) - 0.5 * BIC
+    evidence_AIC = - Npoint * np.log(sigma_points) - 0.5 * Npoint * np.log(2 * np.pi) - 0.5 * AIC
+
+    # OUTPUTS
+    # Re-Calculate each of the arrays dependent on the output parameters for the epoch
+    phase = marg.phase_calc(img_date, tmodel.epoch.val*u.d, tmodel.period.val*u.d, tmodel.use_numba)
+
+    # ...........................................
+    # TRANSIT MODEL fit to the data           # Issue #36
+    # Calculate the impact parameter based on the eccentricity function and from that the transit, integrated over
+    # the exposures if the model does so
+    mulimb01 = marg.transit_light_curve(tmodel.rl.val, tmodel.c1.val, tmodel.c2.val, tmodel.c3.val, tmodel.c4.val, phase,
+                                        tmodel.period.val*u.d, tmodel.msmpr.val, tmodel.inclin.val*u.rad, tmodel.ld_engine,
+                                        use_numba=tmodel.use_numba, **tmodel.supersample_kwargs,
+                                        **tmodel.kernel_kwargs)  # recalculated model at data resolution
+
+    # ...........................................
+    # SMOOTH TRANSIT MODEL across all phase    # Issue #35
+    # Calculate the impact parameter based on the eccentricity function - b0 in stellar radii
+    x_smooth = np.arange(-half_range, half_range, resolution)   # this is the x-array for the smooth model
+    b0_smooth = marg.impact_param((tmodel.period.val*u.d).to(u.s), tmodel.msmpr.val, x_smooth, tmodel.inclin.val*u.rad,
+                                  tmodel.use_numba)
+    mulimb0_smooth, _mulimbf2 = marg.limb_darkened_transit(tmodel.rl.val, tmodel.c1.val, tmodel.c2.val, tmodel.c3.val, tmodel.c4.val, b0_smooth,
+                                                           smooth_engine, use_numba=tmodel.use_numba,
+                                                           **smooth_kernel_kwargs)   # recalculated model at smooth resolution
+    # ..... smooth model end .....
+
+    # The quadrature engine controls its error, report the largest estimate at the exposure mid-times and of the
+    # smooth model
+    ld_error = np.nan
+    b0_data = marg.impact_param((tmodel.period.val*u.d).to(u.s), tmodel.msmpr.val, phase.value, tmodel.inclin.val*u.rad,
+                                tmodel.use_numba)
+    for engine, kernel_kwargs, b0 in [(tmodel.ld_engine, tmodel.kernel_kwargs, b0_data),
+                                      (smooth_engine, smooth_kernel_kwargs, b0_smooth)]:
+        if engine == 'quadrature':
+            _mulimb0, _mulimbf, error = occultnl_quadrature(tmodel.rl.val, tmodel.c1.val, tmodel.c2.val, tmodel.c3.val,
+                                                            tmodel.c4.val, b0, rtol=kernel_kwargs['rtol'],
+                                                            atol=kernel_kwargs['atol'], return_error=True)
+            ld_error = np.fmax(ld_error, np.max(error))
+
+    # Same polynomial bases of HST phase and shifts as in the fit
+    systematic_model = tmodel.systematic_model(img_date.value, phase.value)
+
+    fit_model = mulimb01 * tmodel.flux0.val * systematic_model     #  Issue #36
+    residuals = (img_flux - fit_model) / tmodel.flux0.val
+    resid_scatter = np.std(residuals)
+    fit_data = img_flux / (tmodel.flux0.val * systematic_model)   # this is the data after taking the fitted systematics out
+
+    white_noise, red_noise, beta = marg.noise_calculator(residuals)
+
+    result = {'params': np.array([par.val for par in tmodel.pars]), 'params_err': params_err,
+              'stats': [AIC, BIC, DOF, CHI, resid_scatter, white_noise, red_noise, beta],
+              'evidence_AIC': evidence_AIC, 'evidence_BIC': evidence_BIC, 'phase': np.asarray(phase),
+              'fit_data': fit_data, 'staterror': np.array(tdata.staterror), 'residuals': residuals,
+              'systematic_model': systematic_model, 'smooth_model': mulimb0_smooth, 'x_smooth': x_smooth,
+              'ld_error': ld_error, 'succeeded': tres.succeeded, 'message': tres.message, 'nfev': tres.nfev,
+              'njev': tres.extra_output.get('njev')}
+
+    # Reset the model parameters to the input parameters
+    tmodel.reset()
+
+    result['time'] = time.time() - start
+    return result
+
+
+# The GridFitter of a worker process of map_grid(), and of each of its worker threads
+_worker_fitter = None
+_thread_fitters = threading.local()
+
+
+def _init_worker(config, fitter_args):
+    """Set up a worker process of map_grid() with the configuration of the main process and its own GridFitter."""
+    global _worker_fitter
+    CONFIG_INI.read_dict(config)
+    _worker_fitter = GridFitter(*fitter_args)
+
+
+def _worker_call(function, system, start_params, kwargs):
+    return function(_worker_fitter, system, start_params, **kwargs)
+
+
+def _thread_call(function, system, start_params, fitter_args, kwargs):
+    """Fit one row on a worker thread of map_grid(), with the GridFitter of that thread."""
+    fitter = getattr(_thread_fitters, 'fitter', None)
+    if fitter is None:
+        fitter = _thread_fitters.fitter = GridFitter(*fitter_args)
+    return function(fitter, system, start_params, **kwargs)
+
+
+def _worker_pool(workers, fitter_args, executor):
+    """
+    Pool of workers with a GridFitter each, see map_grid().
+    :return: pool: concurrent.futures.Executor,
+             submit: function submitting function(fitter, system, start_params, **kwargs) to the pool, with the
+             arguments function, system, start_params and kwargs
+    """
+    if executor == 'thread':
+        # A fit changes the parameters of its model, so every thread fits with a GridFitter of its own
+        pool = ThreadPoolExecutor(max_workers=workers)
+
+        def submit(function, system, start_params, kwargs):
+            return pool.submit(_thread_call, function, system, start_params, fitter_args, kwargs)
+    elif executor == 'process':
+        # Hand the configuration over explicitly, as worker processes that are spawned instead of forked read it from
+        # disk
+        config = {section: dict(CONFIG_INI.items(section, raw=True)) for section in CONFIG_INI.sections()}
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(config, fitter_args))
+
+        def submit(function, system, start_params, kwargs):
+            return pool.submit(_worker_call, function, system, start_params, kwargs)
+    else:
+        raise ValueError("executor has to be 'process' or 'thread', not '{}'.".format(executor))
+    return pool, submit
+
+
+def map_grid(function, grid, workers, fitter_args, fitter=None, executor='process', parents=None, starts=None,
+             **kwargs):
+    """
+    Fit all rows of the systematic grid with first_fit() or second_fit(), in parallel if requested.
+
+    Every fit resets the model afterwards, so a row only depends on where it starts from: the input parameters, the
+    values in starts or the best fit of its parent row. Rows are fit in the order of their number of free
+    parameters, and in parallel a row is only handed to a worker once its parent is done, so the results are the same
+    for any number of workers. They are yielded in the order of the grid.
+
+    With a batched fitter (optimizer 'batched_lm'), all rows whose parent is done are fit in lockstep with
+    GridFitter.fit_batch() in this process, one level of the nesting after the other, and workers is ignored.
+    :param function: first_fit or second_fit
+    :param grid: array, systematic grid, one row per systematic model
+    :param workers: int, number of workers; the rows are fit in this process if it is 1 or less
+    :param fitter_args: tuple, arguments of the GridFitter of every worker
+    :param fitter: GridFitter used if the rows are fit in this process, built from fitter_args if None; a batched one
+                   fits all rows in this process
+    :param executor: string, 'process' for worker processes or 'thread' for worker threads in this process, which
+                     start faster and share the configuration and limb darkening tables, but only fit at the same time
+                     while the kernels release the GIL
+    :param parents: array of int, optional; row whose best fit each row starts from, -1 for none, see
+                    margmodule.nested_parents()
+    :param starts: array, optional; starting values of all parameters for each row that has no parent
+    :param kwargs: further keyword arguments of function
+    :return: generator of the results of function, one per row of the grid
+    """
+    nsys = len(grid)
+    if parents is None:
+        parents = np.full(nsys, -1)
+    results = [None] * nsys
+    waiting = list(np.argsort(np.count_nonzero(np.asarray(grid) == 0, axis=1), kind='stable'))   # parents first
+
+    def start_params(i):
+        if parents[i] >= 0:
+            return results[parents[i]]['params']
+        return None if starts is None else starts[i]
+
+    def ready(i):
+        return parents[i] < 0 or results[parents[i]] is not None
+
+    if fitter is None and (workers is None or workers <= 1):
+        fitter = GridFitter(*fitter_args)
+
+    if fitter is not None and fitter.batched:
+        next_row = 0
+        while waiting:
+            level = [i for i in waiting if ready(i)]
+            solutions = fitter.fit_batch(grid[level], [start_params(i) for i in level])
+            for i, solution in zip(level, solutions):
+                results[i] = function(fitter, grid[i], start_params(i), solution=solution, **kwargs)
+                waiting.remove(i)
+            while next_row < nsys and results[next_row] is not None:
+                yield results[next_row]
+                next_row += 1
+        return
+
+    if workers is None or workers <= 1:
+        next_row = 0
+        for i in waiting:
+            results[i] = function(fitter, grid[i], start_params(i), **kwargs)
+            while next_row < nsys and results[next_row] is not None:
+                yield results[next_row]
+                next_row += 1
+        return
+
+    pool, submit = _worker_pool(workers, fitter_args, executor)
+    with pool:
+        pending = {}
+        next_row = 0
+        while waiting or pending:
+            # Hand out every row whose parent is done
+            for i in [i for i in waiting if ready(i)]:
+                pending[submit(function, grid[i], start_params(i), kwargs)] = i
+                waiting.remove(i)
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                results[pending.pop(future)] = future.result()
+            while next_row < nsys and results[next_row] is not None:
+                yield results[next_row]
+                next_row += 1
+
+
+def search_grid(grid, workers, fitter_args, fitter=None, executor='process', beam=4, tolerance=1e-3, warm_start=True):
+    """
+    Adaptive search of the systematic grid with first_fit(), which only fits the models that can still matter.
+
+    The search starts from the models that are not nested in any other one (the model with all systematic terms free)
+    and walks the nesting lattice from the fitted models to their neighbours, see margmodule.nesting_neighbours(). Each
+    step fits the beam neighbours with the lowest AIC bound, see margmodule.aic_lower_bounds(), and the search stops
+    once the models that were not fitted can together have at most a share tolerance of the marginalisation weight,
+    see margmodule.unexplored_weight(), or all models are fitted.
+    :param grid: array, systematic grid, one row per systematic model
+    :param workers: int, number of workers fitting the models of a step, see map_grid()
+    :param fitter_args: tuple, arguments of the GridFitter of every worker
+    :param fitter: GridFitter used if the models are fit in this process, built from fitter_args if None
+    :param executor: string, 'process' or 'thread', see map_grid()
+    :param beam: int, default=4; number of models fit in every step
+    :param tolerance: float, default=1e-3; bound on the weight of the models that are not fitted
+    :param warm_start: bool, default=True; whether a model starts from the best fit of its fitted neighbour with the
+                       lowest AIC instead of the input parameters
+    :return: results: list of the results of first_fit(), None for the models that were not fitted,
+             unexplored: float, bound on the weight of these models
+    """
+    nsys = len(grid)
+    free = np.asarray(grid) == 0
+    neighbours = marg.nesting_neighbours(grid)
+    results = [None] * nsys
+    fitted = np.zeros(nsys, dtype=bool)
+    aic = np.full(nsys, np.inf)
+
+    step = [i for i in range(nsys) if not np.any(np.all(free[i] <= free, axis=1) & np.any(free[i] < free, axis=1))]
+    while True:
+        starts = None
+        if warm_start:
+            starts = []
+            for i in step:
+                candidates = np.flatnonzero(neighbours[i] & fitted)
+                starts.append(results[candidates[np.argmin(aic[candidates])]]['params'] if candidates.size else None)
+        for i, result in zip(step, map_grid(first_fit, grid[step], workers, fitter_args, fitter=fitter,
+                                            executor=executor, starts=starts)):
+            results[i] = result
+            aic[i] = result['AIC']
+            fitted[i] = True
+
+        unexplored = marg.unexplored_weight(grid, aic, fitted)
+        if unexplored <= tolerance or np.all(fitted):
+            return results, unexplored
+
+        frontier = ~fitted & np.any(neighbours[:, fitted], axis=1)
+        if not np.any(frontier):
+            frontier = ~fitted
+        candidates = np.flatnonzero(frontier)
+        bounds = marg.aic_lower_bounds(grid, aic, fitted)[candidates]
+        step = list(candidates[np.argsort(bounds, kind='stable')[:beam]])
+
+
+def full_fit(fitter, system, start_params=None):
+    """
+    Fit one systematic model and return it as a solution that first_fit() and second_fit() take over.
+    :param fitter: GridFitter
+    :param system: array, row of the systematic grid
+    :param start_params: array, optional starting values of all parameters, see GridFitter.set_system()
+    :return: dict with the best-fit values of all parameters (x), chi squared (fval), success, message, the
+             covariance matrix of the free parameters (covar) and the numbers of model and Jacobian evaluations (nfev,
+             njev)
+    """
+    tres = fitter.fit(system, start_params)
+    solution = {'x': np.array([par.val for par in fitter.tmodel.pars]), 'fval': tres.statval,
+                'success': tres.succeeded, 'message': tres.message, 'covar': tres.extra_output['covar'],
+                'nfev': tres.nfev, 'njev': tres.extra_output.get('njev')}
+    fitter.tmodel.reset()
+    return solution
+
+
+def approximate_grid(grid, workers, fitter_args, fitter=None, executor='process', tolerance=0.5):
+    """
+    Approximate fits of the systematic grid, linearised around the fits of a few anchor models.
+
+    The anchors are the models that are not nested in any other one (the model with all systematic terms free), which
+    are fitted in full. Every other model nested in an anchor differs from it by systematic terms that are held at
+    their input values; around the best fit of the anchor, its best fit is a linear least-squares problem on the
+    Jacobian of the anchor, see least_squares.linearised_fit(). The chi squared of all linearised fits is evaluated in
+    one call of Transit.calc_batch(), and the models where it differs from the linear prediction by more than
+    tolerance are fitted in full, starting from the linearised fit.
+    :param grid: array, systematic grid, one row per systematic model
+    :param workers: int, number of workers for the full fits, see map_grid()
+    :param fitter_args: tuple, arguments of the GridFitter of every worker
+    :param fitter: GridFitter of this process, built from fitter_args if None
+    :param executor: string, 'process' or 'thread', see map_grid()
+    :param tolerance: float, default=0.5; largest difference in chi squared between the linear prediction and the
+                      model for which a linearised fit is kept
+    :return: solutions: list of dicts, one per model, see full_fit(); pass them on to first_fit() and second_fit(),
+             refitted: array of bool, which models were fitted in full
+    """
+    if fitter is None:
+        fitter = GridFitter(*fitter_args)
+    tdata, tmodel = fitter.tdata, fitter.tmodel
+    nsys = len(grid)
+    free = np.asarray(grid) == 0
+    inputs = np.array([par.val for par in tmodel.pars])
+    solutions = [None] * nsys
+    refitted = np.zeros(nsys, dtype=bool)
+
+    anchors = [i for i in range(nsys) if not np.any(np.all(free[i] <= free, axis=1) & np.any(free[i] < free, axis=1))]
+    for i, solution in zip(anchors, map_grid(full_fit, grid[anchors], workers, fitter_args, fitter=fitter,
+                                             executor=executor)):
+        solutions[i] = solution
+        refitted[i] = True
+
+    linearised = np.zeros((nsys, len(inputs)))
+    predicted = np.zeros(nsys)
+    for anchor in anchors:
+        # Residuals and Jacobian of all free parameters of the anchor at its best fit, flux0 included
+        fitter.set_system(grid[anchor])
+        tmodel.flux0.thaw()
+        thawed = [k for k, par in enumerate(tmodel.pars) if not par.frozen]
+        tmodel.thawedpars = solutions[anchor]['x'][thawed]
+        resid = (tmodel.calc([par.val for par in tmodel.pars], tdata.x) - tdata.y) / tdata.staterror
+        jac = np.zeros((len(tdata.x), len(inputs)))
+        jac[:, thawed] = residual_jacobian(tmodel, tdata)([tmodel.pars[k].val for k in thawed])
+        tmodel.reset()
+
+        for i in np.flatnonzero(np.all(free <= free[anchor], axis=1)):
+            if solutions[i] is not None:
+                continue
+            step, predicted[i], covar = linearised_fit(jac, resid, free[i], inputs - solutions[anchor]['x'])
+            linearised[i] = solutions[anchor]['x'] + step
+            if fitter.profile_flux0:
+                keep = np.flatnonzero(free[i]) != 1   # flux0 is not a parameter of the fits then
+                covar = covar[np.ix_(keep, keep)]
+            solutions[i] = {'x': linearised[i], 'fval': predicted[i], 'success': True,
+                            'message': 'Linearised around systematic model {}'.format(anchor + 1), 'covar': covar,
+                            'nfev': 0}
+
+    # Check the linearised fits against the model, and fit the ones where the linearisation is poor
+    approximate = np.flatnonzero(~refitted)
+    models = tmodel.calc_batch(linearised[approximate], tdata.x, free[approximate])
+    chi2 = np.sum(((models - tdata.y) / tdata.staterror) ** 2, axis=1)
+    poor = approximate[np.abs(chi2 - predicted[approximate]) > tolerance]
+    for i, solution in zip(poor, map_grid(full_fit, grid[poor], workers, fitter_args, fitter=fitter,
+                                          executor=executor, starts=linearised[poor])):
+        solutions[i] = solution
+        refitted[i] = True
+    for i, value in zip(approximate, chi2):
+        if not refitted[i]:
+            solutions[i]['fval'] = value
+            solutions[i]['nfev'] = 1
+
+    return solutions, refitted
+
+
+def jittered_fit(fitter, system, start_params, covar, scale=3., seed=None):
+    """
+    Fit one systematic model from a random start around a previous best fit, see full_fit().
+    :param fitter: GridFitter
+    :param system: array, row of the systematic grid
+    :param start_params: array, values of all parameters of the previous best fit
+    :param covar: array, covariance matrix of the free parameters of the previous best fit
+    :param scale: float, default=3.; standard deviations of the jitter in units of the errors of the previous fit
+    :param seed: optional seed of numpy.random.default_rng()
+    :return: dict, see full_fit()
+    """
+    fitter.set_system(system)
+    pars = fitter.tmodel.pars
+    thawed = [k for k, par in enumerate(pars) if not par.frozen]
+    sigma = np.sqrt(np.abs(np.diagonal(covar)))
+    sigma[~np.isfinite(sigma)] = 0.
+    start = np.array(start_params, dtype=float)
+    start[thawed] += scale * sigma * np.random.default_rng(seed).standard_normal(len(thawed))
+    start[thawed] = np.clip(start[thawed], [pars[k].min for k in thawed], [pars[k].max for k in thawed])
+    return full_fit(fitter, system, start)
+
+
+def multi_start_grid(grid, workers, fitter_args, fitter=None, executor='process', starts=None, num_starts=4, scale=3.,
+                     tolerance=0.1, cancel=True, seed=0):
+    """
+    Fit every model of the systematic grid from several starts and keep the lowest chi squared.
+
+    The first start of a model is the input parameters (or its row of starts), the others are jittered around the best
+    fit of the first one by scale times its errors, see jittered_fit(). The starts of a model are taken in order, and
+    with cancel, the remaining ones are cancelled once two successful starts are within tolerance of the lowest chi
+    squared so far, which confirms the minimum. In parallel, all starts of the models are fit on one pool and the
+    results are taken in the same order, so they do not depend on the number of workers.
+    :param grid: array, systematic grid, one row per systematic model
+    :param workers: int, number of workers; the starts are fit in this process if it is 1 or less
+    :param fitter_args: tuple, arguments of the GridFitter of every worker
+    :param fitter: GridFitter used if the starts are fit in this process, built from fitter_args if None
+    :param executor: string, 'process' or 'thread', see map_grid()
+    :param starts: array, optional; first start of all parameters for each model
+    :param num_starts: int, default=4; number of starts per model
+    :param scale: float, default=3.; standard deviations of the jitter of the starts, see jittered_fit()
+    :param tolerance: float, default=0.1; chi squared within which two starts confirm the minimum of a model
+    :param cancel: bool, default=True; whether the remaining starts of a model are cancelled once its minimum is
+                   confirmed, otherwise all are fit
+    :param seed: int, default=0; seed of the jitter, which is drawn for every model and start from (seed, model, start)
+    :return: solutions: list of dicts, one per model, with the solution of the best start and the model evaluations of
+             all of its starts, see full_fit(); pass them on to first_fit(),
+             stats: dict of arrays, one entry per model: the number of starts that were fit (fitted) and cancelled
+             (cancelled), which start was the best one (best) and by how much it lowered the chi squared of the first
+             one (improvement)
+    """
+    nsys = len(grid)
+    runs = [[] for _ in range(nsys)]   # solutions of the starts that were taken of every model, in order
+
+    def start_params(i):
+        return None if starts is None else starts[i]
+
+    def jitter_kwargs(i, k):
+        return {'covar': runs[i][0]['covar'], 'scale': scale, 'seed': (seed, i, k)}
+
+    def confirmed(i):
+        fval = np.array([solution['fval'] for solution in runs[i] if solution['success']])
+        return cancel and fval.size >= 2 and np.count_nonzero(fval <= np.min(fval) + tolerance) >= 2
+
+    if workers is None or workers <= 1:
+        if fitter is None:
+            fitter = GridFitter(*fitter_args)
+        for i in range(nsys):
+            runs[i].append(full_fit(fitter, grid[i], start_params(i)))
+            while len(runs[i]) < num_starts and not confirmed(i):
+                runs[i].append(jittered_fit(fitter, grid[i], runs[i][0]['x'], **jitter_kwargs(i, len(runs[i]))))
+    else:
+        pool, submit = _worker_pool(workers, fitter_args, executor)
+        with pool:
+            pending = {submit(full_fit, grid[i], start_params(i), {}): (i, 0) for i in range(nsys)}
+            finished = [{} for _ in range(nsys)]   # solutions of the starts of every model that are not taken yet
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future not in pending:
+                        continue   # a start of a model that was confirmed by another one of this batch
+                    i, k = pending.pop(future)
+                    finished[i][k] = future.result()
+                    if k == 0:
+                        # The jittered starts go around the best fit of the first one
+                        runs[i].append(finished[i].pop(0))
+                        for j in range(1, num_starts):
+                            pending[submit(jittered_fit, grid[i], runs[i][0]['x'], jitter_kwargs(i, j))] = (i, j)
+                    while len(runs[i]) in finished[i] and not confirmed(i):
+                        runs[i].append(finished[i].pop(len(runs[i])))
+                    if confirmed(i):
+                        # Starts that are already running finish, but are not taken
+                        for other in [other for other, (row, _) in pending.items() if row == i]:
+                            other.cancel()
+                            pending.pop(other)
+
+    solutions = []
+    stats = {'fitted': np.zeros(nsys, dtype=int), 'cancelled': np.zeros(nsys, dtype=int),
+             'best': np.zeros(nsys, dtype=int), 'improvement': np.zeros(nsys)}
+    for i in range(nsys):
+        fval = np.array([solution['fval'] if solution['success'] else np.inf for solution in runs[i]])
+        best = int(np.argmin(fval)) if np.any(np.isfinite(fval)) else 0
+        njev = [solution.get('njev') for solution in runs[i]]
+        solutions.append(dict(runs[i][best], nfev=sum(solution['nfev'] for solution in runs[i]),
+                              njev=None if None in njev else sum(njev)))
+        stats['fitted'][i] = len(runs[i])
+        stats['cancelled'][i] = num_starts - len(runs[i])
+        stats['best'][i] = best
+        stats['improvement'][i] = runs[i][0]['fval'] - runs[i][best]['fval']
+    return solutions, stats
+
+
+def total_marg(exoplanet, x, y, err, sh, wavelength, ld_model, grating, grid_selection, output_dir, run_name, plotting=True, report=True,
+               workers=None, executor=None):
     """
     Produce marginalised transit parameters from HST lightcurves over a specified wavelength range.
 
     MAJOR PROGRAMS INCLUDED IN THIS ROUTINE:
     - LIMB-DARKENING (from limb_darkening.py)
         This requires the instrument mode sensitivity file (e.g., G141.WFC3.sensitivity.sav), template.sav, kuruczlist.sav, and the kurucz folder with all models, as well as the 3D models in the folder 3DGrid.
-    - MANDEL & AGOL (2002) transit model (occultnl.py)
+    - MANDEL & AGOL (2002) transit model (occultnl in margmodule.py, or the analytic engine in mandel_agol.py)
     - GRID OF SYSTEMATIC MODELS for WFC3 to test against the data (marg.wfc3_systematic_model_grid_selection() )
 
     :param exoplanet: string, exoplanet name to be worked on, as defined in CONFIG_INI.get('setup', 'data_set')
@@ -58,6 +775,10 @@ def total_marg(exoplanet, x, y, err, sh, wavelength, ld_model, grating, grid_sel
     :param run_name: arbitrary string of the individual run name, e.g. 'whitelight', or 'bin1', or '115-120micron'
     :param plotting: bool, default=True; whether or not interactive plots should be shown
     :param report: bool, default=True, whether or not to create a PDF report
+    :param workers: int, default=None; number of processes fitting the systematic models in parallel, 0 for one per
+                    CPU, read from the configfile if None. The results do not depend on it.
+    :param executor: string, default=None; 'process' or 'thread', whether the workers are processes or threads, read
+                     from the configfile if None
     :return:
     """
 
@@ -80,9 +801,6 @@ def total_marg(exoplanet, x, y, err, sh, wavelength, ld_model, grating, grid_sel
     except IOError:
         copy(os.path.join(config_parent, 'exoticism', 'config.ini'), outDir)
 
-    # READ THE CONSTANTS
-    HST_period = CONFIG_INI.getfloat('constants', 'HST_period') * u.d
-
     # We want to keep the raw data as is, so we generate helper arrays that will get changed from model to model
     img_date = x * u.d    # time array
     img_flux = y    # flux array
@@ -117,14 +835,30 @@ def total_marg(exoplanet, x, y, err, sh, wavelength, ld_model, grating, grid_sel
     #  SET UP THE ARRAYS
     # save arrays for the first step through to get the err inflation
     w_params = np.zeros((nsys, nparams))   # all parameters, but for all the systems in one single array
+    w_aic = np.zeros(nsys)                 # AIC of the first fit
+    sys_nfev = np.zeros((nsys, 2), dtype=int)   # model evaluations of the first and second fit
+    sys_njev = np.full((nsys, 2), np.nan)       # Jacobian evaluations, i.e. iterations, where the optimizer reports them
 
     # Parameters for smooth model
     resolution = CONFIG_INI.getfloat('smooth_model', 'resolution')
     half_range = CONFIG_INI.getfloat('smooth_model', 'half_range')
-
-    # Set up the Sherpa data model
-    # Instantiate a data object
-    tdata = Data1D('Data', x, y, staterror=err)
+    smooth_engine = CONFIG_INI.get('smooth_model', 'ld_engine')
+    profile_flux0 = CONFIG_INI.getboolean('setup', 'profile_flux0')
+    warm_start = CONFIG_INI.getboolean('setup', 'warm_start')
+    prune_weight = CONFIG_INI.getfloat('setup', 'prune_weight')
+    prune_delta_aic = CONFIG_INI.getfloat('setup', 'prune_delta_aic')
+    search = CONFIG_INI.get('setup', 'search')
+    approximate = CONFIG_INI.getboolean('setup', 'approximate')
+    first_fit_bin_size = CONFIG_INI.getint('setup', 'first_fit_bin_size')
+    reparameterise = CONFIG_INI.getboolean('setup', 'reparameterise')
+    num_starts = CONFIG_INI.getint('setup', 'multi_start')
+
+    # Set up the Sherpa data and transit model, the optimizer and the fit object. Every worker process that fits grid
+    # rows builds its own copy of these from the same arguments.
+    fitter_args = (x, y, err, sh, tzero, MsMpR, c1, c2, c3, c4, flux0, CONFIG_INI.get('setup', 'optimizer'),
+                   profile_flux0, reparameterise)
+    fitter = GridFitter(*fitter_args)
+    tdata, tmodel = fitter.tdata, fitter.tmodel
     print(tdata)
 
     # Plot the data with Sherpa
@@ -132,22 +866,56 @@ def total_marg(exoplanet, x, y, err, sh, wavelength, ld_model, grating, grid_sel
     # dplot.prepare(tdata)
     # dplot.plot()
 
-    # Set up the Sherpa transit model
-    tmodel = marg.Transit(tzero, MsMpR, c1, c2, c3, c4, flux0, name="TransitModel", sh=sh)
     print('Starting parameters for transit model:\n')
     print(tmodel)
 
-    # Set up statistics and optimizer
-    stat = Chi2()
-    opt = LevMar()
-    opt.config['epsfcn'] = np.finfo(float).eps
+    # Engine for the smooth model, which is only evaluated once per systematic model and can afford a tighter one
+    if smooth_engine:
+        smooth_kernel_kwargs = marg.ld_engine_kwargs(smooth_engine)
+    else:
+        smooth_engine, smooth_kernel_kwargs = tmodel.ld_engine, tmodel.kernel_kwargs
 
-    print('\nOptimizer used:')
-    print(opt)
+    # How the first round runs: the approximate mode replaces it, and several starts per model replace the search
+    if approximate:
+        first_round = 'approximate'
+    elif num_starts > 1:
+        first_round = 'multi_start'
+    else:
+        first_round = search
+
+    # The first fit only provides starting points, so it can run on the light curve binned within the HST orbits, as
+    # long as there are more bins than free parameters; the second fit then starts from its results. Pruning and the
+    # adaptive search bound the weights of the models in the marginalisation by their AIC, which has to be the one of
+    # the full light curve for that.
+    first_fitter_args, first_fitter = fitter_args, fitter
+    if first_fit_bin_size > 1 and first_round != 'approximate':
+        if prune_weight > 0 or prune_delta_aic > 0 or first_round == 'adaptive':
+            raise ValueError("first_fit_bin_size > 1 cannot be combined with pruning or search = adaptive, their "
+                             "weight bounds would refer to the AIC of the binned light curve.")
+        binned = marg.bin_light_curve(x, y, err, sh, marg.orbit_bins(x, first_fit_bin_size))
+        if binned[0].size > np.max(np.count_nonzero(grid == 0, axis=1)):
+            first_fitter_args = binned + fitter_args[4:]
+            first_fitter = GridFitter(*first_fitter_args)
+            print('The first fit runs on the light curve binned to {} points within the HST orbits, the second fit '
+                  'starts from its results.'.format(binned[0].size))
+        else:
+            print('Binned to {} points, the light curve is too short for the first fit, which runs on all data.'.format(
+                binned[0].size))
 
-    # Set up the fit object
-    tfit = Fit(tdata, tmodel, stat=stat, method=opt)  # Instantiate fit object
-    tfit.estmethod = Confidence()    # Set up error estimator we want. Need to define one even if we rely on the Hessian onyly.
+    print('\nOptimizer used:')
+    print(fitter.tfit.method)
+
+    # Number of processes fitting the rows of the grid
+    if workers is None:
+        workers = CONFIG_INI.getint('setup', 'workers')
+    if workers == 0:
+        workers = os.cpu_count()
+    if executor is None:
+        executor = CONFIG_INI.get('setup', 'executor')
+    if fitter.batched:
+        print('Fitting the grid of systematic models in lockstep in this process.')
+    else:
+        print('Fitting the grid of systematic models with {} {} worker(s).'.format(workers, executor))
 
     #################################
     #           FIRST FIT           #
@@ -161,10 +929,43 @@ def total_marg(exoplanet, x, y, err, sh, wavelength, ld_model, grating, grid_sel
         'the inherent scatter in the data for each model.')
 
     start_first_fit = time.time()
-    # Loop over all systems (= parameter combinations)
-    for i, system in enumerate(grid):
-
-        start_one_first_loop = time.time()
+    # Loop over all systems (= parameter combinations). With warm starts, every fit starts from the best fit of its
+    # closest nested parent, which differs by a systematic term that starts at zero; otherwise all fits start from the
+    # input parameters. The adaptive search only fits the models whose weight can still matter. The approximate mode
+    # linearises around the fit of the model with all systematic terms free instead, and both rounds take over these
+    # solutions. With several starts per model, every model is fitted from the input parameters and from starts
+    # jittered around that fit, and the best one is kept.
+    parents = None
+    solutions = None
+    sys_approximate = np.zeros(nsys, dtype=bool)
+    start_stats = {'fitted': np.ones(nsys, dtype=int), 'cancelled': np.zeros(nsys, dtype=int),
+                   'best': np.zeros(nsys, dtype=int), 'improvement': np.zeros(nsys)}
+    if first_round == 'approximate':
+        solutions, refitted = approximate_grid(grid, workers, fitter_args, fitter=fitter, executor=executor,
+                                               tolerance=CONFIG_INI.getfloat('setup', 'approx_tolerance'))
+        sys_approximate = ~refitted
+        first_fits = (first_fit(fitter, system, solution=solution) for system, solution in zip(grid, solutions))
+    elif first_round == 'multi_start':
+        multi_starts, start_stats = multi_start_grid(grid, workers, first_fitter_args, fitter=first_fitter,
+                                                     executor=executor, num_starts=num_starts,
+                                                     scale=CONFIG_INI.getfloat('setup', 'multi_start_scale'),
+                                                     tolerance=CONFIG_INI.getfloat('setup', 'multi_start_tolerance'),
+                                                     cancel=CONFIG_INI.getboolean('setup', 'multi_start_cancel'))
+        first_fits = (first_fit(first_fitter, system, solution=solution)
+                      for system, solution in zip(grid, multi_starts))
+    elif first_round == 'exhaustive':
+        parents = marg.nested_parents(grid) if warm_start else None
+        first_fits = map_grid(first_fit, grid, workers, first_fitter_args, fitter=first_fitter, executor=executor,
+                              parents=parents)
+    elif first_round == 'adaptive':
+        first_fits, unexplored = search_grid(grid, workers, first_fitter_args, fitter=first_fitter, executor=executor,
+                                             beam=CONFIG_INI.getint('setup', 'search_beam'),
+                                             tolerance=CONFIG_INI.getfloat('setup', 'search_tolerance'),
+                                             warm_start=warm_start)
+    else:
+        raise ValueError("search has to be 'exhaustive' or 'adaptive', not '{}'.".format(search))
+    first_nfev = 0
+    for i, (system, result) in enumerate(zip(grid, first_fits)):
 
         print('\n################################')
         print('SYSTEMATIC MODEL {} of {}'.format(i+1, nsys))
@@ -173,42 +974,61 @@ def total_marg(exoplanet, x, y, err, sh, wavelength, ld_model, grating, grid_sel
         print(system)
         print('  ')
 
-        # Set up systematics for current run
-        for k, select in enumerate(system):
-            if select == 0:
-                tmodel.pars[k].thaw()
-            elif select == 1:
-                tmodel.pars[k].freeze()
-
-        print('\nSTART 1st FIT')
-        tres = tfit.fit()  # do the fit
-        if not tres.succeeded:
-            print(tres.message)
+        if result is None:
+            print('Not fitted, the adaptive search ruled it out.')
+            w_params[i, :] = np.nan
+            w_aic[i] = np.inf
+            continue
+
+        if parents is not None and parents[i] >= 0:
+            print('Started from the best fit of systematic model {}.'.format(parents[i]+1))
+        if sys_approximate[i]:
+            print(result['message'])
+        if first_round == 'multi_start':
+            print('Best of {} starts ({} cancelled) is start {}, which lowered chi squared by {}.'.format(
+                start_stats['fitted'][i], start_stats['cancelled'][i], start_stats['best'][i] + 1,
+                start_stats['improvement'][i]))
+        if not result['succeeded']:
+            print(result['message'])
         print('\n1st ROUND OF SHERPA FIT IS DONE\n')
 
         # Save results of fit
-        w_params[i, :] = [par.val for par in tmodel.pars]
-
-        # Extract the error on rl from the Hessian
-        calc_errors = np.sqrt(tres.extra_output['covar'].diagonal())
-        rl_err = calc_errors[0]
+        w_params[i, :] = result['params']
+        w_aic[i] = result['AIC']
 
-        print('\nTRANSIT DEPTH rl in model {} of {} = {} +/- {}, centered at {}'.format(i+1, nsys, tmodel.rl.val, rl_err, tmodel.epoch.val))
+        print('\nTRANSIT DEPTH rl in model {} of {} = {} +/- {}, centered at {}'.format(i+1, nsys, result['params'][0], result['rl_err'], result['params'][2]))
 
         # We could extract info from the fit at this point, but since the "real" fit is actually happening in the
         # second round of fitting, there is no need for that.
 
-        # Reset the model parameters to the input parameters
-        # Note on resetting: https://sherpa.readthedocs.io/en/latest/models/index.html#resetting-parameter-values
-        tmodel.reset()
-
         # Show how long one iteration takes
-        end_one_first_loop = time.time()
-        one_loop = end_one_first_loop - start_one_first_loop
-        print('This 1st loop took {} sec = {} min'.format(one_loop, one_loop/60))
+        one_loop = result['time']
+        print('This 1st loop took {} sec = {} min and {} model evaluations'.format(one_loop, one_loop/60, result['nfev']))
+        first_nfev += result['nfev']
+        sys_nfev[i, 0] = result['nfev']
+        if result.get('njev') is not None:
+            print('It took {} iterations.'.format(result['njev']))
+            sys_njev[i, 0] = result['njev']
 
     end_first_fit = time.time()
-    print('First fit of all {} models took {} sec = {} min.'.format(nsys, end_first_fit-start_first_fit, (end_first_fit-start_first_fit)/60))
+    sys_unexplored = np.isinf(w_aic)
+    num_fitted = nsys - np.count_nonzero(sys_unexplored)
+    start_stats['fitted'][sys_unexplored | sys_approximate] = 0
+    print('First fit of {} of {} models took {} sec = {} min.'.format(num_fitted, nsys, end_first_fit-start_first_fit, (end_first_fit-start_first_fit)/60))
+    print('Model evaluations in the first fit: {}'.format(first_nfev))
+    if first_round == 'approximate':
+        print('{} models were linearised, {} fitted in full.'.format(np.count_nonzero(sys_approximate),
+                                                                    np.count_nonzero(~sys_approximate)))
+    elif first_round == 'multi_start':
+        print('{} starts were fitted and {} cancelled, the best start of {} models was not the first one.'.format(
+            np.sum(start_stats['fitted']), np.sum(start_stats['cancelled']), np.count_nonzero(start_stats['best'])))
+    elif first_round == 'adaptive':
+        print('The {} models the adaptive search did not fit have at most {:.3g} of the total weight.'.format(
+            nsys - num_fitted, unexplored))
+
+    # Models whose weight is negligible after the first fit are not fit a second time and are left out of the
+    # marginalisation like models with a poor AIC, and so are the models the adaptive search did not fit
+    sys_pruned = marg.prune_models(w_aic, prune_weight, prune_delta_aic) | sys_unexplored
 
     ################################
     #          SECOND FIT          #
@@ -217,6 +1037,9 @@ def total_marg(exoplanet, x, y, err, sh, wavelength, ld_model, grating, grid_sel
     print('..........................................')
     print('\n 2ND FIT \n')
     print('Each systematic model will now be re-fit with the previously determined parameters serving as the new starting points.')
+    if np.any(sys_pruned):
+        print('{} models are pruned and skipped, these model numbers are:\n{}'.format(np.count_nonzero(sys_pruned),
+                                                                                   np.flatnonzero(sys_pruned)))
 
     # Initializing arrays for each systematic model, which we will save once we got through all systems with two fits.
     sys_stats = np.zeros((nsys, 8))                 # stats
@@ -238,112 +1061,59 @@ def total_marg(exoplanet, x, y, err, sh, wavelength, ld_model, grating, grid_sel
 
     sys_evidenceAIC = np.zeros(nsys)                # evidence AIC
     sys_evidenceBIC = np.zeros(nsys)                # evidence BIC
+    sys_ld_error = np.full(nsys, np.nan)            # largest error estimate of the quadrature engine
+
+    # Pruned models only keep the input data and their parameters from the first fit, everything else is NaN
+    for i in np.flatnonzero(sys_pruned):
+        for array in [sys_stats, sys_phase, sys_flux, sys_flux_err, sys_residuals, sys_systematic_model, sys_model,
+                      sys_model_phase, sys_params_err]:
+            array[i] = np.nan
+        sys_date[i, :] = img_date
+        sys_rawflux[i, :] = img_flux
+        sys_rawflux_err[i, :] = err
+        sys_params[i, :] = w_params[i]
+        sys_evidenceAIC[i] = sys_evidenceBIC[i] = np.nan
 
     start_second_fit = time.time()
-    for i, system in enumerate(grid):
+    # With warm starts or a binned first fit, every fit starts from its own result of the first fit
+    fitted = np.flatnonzero(~sys_pruned)
+    second_kwargs = {'grid_selection': grid_selection, 'resolution': resolution, 'half_range': half_range,
+                     'smooth_engine': smooth_engine, 'smooth_kernel_kwargs': smooth_kernel_kwargs}
+    if solutions is not None:
+        # Nothing is fitted again, the model evaluations were counted in the first round
+        second_fits = (second_fit(fitter, grid[i], None, solution=dict(solutions[i], nfev=0), **second_kwargs)
+                       for i in fitted)
+    else:
+        second_fits = map_grid(second_fit, grid[fitted], workers, fitter_args, fitter=fitter, executor=executor,
+                               starts=w_params[fitted] if warm_start or first_fitter is not fitter else None,
+                               **second_kwargs)
+    second_nfev = 0
+    for i, result in zip(fitted, second_fits):
+        system = grid[i]
         print('\n################################')
         print('SYSTEMATIC MODEL {} of {}'.format(i+1, nsys))
         print(system)
         print('  ')
 
-        # The errors at this point got rescaled to unity chi squared in the previous fit and were not reset
-        # by model.reset()
+        if not result['succeeded']:
+            print(result['message'])
+        print('2nd ROUND OF SHERPA FIT IS DONE in {} model evaluations\n'.format(result['nfev']))
+        second_nfev += result['nfev']
+        sys_nfev[i, 1] = result['nfev']
+        if result.get('njev') is not None:
+            print('It took {} iterations.\n'.format(result['njev']))
+            sys_njev[i, 1] = result['njev']
 
-        # Set up systematics for current run
-        for k, select in enumerate(system):
-            if select == 0:
-                tmodel.pars[k].thaw()
-            elif select == 1:
-                tmodel.pars[k].freeze()
-
-        print('\nSTART 2nd FIT\n')
-        tres = tfit.fit()  # do the fit
-        if not tres.succeeded:
-            print(tres.message)
-        print('2nd ROUND OF SHERPA FIT IS DONE\n')
-
-        print('Extracting errors...')
-
-        # Getting errors directly from the covariance matrix in the fit, rl is always thawed.
-        calc_errors = np.sqrt(tres.extra_output['covar'].diagonal())
-        rl_err = calc_errors[0]
-
-        # These are the only errors we might need, depending on "grid_selection"
-        epoch_err = None
-        incl_err = None
-        msmpr_err = None
-        ecc_err = None
-
-        # Read errors from Hessian depending on which parameters actually got fit
-        if grid_selection == 'fix_time':
-            pass
-        elif grid_selection == 'fit_time':
-            epoch_err = calc_errors[2]
-        elif grid_selection == 'fit_inclin':
-            incl_err = calc_errors[2]
-        elif grid_selection == 'fit_msmpr':
-            msmpr_err = calc_errors[2]
-        elif grid_selection == 'fit_ecc':
-            ecc_err = calc_errors[2]
-        elif grid_selection == 'fit_all':
-            epoch_err = calc_errors[2]
-            incl_err = calc_errors[3]
-            msmpr_err = calc_errors[4]
-
-        print('\nTRANSIT DEPTH rl in model {} of {} = {} +/- {}, centered at {}'.format(i+1, nsys, tmodel.rl.val, rl_err, tmodel.epoch.val))
-
-        # Count free parameters by figuring out how many zeros we have in the current systematics
-        nfree = np.count_nonzero(system == 0)
-
-        # From the fit define the DOF, BIC, AIC & CHI
-        CHI = tres.statval  # chi squared of resulting fit
-        BIC = CHI + nfree * np.log(len(img_date))
-        AIC = CHI + nfree
-        DOF = tres.dof
-
-        # EVIDENCE BASED on the AIC and BIC
-        Npoint = len(img_date)
-        sigma_points = np.median(tdata.staterror)
-
-        evidence_BIC = - Npoint * np.log(sigma_points) - 0.5 * Npoint * np.log(2 * np.pi) - 0.5 * BIC
-        evidence_AIC = - Npoint * np.log(sigma_points) - 0.5 * Npoint * np.log(2 * np.pi) - 0.5 * AIC
-
-        # OUTPUTS
-        # Re-Calculate each of the arrays dependent on the output parameters for the epoch
-        phase = marg.phase_calc(img_date, tmodel.epoch.val*u.d, tmodel.period.val*u.d)
-        HSTphase = marg.phase_calc(img_date, tmodel.tzero.val*u.d, HST_period)
-
-        # ...........................................
-        # TRANSIT MODEL fit to the data           # Issue #36
-        # Calculate the impact parameter based on the eccentricity function - b0 in stellar radii
-        b0 = marg.impact_param((tmodel.period.val*u.d).to(u.s), tmodel.msmpr.val, phase, tmodel.inclin.val*u.rad)   # recalculated impact parameter after fit
-        mulimb01, _mulimbf1 = marg.occultnl(tmodel.rl.val, tmodel.c1.val, tmodel.c2.val, tmodel.c3.val, tmodel.c4.val, b0)  # recalculated model at data resolution
-
-        # ...........................................
-        # SMOOTH TRANSIT MODEL across all phase    # Issue #35
-        # Calculate the impact parameter based on the eccentricity function - b0 in stellar radii
-        x_smooth = np.arange(-half_range, half_range, resolution)   # this is the x-array for the smooth model
-        b0_smooth = marg.impact_param((tmodel.period.val*u.d).to(u.s), tmodel.msmpr.val, x_smooth, tmodel.inclin.val*u.rad)
-        mulimb0_smooth, _mulimbf2 = marg.occultnl(tmodel.rl.val, tmodel.c1.val, tmodel.c2.val, tmodel.c3.val, tmodel.c4.val, b0_smooth)   # recalculated model at smooth resolution
-        # ..... smooth model end .....
-
-        systematic_model = marg.sys_model(phase, HSTphase, sh, tmodel.m_fac.val, tmodel.hstp1.val, tmodel.hstp2.val,
-                                          tmodel.hstp3.val, tmodel.hstp4.val, tmodel.xshift1.val, tmodel.xshift2.val,
-                                          tmodel.xshift3.val, tmodel.xshift4.val)
-
-        fit_model = mulimb01 * tmodel.flux0.val * systematic_model     #  Issue #36
-        residuals = (img_flux - fit_model) / tmodel.flux0.val
-        resid_scatter = np.std(residuals)
-        fit_data = img_flux / (tmodel.flux0.val * systematic_model)   # this is the data after taking the fitted systematics out
-
-        white_noise, red_noise, beta = marg.noise_calculator(residuals)
+        print('\nTRANSIT DEPTH rl in model {} of {} = {} +/- {}, centered at {}'.format(i+1, nsys, result['params'][0], result['params_err'][0], result['params'][2]))
+        if np.isfinite(result['ld_error']):
+            print('Largest error estimate of the quadrature engine: {}'.format(result['ld_error']))
 
         if plotting:
             plt.figure(1, figsize=(14, 6))
             plt.clf()
-            plt.scatter(phase, img_flux, s=7, label='Data')
-            plt.plot(x_smooth, mulimb0_smooth, c='#ff7f0e', lw=2, label='Smooth model')
-            plt.errorbar(phase, fit_data, yerr=tdata.staterror, fmt='m.', markersize=7, label='Fit')
+            plt.scatter(result['phase'], img_flux, s=7, label='Data')
+            plt.plot(result['x_smooth'], result['smooth_model'], c='#ff7f0e', lw=2, label='Smooth model')
+            plt.errorbar(result['phase'], result['fit_data'], yerr=result['staterror'], fmt='m.', markersize=7, label='Fit')
             plt.xlim(-0.03, 0.03)
             plt.title('Model ' + str(i+1) + '/' + str(nsys), size=20)
             plt.xlabel('Planet Phase', size=15)
@@ -355,43 +1125,35 @@ def total_marg(exoplanet, x, y, err, sh, wavelength, ld_model, grating, grid_sel
 
         # .............................
         # Fill info into arrays to save to file once we iterated through all systems with both fits.
-        sys_stats[i, :] = [AIC, BIC, DOF, CHI, resid_scatter, white_noise, red_noise, beta]   # stats  - just saving
+        sys_stats[i, :] = result['stats']                       # stats  - just saving
 
         sys_date[i, :] = img_date                               # input time data (x = date)  - reused but not really
-        sys_phase[i, :] = phase                                 # phase  - used for plotting
+        sys_phase[i, :] = result['phase']                       # phase  - used for plotting
         sys_rawflux[i, :] = img_flux                            # raw lightcurve flux  - just saving
         sys_rawflux_err[i, :] = err                             # raw flux error  - just saving
-        sys_flux[i, :] = fit_data                               # corrected lightcurve flux
-        sys_flux_err[i, :] = tdata.staterror                    # corrected flux error  - used for plotting
-        sys_residuals[i, :] = residuals                         # residuals   - REUSED! also for plotting
-        sys_systematic_model[i, :] = systematic_model           # systematic model  - just saving
-
-        sys_model[i, :] = mulimb0_smooth                              # smooth model  - used for plotting
-        sys_model_phase[i, :] = x_smooth                              # smooth phase  - used for plotting
-
-        sys_params[i, :] = [par.val for par in tmodel.pars]     # parameters  - REUSED!
-        # We only really need the errors on rl, epoch, inclination, MsMpR and ecc, so I only save those. The rest
-        # of the errors in this array will be zero (and hence false, but we don't need them).
-        sys_params_err[i, 0] = rl_err
-        if not tmodel.epoch.frozen:
-            sys_params_err[i, 2] = epoch_err
-        if not tmodel.inclin.frozen:
-            sys_params_err[i, 3] = incl_err
-        if not tmodel.msmpr.frozen:
-            sys_params_err[i, 4] = msmpr_err
-        if not tmodel.ecc.frozen:
-            sys_params_err[i, 5] = ecc_err
-
-        sys_evidenceAIC[i] = evidence_AIC                       # evidence AIC  - REUSED!
-        sys_evidenceBIC[i] = evidence_BIC                       # evidence BIC  - REUSED!
-
-        # Reset the model parameters to the input parameters
-        # Note on resetting: https://sherpa.readthedocs.io/en/latest/models/index.html#resetting-parameter-values
-        tmodel.reset()
+        sys_flux[i, :] = result['fit_data']                     # corrected lightcurve flux
+        sys_flux_err[i, :] = result['staterror']                # corrected flux error  - used for plotting
+        sys_residuals[i, :] = result['residuals']               # residuals   - REUSED! also for plotting
+        sys_systematic_model[i, :] = result['systematic_model']  # systematic model  - just saving
+
+        sys_model[i, :] = result['smooth_model']                # smooth model  - used for plotting
+        sys_model_phase[i, :] = result['x_smooth']              # smooth phase  - used for plotting
+
+        sys_params[i, :] = result['params']                     # parameters  - REUSED!
+        sys_params_err[i, :] = result['params_err']             # errors on rl, epoch, inclin, msmpr and ecc
+
+        sys_evidenceAIC[i] = result['evidence_AIC']             # evidence AIC  - REUSED!
+        sys_evidenceBIC[i] = result['evidence_BIC']             # evidence BIC  - REUSED!
+        sys_ld_error[i] = result['ld_error']                    # error estimate of the quadrature engine
+
+    # The marginalisation below reads off the free parameters from the model, which the worker processes did not touch
+    fitter.set_system(grid[fitted[-1]])
 
     end_second_fit = time.time()
-    print('Second fit of all {} models took {} sec = {} min.'.format(nsys, end_second_fit - start_second_fit,
-                                                                     (end_second_fit - start_second_fit) / 60))
+    print('Second fit of {} of {} models took {} sec = {} min.'.format(len(fitted), nsys,
+                                                                       end_second_fit - start_second_fit,
+                                                                       (end_second_fit - start_second_fit) / 60))
+    print('Model evaluations in the second fit: {}'.format(second_nfev))
 
     # Save to file
     # For details on how to deal with this kind of file, see the notebook "NumpyData.ipynb"
@@ -399,7 +1161,12 @@ def total_marg(exoplanet, x, y, err, sh, wavelength, ld_model, grating, grid_sel
              sys_rawflux=sys_rawflux, sys_rawflux_err=sys_rawflux_err, sys_flux=sys_flux, sys_flux_err=sys_flux_err,
              sys_residuals=sys_residuals, sys_model=sys_model, sys_model_phase=sys_model_phase,
              sys_systematic_model=sys_systematic_model, sys_params=sys_params, sys_params_err=sys_params_err,
-             sys_evidenceAIC=sys_evidenceAIC, sys_evidenceBIC=sys_evidenceBIC, wavelength=wavelength)
+             sys_evidenceAIC=sys_evidenceAIC, sys_evidenceBIC=sys_evidenceBIC, sys_pruned=sys_pruned,
+             sys_unexplored=sys_unexplored, sys_approximate=sys_approximate, sys_nfev=sys_nfev, sys_njev=sys_njev,
+             sys_ld_error=sys_ld_error,
+             sys_starts_fitted=start_stats['fitted'], sys_starts_cancelled=start_stats['cancelled'],
+             sys_starts_best=start_stats['best'], sys_starts_improvement=start_stats['improvement'],
+             wavelength=wavelength)
 
 
     #####################################
@@ -428,6 +1195,15 @@ def total_marg(exoplanet, x, y, err, sh, wavelength, ld_model, grating, grid_sel
                                                                                                          ind_rejected))
     else:
         print('All models have positive AIC.')
+
+    # Pruned models are masked just like the ones with a poor AIC
+    num_pruned = np.count_nonzero(sys_pruned)
+    ind_pruned = np.where(sys_pruned)
+    if num_pruned:
+        sys_evidenceAIC_masked[sys_pruned] = np.ma.masked
+        print('{} models were pruned after the first fit, these model numbers are:\n{}'.format(num_pruned, ind_pruned))
+    if num_fitted < nsys:
+        print('{} of {} models were fitted by the adaptive search.'.format(num_fitted, nsys))
     print('{} valid models at positions =\n{}'.format(np.ma.count(sys_evidenceAIC_masked),
                                                       np.where(sys_evidenceAIC_masked.mask == False)))
     print('Valid model AIC values = {}'.format(sys_evidenceAIC_masked))
@@ -494,11 +1270,12 @@ def total_marg(exoplanet, x, y, err, sh, wavelength, ld_model, grating, grid_sel
     best_sys_sdnr = np.nanargmin(masked_rl_sdnr)   # argument of minimum, ignoring possible NaNs
     print('SDNR best without the evidence (weights) = {} for model {}'.format(np.nanmin(masked_rl_sdnr), best_sys_sdnr))
 
-    #  Plotting parameters
-    xlim_min = np.min(sys_phase[0,:]) - 0.005
-    xlim_max = np.max(sys_phase[0,:]) + 0.005
-    ylim_min = np.min(sys_flux[0,:]) - 0.001
-    ylim_max = np.max(sys_flux[0,:]) + 0.001
+    #  Plotting parameters, from the first model that was fit twice
+    first_sys = fitted[0]
+    xlim_min = np.min(sys_phase[first_sys,:]) - 0.005
+    xlim_max = np.max(sys_phase[first_sys,:]) + 0.005
+    ylim_min = np.min(sys_flux[first_sys,:]) - 0.001
+    ylim_max = np.max(sys_flux[first_sys,:]) + 0.001
     legend_font = 8
     ax_label_font = 10
     tick_label_font = 8
@@ -550,7 +1327,7 @@ def total_marg(exoplanet, x, y, err, sh, wavelength, ld_model, grating, grid_sel
     plt.suptitle('First vs. best model', fontsize=12)
 
     plt.subplot(3, 1, 1)
-    plt.scatter(sys_phase[0,:], sys_flux[0,:], s=markers, label='Raw lightcurve')
+    plt.scatter(sys_phase[first_sys,:], sys_flux[first_sys,:], s=markers, label='Raw lightcurve')
     plt.xlim(xlim_min, xlim_max)
     plt.ylim(ylim_min, ylim_max)
     plt.ylabel('Norm. flux', size=ax_label_font)
@@ -649,7 +1426,7 @@ def total_marg(exoplanet, x, y, err, sh, wavelength, ld_model, grating, grid_sel
              marg_inclin_rad=marg_inclin_rad, marg_inclin_rad_err=marg_inclin_rad_err, marg_inclin_deg=marg_inclin_deg,
              marg_inclin_deg_err=marg_inclin_deg_err, marg_msmpr=marg_msmpr, marg_msmpr_err=marg_msmpr_err,
              marg_aors=marg_aors, marg_aors_err=marg_aors_err, rl_sdnr=rl_sdnr, mask=sys_evidenceAIC_masked.mask, wave_mid=wave_mid, wave_half_width=wave_half_width, ind_rejected=ind_rejected,
-             allow_pickle=True)
+             num_fitted=num_fitted, allow_pickle=True)
 
     ### Save as PDF report
     if report:
@@ -693,6 +1470,10 @@ def total_marg(exoplanet, x, y, err, sh, wavelength, ld_model, grating, grid_sel
                          'beta': sys_stats[best_sys_weight, 7],
                          'num_rejected': num_rejected,
                          'indices_rejected': ind_rejected,
+                         'num_pruned': num_pruned,
+                         'indices_pruned': ind_pruned,
+                         'num_fitted': num_fitted,
+                         'num_models': nsys,
                          'rl_marg': marg_rl,
                          'rl_marg_err': marg_rl_err,
                          'epoch_marg': marg_epoch,
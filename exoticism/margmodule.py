@@ -7,13 +7,19 @@ from os import listdir
 from os.path import join, isdir, dirname, basename
 import time
 import datetime
+import functools
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from astropy.constants import G
 import astropy.units as u
+from scipy import sparse
 
 from sherpa.models import model
 
+from exoticism import jit_kernels
 from exoticism.config import CONFIG_INI
+from exoticism.mandel_agol import occultnl_analytic, occultnl_quadrature
+from exoticism.transit_table import get_transit_table
 
 # Read planet parameters from configfile
 exoplanet = CONFIG_INI.get('setup', 'data_set')
@@ -24,11 +30,20 @@ ECC = CONFIG_INI.getfloat(exoplanet, 'ecc')
 OMEGA = CONFIG_INI.getfloat(exoplanet, 'omega')
 PERIOD = CONFIG_INI.getfloat(exoplanet, 'Per')
 
+# Constants of the unit-free code path
+G_SI = G.to_value(u.m ** 3 / (u.kg * u.s ** 2))
+DAY_IN_SECONDS = (1 * u.d).to_value(u.s)
 
-def _transit_model(pars, x, sh, x_in_phase=False):
+
+def _transit_model(pars, x, sh, x_in_phase=False, ld_engine='occultnl', exposure_time=0., supersample=1,
+                   window=None, use_numba=False, **kernel_kwargs):
     """
     Transit model by Mandel & Agol (2002). If x_in_phase=True, the data input is already in units of phase as opposed to
-    MJD or other.
+    MJD or other. ld_engine selects how the limb-darkened transit is computed (see limb_darkened_transit()), additional
+    keyword arguments are passed on to that engine. If supersample > 1, the transit is integrated over exposures of
+    length exposure_time (in days), see transit_light_curve(). If a TransitWindow is passed as window, only the points
+    in transit are passed on to the limb darkening engine. With use_numba=True, the Numba-compiled kernels of
+    jit_kernels.py are used.
     --------
     Params:
     rl: transit depth in Rp/R_star, unitless
@@ -50,60 +65,308 @@ def _transit_model(pars, x, sh, x_in_phase=False):
     sh: array, input shifts
     """
 
-    HSTper = CONFIG_INI.getfloat('constants', 'HST_period') * u.d
+    # Resolve units and constants, then evaluate on plain float arrays
+    hst_period = CONFIG_INI.getfloat('constants', 'HST_period')
+    if isinstance(x, u.Quantity):
+        x = x.to_value(u.d)
+
+    return _transit_model_values(pars, np.asarray(x, dtype=float), sh, hst_period, x_in_phase=x_in_phase,
+                                 ld_engine=ld_engine, exposure_time=exposure_time, supersample=supersample,
+                                 window=window, use_numba=use_numba, **kernel_kwargs)
+
+
+def _transit_model_values(pars, x, sh, hst_period, x_in_phase=False, ld_engine='occultnl', exposure_time=0.,
+                          supersample=1, window=None, hst_basis=None, shift_basis=None, use_numba=False,
+                          **kernel_kwargs):
+    """
+    Unit-free evaluation of _transit_model(), on plain float arrays in fixed units. Transit resolves all units and
+    constants once when it is constructed and calls this directly, so a fit does not pay for astropy on every
+    evaluation.
+    :param pars: list of the parameters of _transit_model(), epoch, period and tzero in days, inclin in radians
+    :param x: array, input time grid in days (MJD), or phase if x_in_phase=True
+    :param sh: array, input shifts
+    :param hst_period: float, HST orbital period in days
+    :param hst_basis: array, optional precomputed polynomial basis of the HST phase, see polynomial_basis()
+    :param shift_basis: array, optional precomputed polynomial basis of sh, see polynomial_basis()
+    The other parameters are the same as for _transit_model().
+    :return: model: array
+    """
 
     # Define each of the parameters that are read into the fitting routine
     (rl, flux0, epoch, inclin, MsMpR, ecc, omega, period, tzero, c1, c2, c3, c4,
      m_fac, hstp1, hstp2, hstp3, hstp4, xshift1, xshift2, xshift3, xshift4) = pars
 
-    # Attaching some units
-    x *= u.d
-    epoch *= u.d
-    inclin *= u.rad
-    period *= u.d
-    tzero *= u.d
-
     # If sh is None, we will just pass an array of zeros (meaning no shift on the data) so that the consecutive code
     # goes through all right. This will guarantee that we can also evaluate the model on a smooth grid, as the sh array
     # containing all zeros created here will always have the same length as x.
+    no_shifts = sh is None
     if sh is None:
         temp = x.shape[0]
         sh = np.zeros(temp)
+    _check_shifts(x, sh)
+
+    if not x_in_phase:
+        phase = _phase_values(x, epoch, period, use_numba)  # Period in days here
+    else:
+        phase = x
+
+    # The polynomial bases of the systematic model only depend on tzero and sh, which are frozen during a fit
+    if hst_basis is None:
+        hst_basis = polynomial_basis(x if x_in_phase else _phase_values(x, tzero, hst_period, use_numba))
+    if shift_basis is None and not no_shifts:
+        shift_basis = polynomial_basis(sh)
+
+    # Limb-darkened transit as a function of the planetary phase across the star.
+    # The main result we need is the rl - radius ratio, the c1-c4 are the non-linear limb-darkening parameters
+    b0 = _impact_parameters(phase, period, MsMpR, inclin, exposure_time=exposure_time, supersample=supersample,
+                            use_numba=use_numba)
+    in_transit = None
+    if window is not None:
+        margin = 0.5 * exposure_time / period if supersample > 1 else 0.
+        in_transit = window.indices(phase, rl, period, MsMpR, inclin, margin=margin)
+    mulimb0 = _transit_from_impact(rl, c1, c2, c3, c4, b0, ld_engine=ld_engine, exposure_time=exposure_time,
+                                   supersample=supersample, in_transit=in_transit, use_numba=use_numba,
+                                   **kernel_kwargs)
+    systematic_model = sys_model_basis(phase, hst_basis, shift_basis, m_fac, (hstp1, hstp2, hstp3, hstp4),
+                                       (xshift1, xshift2, xshift3, xshift4))
+
+    # model fit to data = transit model * baseline flux (flux0) * systematic model
+    model = mulimb0 * flux0 * systematic_model
+
+    return model
 
+
+def _check_shifts(x, sh):
+    """
+    Check that the shifts sh belong to the time grid x.
+    :param x: array, input time grid
+    :param sh: array, input shifts
+    """
     # Including a grid of shifts for the data, sh, only makes sense on actual data, but not on an interpolated grid
     # of x-values. The code will catch this by comparing the array size of the x data with the array size of the sh data.
     # If the x array is longer than sh, you are likely using an sh array for data with an interpolated x array, which
     # will not work, so we will stop you here. If x is shorter than sh, then something else is wrong.
     # If you want to evaluate this transit model, that also includes a systematic model, on such a smooth
     # x-value array, you need to set sh=None.
-    elif x.shape[0] > sh.shape[0]:
+    if x.shape[0] > sh.shape[0]:
         raise ValueError('Your x array is longer than your sh array: You are likely trying to calculate a smooth model'
                          'while also passing an a grid of shifts - this is not possible. Please set sh=None if you'
                          'want to calculate a smooth model. Alternatively, you might simply be passing in wrong data.')
     elif x.shape[0] < sh.shape[0]:
         raise ValueError('Your sh array is longer than you x array - please make sure those have the same length.')
 
-    if not x_in_phase:
-        phase = phase_calc(x, epoch, period)  # Period in days here
-        HSTphase = phase_calc(x, tzero, HSTper)
-    else:
-        phase = x.value
-        HSTphase = x.value
+
+def transit_light_curve(rl, c1, c2, c3, c4, phase, period, msmpr, inclin, ld_engine='occultnl', exposure_time=0.,
+                        supersample=1, use_numba=False, **kernel_kwargs):
+    """
+    Limb-darkened transit light curve at the given planetary phases, optionally integrated over the exposures.
+
+    For supersample > 1, every exposure is split into that many sub-exposures of equal length. The impact parameters of
+    all sub-exposures are computed as one array and go through the limb darkening engine in a single call, and the
+    result is binned back to the exposures with a precomputed sparse reduction matrix, so the Python overhead does not
+    grow with the supersampling factor.
+    :param rl: float, transit depth (Rp/R*)
+    :param c1: float, limb darkening parameter 1
+    :param c2: float, limb darkening parameter 2
+    :param c3: float, limb darkening parameter 3
+    :param c4: float, limb darkening parameter 4
+    :param phase: array, planetary phase of the exposure mid-times
+    :param period: astropy Quantity or float in days, period of the planet
+    :param msmpr: float, MsMpR
+    :param inclin: astropy Quantity or float in radians, inclination
+    :param ld_engine: string, default='occultnl'; see limb_darkened_transit()
+    :param exposure_time: float, default=0; exposure time in days
+    :param supersample: int, default=1; number of sub-exposures per exposure, 1 means no supersampling
+    :param use_numba: bool, default=False; whether the Numba-compiled kernels are used, see jit_kernels.py
+    :param kernel_kwargs: passed on to limb_darkened_transit()
+    :return: mulimb0: array, limb-darkened transit model
+    """
+    if isinstance(period, u.Quantity):
+        period = period.to_value(u.d)
+    if isinstance(inclin, u.Quantity):
+        inclin = inclin.to_value(u.rad)
+    if isinstance(phase, u.Quantity):
+        phase = phase.to_value(u.dimensionless_unscaled)
+
+    return _transit_light_curve_values(rl, c1, c2, c3, c4, np.asarray(phase, dtype=float), period, msmpr, inclin,
+                                       ld_engine=ld_engine, exposure_time=exposure_time, supersample=supersample,
+                                       use_numba=use_numba, **kernel_kwargs)
+
+
+def _transit_light_curve_values(rl, c1, c2, c3, c4, phase, period, msmpr, inclin, ld_engine='occultnl',
+                                exposure_time=0., supersample=1, use_numba=False, **kernel_kwargs):
+    """
+    Unit-free transit_light_curve(), period in days and inclin in radians.
+    """
+    b0 = _impact_parameters(phase, period, msmpr, inclin, exposure_time=exposure_time, supersample=supersample,
+                            use_numba=use_numba)
+    return _transit_from_impact(rl, c1, c2, c3, c4, b0, ld_engine=ld_engine, exposure_time=exposure_time,
+                                supersample=supersample, use_numba=use_numba, **kernel_kwargs)
+
+
+def _impact_parameters(phase, period, msmpr, inclin, exposure_time=0., supersample=1, use_numba=False):
+    """
+    Impact parameters of the exposures, or of all their sub-exposures if supersample > 1.
+    :param phase: array, planetary phase of the exposure mid-times
+    :param period: float, period in days
+    :param msmpr: float, MsMpR
+    :param inclin: float, inclination in radians
+    :param exposure_time: float, default=0; exposure time in days
+    :param supersample: int, default=1; number of sub-exposures per exposure
+    :param use_numba: bool, default=False; whether the Numba-compiled kernel is used
+    :return: b0: array of length len(phase) * supersample in stellar radii, the sub-exposures of an exposure are
+             consecutive
+    """
+    phase = _sub_exposure_phase(phase, period, exposure_time, supersample)
 
     # Calculate the impact parameter as a function of the planetary phase across the star.
-    b0 = impact_param(period.to(u.second), MsMpR, phase, inclin)  # period in sec here, incl in radians, b0 in stellar radii
+    return _impact_param_values(period * DAY_IN_SECONDS, msmpr, phase, inclin, use_numba)  # b0 in stellar radii
 
-    # Occultnl would be replaced with BATMAN if possible. The main result we need is the rl - radius ratio
-    # The c1-c4 are the non-linear limb-darkening parameters
-    # b0 is the impact parameter function and I am not sure how this is handled in BATMAN - need to look into this.
-    mulimb0, _mulimbf = occultnl(rl, c1, c2, c3, c4, b0)
-    systematic_model = sys_model(phase, HSTphase, sh, m_fac, hstp1, hstp2, hstp3, hstp4,
-                                 xshift1, xshift2, xshift3, xshift4)
 
-    # model fit to data = transit model * baseline flux (flux0) * systematic model
-    model = mulimb0 * flux0 * systematic_model
+def _sub_exposure_phase(phase, period, exposure_time=0., supersample=1):
+    """
+    Planetary phase of all sub-exposures, see _impact_parameters().
+    :return: phase: array of length len(phase) * supersample
+    """
+    if supersample > 1:
+        offsets, _reduction = _supersampling(np.size(phase), exposure_time, supersample)
+        phase = (phase[:, np.newaxis] + offsets / period).ravel()
+    return phase
 
-    return model
+
+def _impact_param_partials(period, msmpr, phase, inclin, b0):
+    """
+    Analytic derivatives of the impact parameter of impact_param().
+    :param period: float, period in seconds
+    :param msmpr: float, MsMpR
+    :param phase: array, phase
+    :param inclin: float, inclination in radians
+    :param b0: array, impact parameter at phase
+    :return: dict of arrays, derivatives of b0 with respect to phase, inclin and msmpr
+    """
+    scale = (G_SI * period * period / (4 * np.pi * np.pi)) ** (1 / 3.) * (msmpr ** (1 / 3.))
+    angle = 2 * np.pi * phase
+    norm = b0 / scale
+    # b0 is not differentiable where it vanishes (central transit), the derivatives are set to zero there
+    nonzero = norm > 0
+    dphase = np.zeros(np.shape(b0))
+    dinclin = np.zeros(np.shape(b0))
+    dphase[nonzero] = scale * np.pi * np.sin(2 * angle[nonzero]) * np.sin(inclin) ** 2 / norm[nonzero]
+    dinclin[nonzero] = -scale * np.cos(inclin) * np.sin(inclin) * np.cos(angle[nonzero]) ** 2 / norm[nonzero]
+
+    return {'phase': dphase, 'inclin': dinclin, 'msmpr': b0 / (3 * msmpr)}
+
+
+def _transit_from_impact(rl, c1, c2, c3, c4, b0, ld_engine='occultnl', exposure_time=0., supersample=1,
+                         in_transit=None, use_numba=False, **kernel_kwargs):
+    """
+    Limb-darkened transit of the exposures from the impact parameters of _impact_parameters(), averaged over the
+    sub-exposures if supersample > 1.
+    :param in_transit: array, optional indices of the exposures in transit, see TransitWindow; only these go through
+                       the limb darkening engine, all other exposures are 1
+    The other parameters are the same as for transit_light_curve().
+    :return: mulimb0: array, limb-darkened transit model
+    """
+    if in_transit is not None:
+        mulimb0 = np.ones(b0.size // supersample)
+        if in_transit.size > 0:
+            sub_exposures = (in_transit[:, np.newaxis] * supersample + np.arange(supersample)).ravel()
+            mulimb0[in_transit] = _transit_from_impact(rl, c1, c2, c3, c4, b0[sub_exposures], ld_engine=ld_engine,
+                                                       exposure_time=exposure_time, supersample=supersample,
+                                                       use_numba=use_numba, **kernel_kwargs)
+        return mulimb0
+
+    mulimb0, _mulimbf = limb_darkened_transit(rl, c1, c2, c3, c4, b0, ld_engine, use_numba=use_numba,
+                                              **kernel_kwargs)
+
+    if supersample > 1:
+        _offsets, reduction = _supersampling(b0.size // supersample, exposure_time, supersample)
+        mulimb0 = reduction @ mulimb0
+
+    return mulimb0
+
+
+@functools.lru_cache(maxsize=16)
+def _supersampling(npoints, exposure_time, supersample):
+    """
+    Sub-exposure time grid and reduction matrix of the supersampling, built once per data set.
+    :param npoints: int, number of exposures
+    :param exposure_time: float, exposure time in days
+    :param supersample: int, number of sub-exposures per exposure
+    :return: offsets: array, offsets of the sub-exposure mid-times from the exposure mid-time in days,
+             reduction: sparse matrix of shape (npoints, npoints * supersample) averaging the sub-exposures
+    """
+    offsets = exposure_time * ((np.arange(supersample) + 0.5) / supersample - 0.5)
+    reduction = sparse.kron(sparse.identity(npoints, format='csr'), np.full((1, supersample), 1. / supersample),
+                            format='csr')
+    return _read_only(offsets), reduction
+
+
+class TransitWindow(object):
+    """Index of the data points that are in transit.
+
+    The contact phases follow analytically from the geometry: the impact parameter of impact_param() only drops below
+    1 + rl within +-phi_contact around phase 0 and, as it repeats every half period (it does not distinguish in front of
+    or behind the star), around phase +-0.5. The phases of the data, folded onto half a period, are kept sorted, so the
+    points in transit are found by binary search. Both are only recomputed when their inputs change: the sort order
+    when the phases change (epoch or period during a fit), the contact phase when rl, inclin, msmpr or period change.
+    Each of them is replaced as one tuple together with its key, so threads sharing a window never see a key with the
+    values of another one."""
+
+    def __init__(self):
+        self._sorted = (None, None, None)   # key of the phases, sort order, sorted folded phases
+        self._contact = (None, None)        # key of the geometry, contact phase
+
+    def indices(self, phase, rl, period, msmpr, inclin, margin=0.):
+        """
+        Indices of the points in transit.
+        :param phase: array, planetary phase of the data points
+        :param rl: float, transit depth (Rp/R*)
+        :param period: float, period of the planet in days
+        :param msmpr: float, MsMpR
+        :param inclin: float, inclination in radians
+        :param margin: float, default=0; phase by which the transit window is widened on both sides, e.g. for exposures
+        :return: array, sorted indices of the points in transit
+        """
+        phase = np.asarray(phase, dtype=float)
+        phase_key = hash(phase.tobytes())
+        key, order, sorted_phase = self._sorted
+        if phase_key != key:
+            folded = phase - 0.5 * np.round(2 * phase)   # distance to the closest multiple of half a period
+            order = np.argsort(folded, kind='stable')
+            sorted_phase = folded[order]
+            self._sorted = (phase_key, order, sorted_phase)
+
+        contact_key = (float(rl), period * DAY_IN_SECONDS, float(msmpr), float(inclin))
+        key, contact = self._contact
+        if contact_key != key:
+            contact = contact_phase(*contact_key)
+            self._contact = (contact_key, contact)
+
+        half_width = contact + margin
+        start = np.searchsorted(sorted_phase, -half_width, side='left')
+        stop = np.searchsorted(sorted_phase, half_width, side='right')
+        return np.sort(order[start:stop])
+
+
+def contact_phase(rl, period, msmpr, inclin):
+    """
+    Phase of the first contact, the phase before and after mid-transit at which the impact parameter equals 1 + rl.
+    :param rl: float, transit depth (Rp/R*)
+    :param period: float, period in seconds
+    :param msmpr: float, MsMpR
+    :param inclin: float, inclination in radians
+    :return: float, contact phase in [0, 0.25]; 0 if there is no transit, 0.25 if the planet never leaves the disk
+    """
+    a_rs = (G_SI * period * period / (4 * np.pi * np.pi)) ** (1 / 3.) * (msmpr ** (1 / 3.))
+    # b0^2 = a_rs^2 (sin^2(2 pi phase) + cos^2(i) cos^2(2 pi phase)), solved for b0 = 1 + rl
+    sin2 = (((1 + rl) / a_rs) ** 2 - np.cos(inclin) ** 2) / np.sin(inclin) ** 2
+    if sin2 <= 0:
+        return 0.
+    if sin2 >= 1:
+        return 0.25
+    # Widened by a few units of rounding, so that no point with b0 < 1 + rl is missed
+    return np.arcsin(np.sqrt(sin2)) / (2 * np.pi) * (1 + 1e-9) + 1e-12
 
 
 class Transit(model.RegriddableModel1D):
@@ -119,9 +382,28 @@ class Transit(model.RegriddableModel1D):
            constant1 = (G*Per*Per/(4*!pi*!pi))^(1/3) -> MsMpR = (a_Rs/constant1)^3
     c1, c2, c3, c4: limb darkening parameters (quadratic)
     flux0: flux at tzero
-    sh: array, input shifts"""
-
-    def __init__(self, tzero, msmpr, c1, c2, c3, c4, flux0=1., x_in_phase=False, name='transit', sh=None):
+    sh: array, input shifts
+    ld_engine: string, 'occultnl' (numerical reference), 'analytic', 'table' or 'quadrature', which engine computes
+               the limb-darkened transit; read from configfile if None
+    batched: bool, whether occultnl evaluates all annuli of a refinement level at once; read from configfile if None
+    memory_budget: float, memory budget in MB of the batched occultnl computation; read from configfile if None
+    per_point: bool, whether occultnl tests convergence for every point separately; read from configfile if None
+    threads: int, number of threads evaluating chunks of the time series in the transit kernel; read from configfile
+             if None
+    exposure_time: float, exposure time in seconds the transit is integrated over; read from configfile if None
+    supersample: int, number of sub-exposures per exposure, 1 means no supersampling; read from configfile if None
+    transit_window: bool, whether only the points in transit are passed on to the limb darkening engine; read from
+                    configfile if None
+    use_numba: bool, whether the Numba-compiled kernels of jit_kernels.py are used if Numba is installed; read from
+               configfile if None
+
+    Evaluating the model is re-entrant: calc() and jacobian() work on the snapshot of parameter values they are
+    passed, never modify their inputs and replace cached components as a whole, so one Transit can be evaluated from
+    several threads. A fit changes the parameters of its model though, so concurrent fits need a Transit each."""
+
+    def __init__(self, tzero, msmpr, c1, c2, c3, c4, flux0=1., x_in_phase=False, name='transit', sh=None,
+                 ld_engine=None, batched=None, memory_budget=None, per_point=None, threads=None, exposure_time=None,
+                 supersample=None, transit_window=None, use_numba=None):
         self.rl = model.Parameter(name, 'rl', RL)
         self.flux0 = model.Parameter(name, 'flux0', flux0)
         self.epoch = model.Parameter(name, 'epoch', EPOCH, units='days [MJD]')
@@ -146,8 +428,45 @@ class Transit(model.RegriddableModel1D):
         self.xshift4 = model.Parameter(name, 'xshift4', 0)
 
         self.x_in_phase = x_in_phase
+        self.hst_period = CONFIG_INI.getfloat('constants', 'HST_period')   # days, resolved once for the whole fit
+        self._hst_basis = (None, None)   # key, basis
+        self.profile_data = None
         self.sh_array = sh   # This is not a model parameter but an extra input to the model, like x is
 
+        # Settings of the limb darkening kernel
+        if ld_engine is None:
+            ld_engine = CONFIG_INI.get('transit_model', 'ld_engine')
+        self.ld_engine = ld_engine
+        self.kernel_kwargs = ld_engine_kwargs(ld_engine)
+        if threads is not None:
+            self.kernel_kwargs['threads'] = threads
+
+        if ld_engine == 'occultnl':
+            for key, value in [('batched', batched), ('memory_budget', memory_budget), ('per_point', per_point)]:
+                if value is not None:
+                    self.kernel_kwargs[key] = value
+
+        # Numba-compiled kernels, only if Numba can be imported
+        if use_numba is None:
+            use_numba = CONFIG_INI.getboolean('transit_model', 'use_numba')
+        self.use_numba = use_numba and jit_kernels.NUMBA_AVAILABLE
+
+        # Integration of the transit over the exposures
+        if exposure_time is None:
+            exposure_time = CONFIG_INI.getfloat('transit_model', 'exposure_time')
+        if supersample is None:
+            supersample = CONFIG_INI.getint('transit_model', 'supersample')
+        if supersample < 1:
+            raise ValueError('supersample has to be a positive integer.')
+        self.supersample_kwargs = {'exposure_time': (exposure_time * u.s).to_value(u.d), 'supersample': supersample}
+
+        if transit_window is None:
+            transit_window = CONFIG_INI.getboolean('transit_model', 'transit_window')
+        self.window = TransitWindow() if transit_window else None
+
+        # Order of the analytic engine that differentiates the transit in jacobian()
+        self.jacobian_order = CONFIG_INI.getint('transit_model', 'analytic_order')
+
         model.RegriddableModel1D.__init__(self, name,
                                           (self.rl, self.flux0, self.epoch,
                                            self.inclin, self.msmpr, self.ecc,
@@ -157,12 +476,543 @@ class Transit(model.RegriddableModel1D):
                                            self.hstp3, self.hstp4, self.xshift1,
                                            self.xshift2, self.xshift3, self.xshift4))
 
+    @property
+    def sh_array(self):
+        """Shifts of the spectrum on the detector; setting them rebuilds the polynomial basis of the shift systematics."""
+        return self._shifts[0]
+
+    @sh_array.setter
+    def sh_array(self, sh):
+        self._shifts = (sh, None if sh is None else _read_only(polynomial_basis(sh)))
+        self._cache = {}   # evaluations still running with the old shifts fill the old cache
+
+    @property
+    def shift_basis(self):
+        """Polynomial basis of sh_array, see polynomial_basis(); None without shifts."""
+        return self._shifts[1]
+
+    def hst_basis(self, x, tzero=None):
+        """
+        Polynomial basis of the HST phase of the time grid x, built on first use and kept as long as x and tzero are
+        the same.
+        :param x: array, time grid in days (MJD), or phase if x_in_phase=True
+        :param tzero: float, first time of the data in days (MJD); the current value of the tzero parameter if None
+        :return: array of shape (4, len(x)), see polynomial_basis()
+        """
+        x = np.asarray(x, dtype=float)
+        if tzero is None:
+            tzero = self.tzero.val
+        key = (hash(x.tobytes()), tzero)
+        cached_key, basis = self._hst_basis
+        if key != cached_key:
+            hst_phase = x if self.x_in_phase else _phase_values(x, tzero, self.hst_period, self.use_numba)
+            basis = _read_only(polynomial_basis(hst_phase))
+            self._hst_basis = (key, basis)
+        return basis
+
+    def systematic_model(self, x, phase):
+        """
+        Evaluate the systematic model with the current parameter values on the precomputed bases.
+        :param x: array, time grid in days (MJD), or phase if x_in_phase=True
+        :param phase: array, planetary phase of x
+        :return: sys_m: array
+        """
+        return sys_model_basis(phase, self.hst_basis(x), self.shift_basis, self.m_fac.val,
+                               (self.hstp1.val, self.hstp2.val, self.hstp3.val, self.hstp4.val),
+                               (self.xshift1.val, self.xshift2.val, self.xshift3.val, self.xshift4.val))
+
     def calc(self, pars, x, *args, **kwargs):
-        """Evaluate the model"""
-        return _transit_model(pars, x, self.sh_array, x_in_phase=self.x_in_phase)
+        """Evaluate the model
+
+        Same model as _transit_model_values(), but every component is cached together with the values of the
+        parameters it depends on and only recomputed when one of them changed. A finite-difference Jacobian perturbs
+        one parameter at a time, so e.g. a step in hstp3 only recomputes the HST phase factor, and the limb darkening
+        engine only runs when rl, epoch, inclin, msmpr or period move."""
+        x = np.asarray(x, dtype=float)
+        flux0 = pars[1]
+        components = self._components(pars, x)
+        systematic_model = components['slope'] * components['hst']
+        if components['shift'] is not None:
+            systematic_model = systematic_model * components['shift']
+
+        profile = self._profile(x)
+        if profile is not None:
+            flux0 = linear_scale(components['transit'] * systematic_model, *profile)
+
+        return components['transit'] * flux0 * systematic_model
+
+    def profile_flux0(self, data):
+        """
+        Solve for flux0 analytically while it is frozen.
+
+        The model is linear in flux0, so for any values of the other parameters the best flux0 is a weighted linear
+        least-squares solution, see linear_scale(). While flux0 is frozen, every evaluation of the model on the x-grid
+        of data uses that solution instead of the value of flux0, which takes it out of the nonlinear fit; the
+        evaluation does not write it to flux0, set_profiled_flux0() does that after a fit. Thawing flux0 goes back to
+        the normal model, e.g. for the covariance of all parameters at the best fit.
+        :param data: sherpa.data.Data1D with staterror that is fit, or None to switch the profiling off
+        """
+        self.profile_data = data
+
+    def set_profiled_flux0(self):
+        """
+        Set the frozen flux0 to its profiled solution at the current values of the other parameters, e.g. at the best
+        fit. Written like the optimisers write parameter values, which leaves the value reset() returns to alone.
+        Nothing happens if flux0 is not profiled.
+        :return:
+        """
+        data = self.profile_data
+        if data is None or not self.flux0.frozen:
+            return
+        x = np.asarray(data.x, dtype=float)
+        components = self._components([par.val for par in self.pars], x)
+        systematic_model = components['slope'] * components['hst']
+        if components['shift'] is not None:
+            systematic_model = systematic_model * components['shift']
+        self.flux0._val = linear_scale(components['transit'] * systematic_model, *self._profile(x))
+
+    def _profile(self, x, frozen=None):
+        """
+        Data and weights flux0 is profiled over on the grid x, None if flux0 is not profiled there.
+        :param x: array, time grid
+        :param frozen: bool, whether flux0 is treated as frozen; the state of the flux0 parameter if None
+        :return: tuple of the data and the weights 1 / staterror^2, or None
+        """
+        data = self.profile_data
+        if frozen is None:
+            frozen = self.flux0.frozen
+        if data is None or not frozen or np.shape(data.x) != x.shape or not np.array_equal(data.x, x):
+            return None
+        return np.asarray(data.y, dtype=float), 1. / np.square(data.staterror)
+
+    def jacobian(self, pars, x):
+        """
+        Partial derivatives of the model with respect to the thawed parameters.
+
+        The derivatives for flux0, m_fac, hstp1 ... hstp4 and xshift1 ... xshift4 are products of the cached model
+        components. The transit depends on rl directly and on epoch, inclin and msmpr through the impact parameter;
+        these derivatives combine the analytic derivatives of the impact parameter with the derivatives of the
+        limb-darkened transit along rl and b0, see transit_partials(). The model does not depend on ecc.
+        :param pars: list of all parameter values, in the order of Transit.pars
+        :param x: array, time grid in days (MJD), or phase if x_in_phase=True
+        :return: jac: array of shape (number of thawed parameters, len(x))
+        """
+        (rl, flux0, epoch, inclin, msmpr, ecc, omega, period, tzero, c1, c2, c3, c4,
+         m_fac, hstp1, hstp2, hstp3, hstp4, xshift1, xshift2, xshift3, xshift4) = pars
+
+        x = np.asarray(x, dtype=float)
+        components = self._components(pars, x)
+        transit, slope, hst_factor = components['transit'], components['slope'], components['hst']
+        shift_factor = 1. if components['shift'] is None else components['shift']
+        systematic_model = slope * hst_factor * shift_factor
+        profile = self._profile(x)
+        if profile is not None:
+            flux0 = linear_scale(transit * systematic_model, *profile)
+
+        derivatives = {'flux0': transit * systematic_model,
+                       'm_fac': transit * flux0 * components['phase'] * hst_factor * shift_factor,
+                       'ecc': np.zeros(x.size)}
+        hst_basis = self.hst_basis(x, tzero)
+        shift_basis = components['shift_basis']
+        for k in range(4):
+            derivatives['hstp{}'.format(k + 1)] = transit * flux0 * slope * shift_factor * hst_basis[k]
+            derivatives['xshift{}'.format(k + 1)] = (np.zeros(x.size) if shift_basis is None else
+                                                     transit * flux0 * slope * hst_factor * shift_basis[k])
+
+        geometric = [par.name for par in self.pars if par.name in ('rl', 'epoch', 'inclin', 'msmpr') and not par.frozen]
+        if geometric:
+            exposure_time, supersample = self.supersample_kwargs['exposure_time'], self.supersample_kwargs['supersample']
+            b0 = components['b0']
+            phase = _sub_exposure_phase(components['phase'], period, exposure_time, supersample)
+            dmu_drl, dmu_db0 = transit_partials(rl, c1, c2, c3, c4, b0, order=self.jacobian_order)
+            db0 = _impact_param_partials(period * DAY_IN_SECONDS, msmpr, phase, inclin, b0)
+            dphase_depoch = 0. if self.x_in_phase else -1. / period
+            per_sub_exposure = {'rl': dmu_drl, 'epoch': dmu_db0 * db0['phase'] * dphase_depoch,
+                                'inclin': dmu_db0 * db0['inclin'], 'msmpr': dmu_db0 * db0['msmpr']}
+            for name in geometric:
+                dtransit = per_sub_exposure[name]
+                if supersample > 1:
+                    dtransit = _supersampling(x.size, exposure_time, supersample)[1] @ dtransit
+                derivatives[name] = flux0 * systematic_model * dtransit
+            if 'epoch' in derivatives:
+                derivatives['epoch'] = derivatives['epoch'] + transit * flux0 * hst_factor * shift_factor * m_fac * \
+                                       dphase_depoch
+
+        jac = []
+        for par in self.pars:
+            if par.frozen:
+                continue
+            if par.name not in derivatives:
+                raise ValueError('The Transit model has no derivative with respect to {}.'.format(par.name))
+            jac.append(derivatives[par.name])
+        jac = np.array(jac)
+
+        # A profiled flux0 moves with the other parameters, which adds unit_model * dflux0/dpar to every derivative
+        if profile is not None and jac.size > 0:
+            y, weights = profile
+            unit_model = derivatives['flux0']
+            dflux0 = jac @ (weights * (y - 2 * flux0 * unit_model)) / (flux0 * np.sum(weights * unit_model ** 2))
+            jac = jac + dflux0[:, np.newaxis] * unit_model
+
+        return jac
+
+    def _components(self, pars, x):
+        """
+        Model components for the parameter values pars, taken from the cache where they are still valid.
+        :param pars: list of all parameter values, in the order of Transit.pars
+        :param x: array, time grid in days (MJD), or phase if x_in_phase=True
+        :return: dict with phase, b0 (impact parameters of all sub-exposures), transit, slope, hst and shift factors
+                 (shift is None without shifts) and the shift_basis they were computed with
+        """
+        (rl, flux0, epoch, inclin, msmpr, ecc, omega, period, tzero, c1, c2, c3, c4,
+         m_fac, hstp1, hstp2, hstp3, hstp4, xshift1, xshift2, xshift3, xshift4) = pars
+
+        cache = self._cache
+        sh, shift_basis = self._shifts   # one consistent pair, even if sh_array is set meanwhile
+        if sh is not None:
+            _check_shifts(x, sh)
+        x_key = hash(x.tobytes())
+        phase_key = (x_key, epoch, period)
+        geometry_key = phase_key + (msmpr, inclin)
+
+        if self.x_in_phase:
+            phase = x
+        else:
+            phase = _cached(cache, 'phase', phase_key, _phase_values, x, epoch, period, self.use_numba)
+        b0 = _cached(cache, 'b0', geometry_key, _impact_parameters, phase, period, msmpr, inclin,
+                          use_numba=self.use_numba, **self.supersample_kwargs)
+        mulimb0 = _cached(cache, 'transit', geometry_key + (rl, c1, c2, c3, c4), self._transit, phase, b0, rl, c1, c2,
+                               c3, c4, period, msmpr, inclin)
+
+        slope = _cached(cache, 'slope', phase_key + (m_fac,), lambda: phase * m_fac + 1.0)
+        hstp = (hstp1, hstp2, hstp3, hstp4)
+        hst_factor = _cached(cache, 'hst', (x_key, tzero) + hstp,
+                             lambda: _polynomial_factor(hstp, self.hst_basis(x, tzero)))
+        shift_factor = None
+        if shift_basis is not None:
+            xshift = (xshift1, xshift2, xshift3, xshift4)
+            shift_factor = _cached(cache, 'shift', xshift, _polynomial_factor, xshift, shift_basis)
+
+        return {'phase': phase, 'b0': b0, 'transit': mulimb0, 'slope': slope, 'hst': hst_factor, 'shift': shift_factor,
+                'shift_basis': shift_basis}
+
+    def _transit(self, phase, b0, rl, c1, c2, c3, c4, period, msmpr, inclin):
+        """
+        Limb-darkened transit of the data from the impact parameters, restricted to the transit window if enabled.
+        :return: mulimb0: array
+        """
+        in_transit = None
+        if self.window is not None:
+            exposure_time, supersample = self.supersample_kwargs['exposure_time'], self.supersample_kwargs['supersample']
+            margin = 0.5 * exposure_time / period if supersample > 1 else 0.
+            in_transit = self.window.indices(phase, rl, period, msmpr, inclin, margin=margin)
+        return _transit_from_impact(rl, c1, c2, c3, c4, b0, ld_engine=self.ld_engine, in_transit=in_transit,
+                                    use_numba=self.use_numba, **self.supersample_kwargs, **self.kernel_kwargs)
+
+    def calc_batch(self, pars, x, free):
+        """
+        Evaluate the model for a stack of parameter vectors at once, e.g. for all systematic models of a grid.
+
+        The limb darkening engine runs once on the points in transit of all rows if it takes an array of radius
+        ratios ('analytic' and 'quadrature'), otherwise once per row. flux0 is profiled in the rows where it is not
+        free, as in calc() while profile_flux0() is on. Nothing is cached and no parameter is changed.
+        :param pars: array of shape (number of rows, number of parameters), values in the order of Transit.pars
+        :param x: array, time grid in days (MJD), or phase if x_in_phase=True
+        :param free: array of bool of the same shape as pars, the free parameters of every row
+        :return: array of shape (number of rows, len(x))
+        """
+        components = self._batch_components(pars, x, free)
+        return components['transit'] * components['flux0'][:, np.newaxis] * components['systematic']
+
+    def jacobian_batch(self, pars, x, free):
+        """
+        Partial derivatives of calc_batch() with respect to all parameters, the same derivatives as jacobian().
+        :param pars: array of shape (number of rows, number of parameters), values in the order of Transit.pars
+        :param x: array, time grid in days (MJD), or phase if x_in_phase=True
+        :param free: array of bool of the same shape as pars, the free parameters of every row
+        :return: jac: array of shape (number of rows, number of parameters, len(x)), zero for the parameters that are
+                 not free
+        """
+        pars = np.atleast_2d(np.asarray(pars, dtype=float))
+        free = np.broadcast_to(np.asarray(free, dtype=bool), pars.shape)
+        x = np.asarray(x, dtype=float)
+        names = [par.name for par in self.pars]
+        p = dict(zip(names, pars.T[:, :, np.newaxis]))   # columns of shape (number of rows, 1)
+        components = self._batch_components(pars, x, free)
+        transit, slope, hst_factor = components['transit'], components['slope'], components['hst']
+        shift_factor = 1. if components['shift'] is None else components['shift']
+        flux0 = components['flux0'][:, np.newaxis]
+
+        derivatives = {'flux0': transit * components['systematic'],
+                       'm_fac': transit * flux0 * components['phase'] * hst_factor * shift_factor}
+        hst_basis = self.hst_basis(x, p['tzero'][0, 0])
+        shift_basis = components['shift_basis']
+        for k in range(4):
+            derivatives['hstp{}'.format(k + 1)] = transit * flux0 * slope * shift_factor * hst_basis[k]
+            if shift_basis is not None:
+                derivatives['xshift{}'.format(k + 1)] = transit * flux0 * slope * hst_factor * shift_basis[k]
+
+        geometric = [name for name in ('rl', 'epoch', 'inclin', 'msmpr') if np.any(free[:, names.index(name)])]
+        if geometric:
+            exposure_time, supersample = self.supersample_kwargs['exposure_time'], self.supersample_kwargs['supersample']
+            b0 = components['b0']
+            dmu_drl, dmu_db0 = transit_partials(p['rl'], *[p[name][0, 0] for name in ('c1', 'c2', 'c3', 'c4')], b0,
+                                                order=self.jacobian_order)
+            db0 = [_impact_param_partials(period * DAY_IN_SECONDS, msmpr,
+                                          _sub_exposure_phase(phase, period, exposure_time, supersample), inclin,
+                                          row_b0)
+                   for period, msmpr, inclin, phase, row_b0 in
+                   zip(p['period'][:, 0], p['msmpr'][:, 0], p['inclin'][:, 0], components['phase'], b0)]
+            db0 = {key: np.array([row[key] for row in db0]) for key in ('phase', 'inclin', 'msmpr')}
+            dphase_depoch = 0. if self.x_in_phase else -1. / p['period']
+            per_sub_exposure = {'rl': dmu_drl, 'epoch': dmu_db0 * db0['phase'] * dphase_depoch,
+                                'inclin': dmu_db0 * db0['inclin'], 'msmpr': dmu_db0 * db0['msmpr']}
+            for name in geometric:
+                dtransit = per_sub_exposure[name]
+                if supersample > 1:
+                    dtransit = (_supersampling(x.size, exposure_time, supersample)[1] @ dtransit.T).T
+                derivatives[name] = flux0 * components['systematic'] * dtransit
+            if 'epoch' in derivatives:
+                derivatives['epoch'] = derivatives['epoch'] + transit * flux0 * hst_factor * shift_factor * p['m_fac'] * \
+                                       dphase_depoch
+
+        jac = np.zeros(pars.shape + (x.size,))
+        for j, name in enumerate(names):
+            if not np.any(free[:, j]) or name == 'ecc':
+                continue
+            if name not in derivatives:
+                raise ValueError('The Transit model has no derivative with respect to {}.'.format(name))
+            jac[:, j] = derivatives[name]
+        jac *= free[:, :, np.newaxis]
+
+        # A profiled flux0 moves with the other parameters, see jacobian()
+        profiled = components['profiled']
+        if np.any(profiled):
+            y, weights = components['profile']
+            unit_model = derivatives['flux0'][profiled]
+            dflux0 = np.einsum('kpn,kn->kp', jac[profiled], weights * (y - 2 * flux0[profiled] * unit_model))
+            dflux0 /= flux0[profiled] * np.sum(weights * unit_model ** 2, axis=-1)[:, np.newaxis]
+            jac[profiled] += dflux0[:, :, np.newaxis] * unit_model[:, np.newaxis]
+
+        return jac
+
+    def _batch_components(self, pars, x, free):
+        """
+        Model components of calc_batch(), one row per parameter vector.
+        :return: dict with the arrays phase, b0, transit, slope, hst, shift (None without shifts) and systematic of
+                 shape (number of rows, ...), the shift_basis, flux0 of every row (profiled where flux0 is not free),
+                 the bool array profiled and the profile (data and weights) or None
+        """
+        pars = np.atleast_2d(np.asarray(pars, dtype=float))
+        free = np.broadcast_to(np.asarray(free, dtype=bool), pars.shape)
+        x = np.asarray(x, dtype=float)
+        names = [par.name for par in self.pars]
+        p = dict(zip(names, pars.T))
+        sh, shift_basis = self._shifts
+        if sh is not None:
+            _check_shifts(x, sh)
+
+        if self.x_in_phase:
+            phase = np.tile(x, (pars.shape[0], 1))
+        else:
+            phase = np.array([_phase_values(x, epoch, period, self.use_numba)
+                              for epoch, period in zip(p['epoch'], p['period'])])
+        b0 = np.array([_impact_parameters(row_phase, period, msmpr, inclin, use_numba=self.use_numba,
+                                          **self.supersample_kwargs)
+                       for row_phase, period, msmpr, inclin in zip(phase, p['period'], p['msmpr'], p['inclin'])])
+
+        coeffs = pars[:, [names.index(name) for name in ('c1', 'c2', 'c3', 'c4')]]
+        if self.ld_engine in ('analytic', 'quadrature') and np.all(coeffs == coeffs[0]):
+            # One call of the engine for the points in transit of all rows, every other point is 1
+            mulimb0 = np.ones(b0.shape)
+            near = np.nonzero(b0 < 1 + p['rl'][:, np.newaxis])
+            if near[0].size > 0:
+                mulimb0[near] = limb_darkened_transit(np.broadcast_to(p['rl'][:, np.newaxis], b0.shape)[near],
+                                                      *coeffs[0], b0[near], self.ld_engine, **self.kernel_kwargs)[0]
+            supersample = self.supersample_kwargs['supersample']
+            if supersample > 1:
+                reduction = _supersampling(x.size, self.supersample_kwargs['exposure_time'], supersample)[1]
+                mulimb0 = (reduction @ mulimb0.T).T
+        else:
+            mulimb0 = np.array([self._transit(row_phase, row_b0, rl, *row_coeffs, period, msmpr, inclin)
+                                for row_phase, row_b0, rl, row_coeffs, period, msmpr, inclin in
+                                zip(phase, b0, p['rl'], coeffs, p['period'], p['msmpr'], p['inclin'])])
+
+        slope = phase * p['m_fac'][:, np.newaxis] + 1.0
+        hst_factor = _polynomial_factor(pars[:, [names.index('hstp{}'.format(k + 1)) for k in range(4)]],
+                                        self.hst_basis(x, p['tzero'][0]))
+        systematic_model = slope * hst_factor
+        shift_factor = None
+        if shift_basis is not None:
+            shift_factor = _polynomial_factor(pars[:, [names.index('xshift{}'.format(k + 1)) for k in range(4)]],
+                                              shift_basis)
+            systematic_model = systematic_model * shift_factor
+
+        flux0 = p['flux0'].copy()
+        profile = self._profile(x, frozen=True)
+        profiled = ~free[:, names.index('flux0')] if profile is not None else np.zeros(flux0.size, dtype=bool)
+        if np.any(profiled):
+            flux0[profiled] = linear_scale(mulimb0[profiled] * systematic_model[profiled], *profile)
+
+        return {'phase': phase, 'b0': b0, 'transit': mulimb0, 'slope': slope, 'hst': hst_factor, 'shift': shift_factor,
+                'shift_basis': shift_basis, 'systematic': systematic_model, 'flux0': flux0, 'profiled': profiled,
+                'profile': profile}
+
+
+def _cached(cache, name, key, function, *args, **kwargs):
+    """
+    Return the cached component name if it was computed for the same key, otherwise compute and cache it.
+
+    An entry is replaced as one (key, value) tuple and its value is read-only, so threads evaluating the same model
+    either find a complete entry or compute their own.
+    :param cache: dict of the cached components of a model
+    :param name: string, name of the component
+    :param key: tuple of the values the component depends on
+    :param function: computes the component from args and kwargs
+    :return: the component
+    """
+    entry = cache.get(name)
+    if entry is None or entry[0] != key:
+        entry = (key, _read_only(function(*args, **kwargs)))
+        cache[name] = entry
+    return entry[1]
+
+
+def _read_only(value):
+    """Mark an array that is kept and handed out to several callers as read-only, return anything else as it is."""
+    if isinstance(value, np.ndarray):
+        value.flags.writeable = False
+    return value
+
+
+LD_ENGINES = ('occultnl', 'analytic', 'table', 'quadrature')
+
+
+def ld_engine_kwargs(ld_engine):
+    """
+    Read the settings of a limb darkening engine from the configfile.
+    :param ld_engine: string, one of LD_ENGINES
+    :return: dict, keyword arguments for limb_darkened_transit()
+    """
+    kwargs = {'chunk_size': CONFIG_INI.getint('transit_model', 'chunk_size'),
+              'threads': CONFIG_INI.getint('transit_model', 'threads')}
+
+    if ld_engine == 'occultnl':
+        kwargs.update({'batched': CONFIG_INI.getboolean('transit_model', 'batched'),
+                       'memory_budget': CONFIG_INI.getfloat('transit_model', 'memory_budget'),
+                       'per_point': CONFIG_INI.getboolean('transit_model', 'per_point')})
+    elif ld_engine == 'analytic':
+        kwargs.update({'order': CONFIG_INI.getint('transit_model', 'analytic_order')})
+    elif ld_engine == 'table':
+        kwargs.update({'rl_min': CONFIG_INI.getfloat('transit_model', 'table_rl_min'),
+                       'rl_max': CONFIG_INI.getfloat('transit_model', 'table_rl_max'),
+                       'tolerance': CONFIG_INI.getfloat('transit_model', 'table_tolerance')})
+    elif ld_engine == 'quadrature':
+        kwargs.update({'rtol': CONFIG_INI.getfloat('transit_model', 'quadrature_rtol'),
+                       'atol': CONFIG_INI.getfloat('transit_model', 'quadrature_atol')})
+    else:
+        raise ValueError("ld_engine has to be one of {}, not '{}'.".format(LD_ENGINES, ld_engine))
+
+    return kwargs
+
+
+def transit_partials(rl, c1, c2, c3, c4, b0, step=1e-6, order=12):
+    """
+    Derivatives of the limb-darkened transit with respect to the radius ratio and the impact parameter.
+
+    They are central differences of the analytic engine (mandel_agol.py), which is smooth in rl and b0 whichever
+    engine computes the transit itself; the global convergence test of occultnl can change its number of annuli
+    between two nearby points, which does not make for good finite differences. With the other engines, these are
+    therefore the derivatives of a slightly different model: for W17 with occultnl, they differ from the derivatives
+    of occultnl at its final number of annuli by up to 0.1% of their largest value, which changes the parameter
+    errors of a fit by about 2e-4 relative (see test_transit_partials_engine_mismatch). Only points near or in
+    transit are evaluated, everywhere else both derivatives are zero.
+    :param rl: float or array that broadcasts against b0, transit depth (Rp/R*)
+    :param c1: float, limb darkening parameter 1
+    :param c2: float, limb darkening parameter 2
+    :param c3: float, limb darkening parameter 3
+    :param c4: float, limb darkening parameter 4
+    :param b0: array, impact parameter in stellar radii
+    :param step: float, default=1e-6; step of the central differences
+    :param order: int, default=12; order of the analytic engine
+    :return: dmu_drl, dmu_db0: arrays of the same shape as b0
+    """
+    b0 = np.asarray(b0, dtype=float)
+    rl = np.broadcast_to(np.asarray(rl, dtype=float), b0.shape)
+    dmu_drl = np.zeros(b0.shape)
+    dmu_db0 = np.zeros(b0.shape)
+
+    near = np.nonzero(b0 < 1 + rl + step)
+    if near[0].size > 0:
+        z = b0[near]
+        r = rl[near]
+        # The transit is even in b0, so the step below zero is mirrored
+        rls = np.concatenate([r + step, r - step, r, r])
+        zs = np.concatenate([z, z, z + step, np.abs(z - step)])
+        mu = occultnl_analytic(rls, c1, c2, c3, c4, zs, order=order)[0].reshape(4, z.size)
+        dmu_drl[near] = (mu[0] - mu[1]) / (2 * step)
+        dmu_db0[near] = (mu[2] - mu[3]) / (2 * step)
+
+    return dmu_drl, dmu_db0
+
+
+def limb_darkened_transit(rl, c1, c2, c3, c4, b0, ld_engine='occultnl', chunk_size=None, threads=1, use_numba=False,
+                          **kwargs):
+    """
+    Compute the limb-darkened transit with the selected engine.
+
+    'occultnl' integrates the nonlinear limb darkening law numerically and is the reference implementation, 'analytic'
+    uses the closed-form solutions of Mandel & Agol (2002) from mandel_agol.py and 'table' interpolates a table of the
+    transit that is built once per set of limb darkening coefficients (transit_table.py). 'quadrature' integrates the
+    nonlinear law with an error-controlled Gauss-Legendre rule (mandel_agol.occultnl_quadrature()).
+    :param rl: float, transit depth (Rp/R*); 'analytic' and 'quadrature' also take an array of one per point of b0
+    :param c1: float, limb darkening parameter 1
+    :param c2: float, limb darkening parameter 2
+    :param c3: float, limb darkening parameter 3
+    :param c4: float, limb darkening parameter 4
+    :param b0: impact parameter in stellar radii
+    :param ld_engine: string, default='occultnl'; 'occultnl', 'analytic', 'table' or 'quadrature'
+    :param chunk_size: int or None, default=None; if set, b0 is split into chunks of this size that are evaluated in
+                       parallel if threads > 1; the result is bitwise identical for any number of threads
+    :param threads: int, default=1; number of threads evaluating the chunks
+    :param use_numba: bool, default=False; whether occultnl() runs its Numba-compiled loop, see jit_kernels.py; the
+                      other engines do not use Numba
+    :param kwargs: passed on to occultnl(), mandel_agol.occultnl_analytic(), transit_table.get_transit_table() or
+                   mandel_agol.occultnl_quadrature()
+    :return: mulimb0: limb-darkened transit model, mulimbf: lightcurves for each component that you put in the model
+             (None for the 'table' engine, which only tabulates the combined model)
+    """
+    if ld_engine == 'occultnl':
+        # The convergence test of occultnl couples all points, so occultnl does its own chunking
+        return occultnl(rl, c1, c2, c3, c4, b0, chunk_size=chunk_size, threads=threads, use_numba=use_numba, **kwargs)
+
+    if isinstance(b0, u.Quantity):
+        b0 = b0.value
+    b0 = np.atleast_1d(b0)
+    if chunk_size and b0.size > chunk_size:
+        # The other engines treat every point independently
+        starts = range(0, b0.size, chunk_size)
+        chunks = [b0[start:start + chunk_size] for start in starts]
+        rls = [rl] * len(chunks) if np.ndim(rl) == 0 else [rl[start:start + chunk_size] for start in starts]
+        results = _map_threaded(lambda rl_chunk, chunk: limb_darkened_transit(rl_chunk, c1, c2, c3, c4, chunk, ld_engine,
+                                                                              **kwargs),
+                                rls, chunks, threads=threads)
+        mulimb0 = np.concatenate([result[0] for result in results])
+        mulimbf = None if results[0][1] is None else np.concatenate([result[1] for result in results], axis=-1)
+        return mulimb0, mulimbf
+
+    if ld_engine == 'analytic':
+        return occultnl_analytic(rl, c1, c2, c3, c4, b0, **kwargs)
+    elif ld_engine == 'table':
+        return get_transit_table(c1, c2, c3, c4, **kwargs)(rl, b0), None
+    elif ld_engine == 'quadrature':
+        return occultnl_quadrature(rl, c1, c2, c3, c4, b0, **kwargs)
+    else:
+        raise ValueError("ld_engine has to be one of {}, not '{}'.".format(LD_ENGINES, ld_engine))
 
 
-def occultnl(rl, c1, c2, c3, c4, b0):
+def occultnl(rl, c1, c2, c3, c4, b0, batched=False, memory_budget=256., per_point=False, return_nr=False,
+             chunk_size=None, threads=1, use_numba=False):
     """
     MANDEL & AGOL (2002) transit model.
     :param rl: float, transit depth (Rp/R*)
@@ -171,9 +1021,42 @@ def occultnl(rl, c1, c2, c3, c4, b0):
     :param c3: float, limb darkening parameter 3
     :param c4: float, limb darkening parameter 4
     :param b0: impact parameter in stellar radii
-    :return: mulimb0: limb-darkened transit model, mulimbf: lightcurves for each component that you put in the model
+    :param batched: bool, default=False; if True, all annuli of a refinement level are evaluated as one
+                    (annulus x impact parameter) array computation instead of looping over them one by one
+    :param memory_budget: float, default=256; memory in MB the batched computation is allowed to use for one tile
+                          of annuli and for keeping the annuli that the next refinement level can reuse
+    :param per_point: bool, default=False; if True, convergence is tested for every impact parameter separately and
+                      converged points are frozen, so only the points that have not converged yet get refined further
+    :param return_nr: bool, default=False; if True, also return the number of annuli every point was integrated with
+    :param chunk_size: int or None, default=None; if set, the points in transit are integrated in chunks of this size,
+                       which are evaluated in parallel if threads > 1 (the convergence test still covers all points)
+    :param threads: int, default=1; number of threads evaluating the chunks; the result is bitwise identical for any
+                    number of threads
+    :param use_numba: bool, default=False; if True, the loop over the annuli runs in the Numba-compiled kernels of
+                      jit_kernels.py (which needs Numba to be installed); the whole integration is compiled unless
+                      there are more than chunk_size points, then every chunk of a refinement level is
+    :return: mulimb0: limb-darkened transit model, mulimbf: lightcurves for each component that you put in the model,
+             nr_points: number of annuli per point (0 for points out of transit), only if return_nr=True
     """
-    mulimb0 = occultuniform(b0, rl)
+    if per_point:
+        mulimb0, mulimbf, nr_points = _occultnl_per_point(rl, c1, c2, c3, c4, b0, batched, memory_budget, use_numba)
+        if return_nr:
+            return mulimb0, mulimbf, nr_points
+        return mulimb0, mulimbf
+
+    if use_numba:
+        # The compiled loop over the annuli needs no temporaries, so it replaces the batched mode as well
+        if isinstance(b0, u.Quantity):
+            b0 = b0.value
+        b0 = np.atleast_1d(np.asarray(b0, dtype=float))
+        if not chunk_size or b0.size <= chunk_size:
+            mulimb0, mulimbf, nr = jit_kernels.occultnl(float(rl), float(c1), float(c2), float(c3), float(c4), b0)
+            if return_nr:
+                return mulimb0, mulimbf, np.where(mulimbf[0] != 1., nr, 0)
+            return mulimb0, mulimbf
+        # Long time series run the compiled refinement levels chunk by chunk below, on several threads if asked to
+
+    mulimb0 = occultuniform(b0, rl, use_numba)
     bt0 = b0
     fac = np.max(np.abs(mulimb0 - 1))
     if fac == 0:
@@ -193,6 +1076,7 @@ def occultnl(rl, c1, c2, c3, c4, b0):
     mulimbf[4, :] = mulimbf[4, :] + 0.5
     nr = np.int64(2)
     dmumax = 1.0
+    mu_annuli = None   # uniform-source occultation of the annuli of the previous refinement level, if kept
 
     while (dmumax > fac * 1.e-3) and (nr <= 131072):
         #print(nr)
@@ -202,19 +1086,25 @@ def occultnl(rl, c1, c2, c3, c4, b0):
         t = dt * np.arange(nr + 1)
         th = t + 0.5 * dt
         r = np.sin(t)
-        sig = np.sqrt(np.cos(th[nr - 1]))
-        mulimbhalf = sig ** 3 * mulimb0[indx] / (1 - r[nr - 1])
-        mulimb1 = sig ** 4 * mulimb0[indx] / (1 - r[nr - 1])
-        mulimb3half = sig ** 5 * mulimb0[indx] / (1 - r[nr - 1])
-        mulimb2 = sig ** 6 * mulimb0[indx] / (1 - r[nr - 1])
-        for i in range(1, nr):
-            mu = occultuniform(b0[indx] / r[i], rl / r[i])
-            sig1 = np.sqrt(np.cos(th[i - 1]))
-            sig2 = np.sqrt(np.cos(th[i]))
-            mulimbhalf = mulimbhalf + r[i] ** 2 * mu * (sig1 ** 3 / (r[i] - r[i - 1]) - sig2 ** 3 / (r[i + 1] - r[i]))
-            mulimb1 = mulimb1 + r[i] ** 2 * mu * (sig1 ** 4 / (r[i] - r[i - 1]) - sig2 ** 4 / (r[i + 1] - r[i]))
-            mulimb3half = mulimb3half + r[i] ** 2 * mu * (sig1 ** 5 / (r[i] - r[i - 1]) - sig2 ** 5 / (r[i + 1] - r[i]))
-            mulimb2 = mulimb2 + r[i] ** 2 * mu * (sig1 ** 6 / (r[i] - r[i - 1]) - sig2 ** 6 / (r[i + 1] - r[i]))
+        if chunk_size and np.size(indx) > chunk_size:
+            # Every point only depends on itself within a level, so the in-transit points are split into chunks that
+            # can be evaluated in parallel; the convergence test below still runs over all points
+            chunks = [indx[start:start + chunk_size] for start in range(0, indx.size, chunk_size)]
+            if mu_annuli is None:
+                mu_annuli = [None] * len(chunks)
+            level = _map_threaded(lambda chunk, mu_chunk: _occultnl_level(rl, b0[chunk], mulimb0[chunk], r, th, nr,
+                                                                          batched, memory_budget, mu_chunk,
+                                                                          use_numba),
+                                  chunks, mu_annuli, threads=threads)
+            mulimbhalf, mulimb1, mulimb3half, mulimb2 = [np.concatenate([result[k] for result in level])
+                                                         for k in range(4)]
+            mu_annuli = [result[4] for result in level]
+            if any(mu_chunk is None for mu_chunk in mu_annuli):
+                mu_annuli = None
+        else:
+            mulimbhalf, mulimb1, mulimb3half, mulimb2, mu_annuli = _occultnl_level(rl, b0[indx], mulimb0[indx], r, th,
+                                                                                   nr, batched, memory_budget,
+                                                                                   mu_annuli, use_numba)
 
         mulimb = ((1 - c1 - c2 - c3 - c4) * mulimb0[
             indx] + c1 * mulimbhalf * dt + c2 * mulimb1 * dt + c3 * mulimb3half * dt + c4 * mulimb2 * dt) / omega
@@ -235,47 +1125,287 @@ def occultnl(rl, c1, c2, c3, c4, b0):
     np.atleast_1d(mulimb0)[indx] = mulimb
     b0 = bt0
 
+    if return_nr:
+        nr_points = np.zeros(nb, dtype=np.int64)
+        nr_points[indx] = nr
+        return mulimb0, mulimbf, nr_points
     return mulimb0, mulimbf
 
 
-def occultuniform(b0, w):
+def _occultnl_level(rl, b0, mulimb0, r, th, nr, batched=False, memory_budget=256., mu_annuli=None, use_numba=False):
     """
-    Compute the lightcurve for occultation of a uniform source without microlensing (Mandel & Agol 2002).
+    Integrate the four limb darkening components of the points in transit for one occultnl refinement level.
+    :param rl: float, transit depth (Rp/R*)
+    :param b0: array, impact parameters (in stellar radii) of the points that are in transit
+    :param mulimb0: array, uniform-source occultation of these points
+    :param r: array, radii of the annuli of this refinement level (length nr+1)
+    :param th: array, midpoint angles of the annuli of this refinement level (length nr+1)
+    :param nr: int, number of annuli of this refinement level
+    :param batched: bool, see occultnl()
+    :param memory_budget: float, see occultnl()
+    :param mu_annuli: array or None, annuli kept by the batched computation of the previous level
+    :param use_numba: bool, default=False; if True, the level is integrated by the Numba-compiled kernel, which releases
+                      the GIL, and batched is ignored
+    :return: mulimbhalf, mulimb1, mulimb3half, mulimb2: sums of the four components (not yet multiplied by dt),
+             mu_annuli: annuli of this level kept by the batched computation, or None
+    """
+    if use_numba:
+        sums = jit_kernels.occultnl_level(float(rl), np.atleast_1d(b0), np.atleast_1d(mulimb0), r, th, int(nr))
+        sums = sums.reshape((4,) + np.shape(b0))
+        return sums[0], sums[1], sums[2], sums[3], None
+
+    sig = np.sqrt(np.cos(th[nr - 1]))
+    mulimbhalf = sig ** 3 * mulimb0 / (1 - r[nr - 1])
+    mulimb1 = sig ** 4 * mulimb0 / (1 - r[nr - 1])
+    mulimb3half = sig ** 5 * mulimb0 / (1 - r[nr - 1])
+    mulimb2 = sig ** 6 * mulimb0 / (1 - r[nr - 1])
+    if batched:
+        annuli_sums, mu_annuli = _occultnl_annuli(rl, b0, r, th, nr, mu_annuli, memory_budget)
+        mulimbhalf = mulimbhalf + annuli_sums[0]
+        mulimb1 = mulimb1 + annuli_sums[1]
+        mulimb3half = mulimb3half + annuli_sums[2]
+        mulimb2 = mulimb2 + annuli_sums[3]
+    else:
+        for i in range(1, nr):
+            mu = occultuniform(b0 / r[i], rl / r[i])
+            sig1 = np.sqrt(np.cos(th[i - 1]))
+            sig2 = np.sqrt(np.cos(th[i]))
+            mulimbhalf = mulimbhalf + r[i] ** 2 * mu * (sig1 ** 3 / (r[i] - r[i - 1]) - sig2 ** 3 / (r[i + 1] - r[i]))
+            mulimb1 = mulimb1 + r[i] ** 2 * mu * (sig1 ** 4 / (r[i] - r[i - 1]) - sig2 ** 4 / (r[i + 1] - r[i]))
+            mulimb3half = mulimb3half + r[i] ** 2 * mu * (sig1 ** 5 / (r[i] - r[i - 1]) - sig2 ** 5 / (r[i + 1] - r[i]))
+            mulimb2 = mulimb2 + r[i] ** 2 * mu * (sig1 ** 6 / (r[i] - r[i - 1]) - sig2 ** 6 / (r[i + 1] - r[i]))
 
-    :param b0: array; impact parameter in units of stellar radii
-    :param w: array; occulting star size in units of stellar radius
-    :return: muo1: float; fraction of flux at each b0 for a uniform source
+    return mulimbhalf, mulimb1, mulimb3half, mulimb2, mu_annuli
+
+
+def _map_threaded(function, *iterables, threads=1):
+    """
+    Map a function over chunks of work, on a thread pool if threads > 1.
+
+    The chunks are the same for any number of threads and the results come back in order, so the outcome does not
+    depend on the number of threads. NumPy releases the GIL inside its array operations, which is where the time of
+    the transit kernels goes.
+    :param function: callable
+    :param iterables: iterables of the arguments, like for map()
+    :param threads: int, number of threads
+    :return: list of the results
     """
+    if threads > 1:
+        return list(_thread_pool(threads).map(function, *iterables))
+    return list(map(function, *iterables))
 
-    if np.abs(w - 0.5) < 1.0e-3:
-        w = 0.5
 
-    nb = len(np.atleast_1d(b0))
-    muo1 = np.zeros(nb)
+@functools.lru_cache(maxsize=None)
+def _thread_pool(threads):
+    """Thread pool shared by all kernel evaluations that use the same number of threads."""
+    return ThreadPoolExecutor(max_workers=threads)
 
 
-    for i in range(nb):
-        # substitute z=b0(i) to shorten expressions
-        z = np.atleast_1d(b0)[i]
-        z = z.value    # stripping it of astropy units
-        if z >= 1+w:
-            muo1[i] = 1.0
-            continue
+def _occultnl_per_point(rl, c1, c2, c3, c4, b0, batched=False, memory_budget=256., use_numba=False):
+    """
+    occultnl() with a convergence test for every impact parameter separately.
+
+    The refinement levels are the same as for the global test, but a point is frozen once its own model has converged
+    and is dropped from the working set. The change of a single point between two levels does not shrink
+    monotonically and can be small by coincidence, while the global test stops at the level where the largest change
+    of all points is below the tolerance, so that most points have changed much less. A point is therefore only frozen
+    once its change was below half the tolerance of the global test (relative to the transit depth, as in occultnl())
+    at two consecutive levels, which keeps its error within that of the global test.
+    :param rl: float, transit depth (Rp/R*)
+    :param c1: float, limb darkening parameter 1
+    :param c2: float, limb darkening parameter 2
+    :param c3: float, limb darkening parameter 3
+    :param c4: float, limb darkening parameter 4
+    :param b0: impact parameter in stellar radii
+    :param batched: bool, see occultnl()
+    :param memory_budget: float, see occultnl()
+    :param use_numba: bool, whether the uniform-source occultation of the annuli is Numba-compiled
+    :return: mulimb0: limb-darkened transit model, mulimbf: lightcurves for each component, nr_points: number of
+             annuli per point (0 for points out of transit)
+    """
+    if isinstance(b0, u.Quantity):
+        b0 = b0.value
+    b0 = np.atleast_1d(b0)
 
-        if w >= 1 and z <= w-1:
-            muo1[i] = 0.0
-            continue
+    mulimb0 = occultuniform(b0, rl, use_numba)
+    fac = np.max(np.abs(mulimb0 - 1))
+    if fac == 0:
+        fac = 1e-6  # DKS edit
 
-        if z >= np.abs(1-w) and z <= 1+w:
-            kap1 = np.arccos(np.min(np.append((1 - w ** 2 + z ** 2) / 2 / z, 1.)))
-            kap0 = np.arccos(np.min(np.append((w ** 2 + z ** 2 - 1) / 2 / w / z, 1.)))
-            lambdae = w ** 2 * kap0 + kap1
-            lambdae = (lambdae - 0.5 * np.sqrt(np.max(np.append(4. * z ** 2 - (1 + z ** 2 - w ** 2) ** 2, 0.)))) / np.pi
-            muo1[i] = 1 - lambdae
+    omega = 4 * ((1 - c1 - c2 - c3 - c4) / 4 + c1 / 5 + c2 / 6 + c3 / 7 + c4 / 8)
+    nb = len(b0)
+    mulimbf = np.zeros((5, nb))
+    mulimbf[0, :] = mulimbf[0, :] + 1.
+    mulimbf[1, :] = mulimbf[1, :] + 0.8
+    mulimbf[2, :] = mulimbf[2, :] + 2 / 3
+    mulimbf[3, :] = mulimbf[3, :] + 4 / 7
+    mulimbf[4, :] = mulimbf[4, :] + 0.5
+    nr_points = np.zeros(nb, dtype=np.int64)
 
-        if z <= 1-w:
-            muo1[i] = 1 - w ** 2
-            continue
+    active = np.where(mulimb0 != 1.0)[0]   # points in transit that have not converged yet
+    mulimbp = mulimb0[active]
+    mulimb = mulimb0.copy()
+    converged = np.zeros(active.size, dtype=bool)   # whether each active point has converged at the previous level
+    nr = np.int64(2)
+    mu_annuli = None
+
+    while active.size > 0 and nr <= 131072:
+        nr = nr * 2
+        dt = 0.5 * np.pi / nr
+        t = dt * np.arange(nr + 1)
+        th = t + 0.5 * dt
+        r = np.sin(t)
+        sig = np.sqrt(np.cos(th[nr - 1]))
+        edge = mulimb0[active] / (1 - r[nr - 1])
+        sums = sig ** np.arange(3, 7)[:, np.newaxis] * edge
+
+        if batched:
+            annuli_sums, mu_annuli = _occultnl_annuli(rl, b0[active], r, th, nr, mu_annuli, memory_budget)
+            sums += annuli_sums
+        else:
+            for i in range(1, nr):
+                mu = occultuniform(b0[active] / r[i], rl / r[i], use_numba)
+                sig1 = np.sqrt(np.cos(th[i - 1]))
+                sig2 = np.sqrt(np.cos(th[i]))
+                for k, power in enumerate(range(3, 7)):
+                    sums[k] += r[i] ** 2 * mu * (sig1 ** power / (r[i] - r[i - 1]) - sig2 ** power / (r[i + 1] - r[i]))
+
+        mulimbf[1:, active] = sums * dt
+        mulimb[active] = ((1 - c1 - c2 - c3 - c4) * mulimb0[active] + c1 * sums[0] * dt + c2 * sums[1] * dt
+                          + c3 * sums[2] * dt + c4 * sums[3] * dt) / omega
+        nr_points[active] = nr
+
+        total = mulimb[active] + mulimbp
+        change = np.abs(mulimb[active] - mulimbp) / np.where(total != 0., total, 1.)
+        small = change <= 0.5 * fac * 1.e-3
+        if nr == 4:
+            # The first level is compared with the uniform-source model, which is no estimate of the integral
+            small[:] = False
+        pending = ~(small & converged)
+
+        active = active[pending]
+        converged = small[pending]
+        mulimbp = mulimb[active]
+        if mu_annuli is not None:
+            mu_annuli = mu_annuli[:, pending]
+
+    in_transit = nr_points > 0
+    mulimbf[0, in_transit] = mulimb0[in_transit]
+
+    return mulimb, mulimbf, nr_points
+
+
+def _occultnl_annuli(rl, b0, r, th, nr, mu_previous=None, memory_budget=256.):
+    """
+    Sum the contributions of all annuli i = 1 ... nr-1 of one occultnl refinement level in one go.
+
+    The uniform-source occultation of every annulus is computed as a 2D (annulus x impact parameter) array, in tiles
+    of annuli that fit into the memory budget. Doubling nr keeps every annulus of the previous level (the new annulus
+    2*i sits at exactly the same radius as the old annulus i), so if the annuli of the previous level were kept, only
+    the new, odd annuli have to be computed.
+
+    :param rl: float, transit depth (Rp/R*)
+    :param b0: array, impact parameters (in stellar radii) of the points that are in transit
+    :param r: array, radii of the annuli of this refinement level (length nr+1)
+    :param th: array, midpoint angles of the annuli of this refinement level (length nr+1)
+    :param nr: int, number of annuli of this refinement level
+    :param mu_previous: array or None, uniform-source occultation of the annuli of the previous level, as returned by
+                        the previous call of this function
+    :param memory_budget: float, memory in MB one tile of annuli and the kept annuli are allowed to use
+    :return: sums: array of shape (4, len(b0)), contributions to mulimbhalf, mulimb1, mulimb3half and mulimb2;
+             mu_annuli: uniform-source occultation of all annuli of this level, or None if they don't fit into the
+             memory budget
+    """
+
+    if isinstance(b0, u.Quantity):
+        b0 = b0.value
+    b0 = np.atleast_1d(b0)
+
+    # Weights of each annulus in the four limb darkening integrals, shape (4, nr-1)
+    i = np.arange(1, nr)
+    sig1 = np.sqrt(np.cos(th[i - 1]))
+    sig2 = np.sqrt(np.cos(th[i]))
+    powers = np.arange(3, 7)[:, np.newaxis]
+    weights = r[i] ** 2 * (sig1 ** powers / (r[i] - r[i - 1]) - sig2 ** powers / (r[i + 1] - r[i]))
+
+    budget = memory_budget * 2 ** 20
+    row_bytes = 8 * b0.size
+    tile_rows = max(1, int(budget / (10 * row_bytes)))   # occultuniform creates about ten temporaries per tile
+    keep = (nr - 1) * row_bytes <= budget
+    mu_annuli = np.empty((nr - 1, b0.size)) if keep else None
+
+    sums = np.zeros((4, b0.size))
+    if mu_previous is not None:
+        # Even annuli are the annuli of the previous level
+        sums += weights[:, 1::2] @ mu_previous
+        if keep:
+            mu_annuli[1::2] = mu_previous
+        todo = np.arange(1, nr, 2)
+    else:
+        todo = i
+
+    for start in range(0, todo.size, tile_rows):
+        ii = todo[start:start + tile_rows]
+        mu = occultuniform(b0[np.newaxis, :] / r[ii, np.newaxis], rl / r[ii, np.newaxis])
+        sums += weights[:, ii - 1] @ mu
+        if keep:
+            mu_annuli[ii - 1] = mu
+
+    return sums, mu_annuli
+
+
+def occultuniform(b0, w, use_numba=False):
+    """
+    Compute the lightcurve for occultation of a uniform source without microlensing (Mandel & Agol 2002).
+
+    All cases (no overlap, partial overlap, full occultation and planet fully inside the stellar disk) are evaluated
+    with masks over the whole b0 array at once, so there is no Python loop over the individual impact parameters.
+    b0 and w are broadcast against each other, and both can be plain floats/arrays or astropy Quantities.
+
+    :param b0: array; impact parameter in units of stellar radii
+    :param w: float or array; occulting star size in units of stellar radius
+    :param use_numba: bool, default=False; whether the Numba-compiled kernel of jit_kernels.py is used
+    :return: muo1: array; fraction of flux at each b0 for a uniform source
+    """
+
+    # Stripping the inputs of astropy units
+    if isinstance(b0, u.Quantity):
+        b0 = b0.value
+    if isinstance(w, u.Quantity):
+        w = w.value
+
+    z = np.atleast_1d(np.asarray(b0, dtype=float))
+    w = np.asarray(w, dtype=float)
+    if use_numba:
+        shape = np.broadcast_shapes(z.shape, w.shape)
+        return jit_kernels.occultuniform(np.broadcast_to(z, shape).ravel(),
+                                         np.broadcast_to(w, shape).ravel()).reshape(shape)
+
+    w = np.where(np.abs(w - 0.5) < 1.0e-3, 0.5, w)
+    z, w = np.broadcast_arrays(z, w)
+
+    muo1 = np.zeros(z.shape)
+
+    # Partial overlap of the two disks
+    partial = (z >= np.abs(1 - w)) & (z <= 1 + w)
+    if np.any(partial):
+        zp = z[partial]
+        wp = w[partial]
+        kap1 = np.arccos(np.minimum((1 - wp ** 2 + zp ** 2) / 2 / zp, 1.))
+        kap0 = np.arccos(np.minimum((wp ** 2 + zp ** 2 - 1) / 2 / wp / zp, 1.))
+        lambdae = wp ** 2 * kap0 + kap1
+        lambdae = (lambdae - 0.5 * np.sqrt(np.maximum(4. * zp ** 2 - (1 + zp ** 2 - wp ** 2) ** 2, 0.))) / np.pi
+        muo1[partial] = 1 - lambdae
+
+    # Occulting disk fully inside the stellar disk
+    inside = z <= 1 - w
+    muo1[inside] = 1 - w[inside] ** 2
+
+    # Stellar disk fully occulted
+    muo1[(w >= 1) & (z <= w - 1)] = 0.0
+
+    # No overlap at all
+    muo1[z >= 1 + w] = 1.0
 
     return muo1
 
@@ -389,6 +1519,111 @@ def wfc3_systematic_model_grid_selection(selection):
     return wfc3_grid
 
 
+def nested_parents(grid):
+    """
+    Closest nested parent of every systematic model in a grid.
+
+    A model is nested in another one if all of its free parameters are also free in the other one. The parent of a
+    model is the nested model that leaves the fewest of its parameters frozen, the first one in the grid if there are
+    several; the best fit of the parent is a good starting point for the model, with the extra free terms starting
+    from their default values. Parents always have fewer free parameters than their children, so fitting the models
+    in the order of their number of free parameters fits every parent before its children.
+    :param grid: array, systematic grid as from wfc3_systematic_model_grid_selection(), 0 for a free parameter
+    :return: parents: array of int, index of the parent of each model, -1 for a model without one
+    """
+    free = np.asarray(grid) == 0
+    nfree = np.count_nonzero(free, axis=1)
+    parents = np.full(len(free), -1)
+    for i in range(len(free)):
+        nested = np.all(free <= free[i], axis=1) & (nfree < nfree[i])
+        if np.any(nested):
+            candidates = np.flatnonzero(nested)
+            parents[i] = candidates[np.argmax(nfree[candidates])]
+    return parents
+
+
+def nesting_neighbours(grid):
+    """
+    Neighbours of every systematic model in the nesting lattice of a grid, the models that are nested in it or that it
+    is nested in with exactly one free parameter more or less.
+    :param grid: array, systematic grid as from wfc3_systematic_model_grid_selection(), 0 for a free parameter
+    :return: neighbours: array of bool of shape (number of models, number of models), True for neighbours
+    """
+    free = np.asarray(grid) == 0
+    nfree = np.count_nonzero(free, axis=1)
+    nested = np.all(free[:, np.newaxis, :] <= free[np.newaxis, :, :], axis=2)   # row nested in column
+    return (nested | nested.T) & (np.abs(nfree[:, np.newaxis] - nfree[np.newaxis, :]) == 1)
+
+
+def aic_lower_bounds(grid, aic, fitted):
+    """
+    Lower bounds on the AIC of the systematic models from the models that were fitted.
+
+    Freeing more parameters can only lower chi squared at the best fit, so a model has at least the chi squared of
+    every fitted model it is nested in, and its AIC is at least the largest of these plus its own number of free
+    parameters. This holds as long as the fits find their global minimum.
+    :param grid: array, systematic grid as from wfc3_systematic_model_grid_selection(), 0 for a free parameter
+    :param aic: array, AIC of every model (chi squared plus the number of free parameters), ignored where not fitted
+    :param fitted: array of bool, which models were fitted
+    :return: bounds: array, the AIC of the fitted models and a lower bound for the others, their number of free
+             parameters if they are not nested in any fitted model
+    """
+    free = np.asarray(grid) == 0
+    nfree = np.count_nonzero(free, axis=1)
+    fitted = np.asarray(fitted, dtype=bool)
+    aic = np.asarray(aic, dtype=float)
+    bounds = nfree.astype(float)
+    for i in np.flatnonzero(~fitted):
+        supersets = fitted & np.all(free[i] <= free, axis=1)
+        if np.any(supersets):
+            bounds[i] += np.max(aic[supersets] - nfree[supersets])
+    bounds[fitted] = aic[fitted]
+    return bounds
+
+
+def unexplored_weight(grid, aic, fitted):
+    """
+    Upper bound on the share of the marginalisation weight exp(-AIC/2) of all models that falls on the models that
+    were not fitted, from their lower AIC bounds, see aic_lower_bounds().
+    :param grid: array, systematic grid as from wfc3_systematic_model_grid_selection(), 0 for a free parameter
+    :param aic: array, AIC of every model, ignored where not fitted
+    :param fitted: array of bool, which models were fitted; at least one
+    :return: float between 0 and 1
+    """
+    fitted = np.asarray(fitted, dtype=bool)
+    bounds = aic_lower_bounds(grid, aic, fitted)
+    best = np.min(bounds[fitted])
+    weights = np.exp(-0.5 * (bounds - best))
+    unexplored = np.sum(weights[~fitted])
+    return unexplored / (np.sum(weights[fitted]) + unexplored)
+
+
+def prune_models(aic, weight=0., delta_aic=0.):
+    """
+    Systematic models that are left out of the marginalisation because of their AIC.
+
+    The weight of a model is exp(-AIC/2), normalised over all models, as in the marginalisation. A model is pruned if
+    its weight is below weight, or if its AIC is more than delta_aic above the best one. Pruning by weight compares
+    against the sum of all weights, by delta_aic against the best model only, so the second does not depend on how many
+    models are similar.
+    :param aic: array, AIC of every model (chi squared plus the number of free parameters)
+    :param weight: float, default=0; weight below which a model is pruned, 0 to not prune by weight
+    :param delta_aic: float, default=0; AIC difference to the best model above which a model is pruned, 0 to not prune
+                      by AIC difference
+    :return: pruned: array of bool, True for the pruned models
+    """
+    aic = np.asarray(aic, dtype=float)
+    delta = aic - np.min(aic)
+    weights = np.exp(-0.5 * delta) / np.sum(np.exp(-0.5 * delta))
+
+    pruned = np.zeros(aic.shape, dtype=bool)
+    if weight > 0:
+        pruned |= weights < weight
+    if delta_aic > 0:
+        pruned |= delta > delta_aic
+    return pruned
+
+
 def marginalisation(array, error, weight):
     """
     Marginalisation of the parameter array.
@@ -405,22 +1640,52 @@ def marginalisation(array, error, weight):
 
 
 @u.quantity_input(period=u.s, incl=u.rad)
-def impact_param(period, msmpr, phase, incl):
+def impact_param(period, msmpr, phase, incl, use_numba=False):
     """
     Calculate impact parameter.
     :param period: float, period in seconds
     :param msmpr: float, MsMpR
     :param phase: array, phase
     :param incl: float, inclination in radians
+    :param use_numba: bool, default=False; whether the Numba-compiled kernel is used for a plain float msmpr
     """
 
+    if isinstance(period, u.Quantity) and not isinstance(msmpr, u.Quantity):
+        # Thin wrapper around the unit-free calculation, the result keeps the units G gives it
+        if isinstance(phase, u.Quantity):
+            phase = phase.to_value(u.dimensionless_unscaled)
+        b0 = _impact_param_values(period.to_value(u.s), msmpr, np.asarray(phase, dtype=float), u.Quantity(incl, u.rad).value,
+                                  use_numba)
+        return b0 * (G.unit * u.s ** 2) ** (1 / 3.)
+
     b0 = (G * period * period / (4 * np.pi * np.pi)) ** (1 / 3.) * (msmpr ** (1 / 3.)) * np.sqrt(
          (np.sin(phase * 2 * np.pi * u.rad)) ** 2 + (np.cos(incl) * np.cos(phase * 2 * np.pi * u.rad)) ** 2)
 
     return b0
 
 
-def sys_model(phase, hst_phase, sh, m_fac, hstp1, hstp2, hstp3, hstp4, xshift1, xshift2, xshift3, xshift4):
+def _impact_param_values(period, msmpr, phase, incl, use_numba=False):
+    """
+    Unit-free impact_param().
+    :param period: float, period in seconds
+    :param msmpr: float, MsMpR in SI units
+    :param phase: array, phase
+    :param incl: float, inclination in radians
+    :param use_numba: bool, default=False; whether the Numba-compiled kernel is used
+    :return: b0: array, impact parameter in stellar radii
+    """
+    if use_numba:
+        return jit_kernels.impact_param(float(period), float(msmpr), np.atleast_1d(phase), float(incl),
+                                        G_SI).reshape(np.shape(phase))
+
+    b0 = (G_SI * period * period / (4 * np.pi * np.pi)) ** (1 / 3.) * (msmpr ** (1 / 3.)) * np.sqrt(
+         (np.sin(phase * 2 * np.pi)) ** 2 + (np.cos(incl) * np.cos(phase * 2 * np.pi)) ** 2)
+
+    return b0
+
+
+def sys_model(phase, hst_phase, sh, m_fac, hstp1, hstp2, hstp3, hstp4, xshift1, xshift2, xshift3, xshift4,
+              use_numba=False):
     """
     Systematic model for WFC3 data.
     :param phase:
@@ -435,9 +1700,22 @@ def sys_model(phase, hst_phase, sh, m_fac, hstp1, hstp2, hstp3, hstp4, xshift1,
     :param xshift2:
     :param xshift3:
     :param xshift4:
+    :param use_numba: bool, default=False; whether the Numba-compiled kernel is used
     :return:
     """
 
+    if use_numba:
+        arrays = [phase, hst_phase, sh]
+        is_quantity = any(isinstance(array, u.Quantity) for array in arrays)
+        arrays = [array.to_value(u.dimensionless_unscaled) if isinstance(array, u.Quantity) else array
+                  for array in arrays]
+        arrays = [np.atleast_1d(np.asarray(array, dtype=float)) for array in arrays]
+        shape = np.broadcast_shapes(*[array.shape for array in arrays])
+        sys_m = jit_kernels.sys_model(*[np.broadcast_to(array, shape).ravel() for array in arrays], float(m_fac),
+                                      float(hstp1), float(hstp2), float(hstp3), float(hstp4), float(xshift1),
+                                      float(xshift2), float(xshift3), float(xshift4)).reshape(shape)
+        return u.Quantity(sys_m) if is_quantity else sys_m
+
     sys_m = (phase * m_fac + 1.0) * (
             hst_phase * hstp1 + hst_phase ** 2. * hstp2 + hst_phase ** 3. * hstp3 + hst_phase ** 4. * hstp4 + 1.0) * (
                     sh * xshift1 + sh ** 2. * xshift2 + sh ** 3. * xshift3 + sh ** 4. * xshift4 + 1.0)
@@ -445,16 +1723,76 @@ def sys_model(phase, hst_phase, sh, m_fac, hstp1, hstp2, hstp3, hstp4, xshift1,
     return sys_m
 
 
+def linear_scale(unit_model, y, weights):
+    """
+    Weighted least-squares solution for the scale of a model that is linear in it, like flux0.
+    :param unit_model: array, model for a scale of 1; several models along the first axes get a scale each
+    :param y: array, data
+    :param weights: array, weights of the data points, 1 / error^2
+    :return: float or array, scale minimising sum(weights * (y - scale * unit_model)^2)
+    """
+    return np.sum(weights * y * unit_model, axis=-1) / np.sum(weights * unit_model ** 2, axis=-1)
+
+
+def polynomial_basis(values, degree=4):
+    """
+    Powers 1 ... degree of the input, as the rows of a contiguous matrix. The polynomial factors of the systematic
+    model are then a product of this basis with the vector of their coefficients, see sys_model_basis().
+    :param values: array, e.g. HST phase or shifts; None stands for all zeros
+    :param degree: int, default=4; highest power
+    :return: array of shape (degree, len(values))
+    """
+    if values is None:
+        return None
+    if isinstance(values, u.Quantity):
+        values = values.value
+    values = np.asarray(values, dtype=float)
+    return np.ascontiguousarray([values ** power for power in range(1, degree + 1)])
+
+
+def sys_model_basis(phase, hst_basis, shift_basis, m_fac, hstp, xshift):
+    """
+    Systematic model for WFC3 data, see sys_model(), on precomputed polynomial bases of the HST phase and the shifts.
+    :param phase: array, planetary phase
+    :param hst_basis: array, polynomial_basis() of the HST phase
+    :param shift_basis: array, polynomial_basis() of the shifts; None means no shifts
+    :param m_fac: float, slope factor
+    :param hstp: sequence of the four HST phase coefficients hstp1 ... hstp4
+    :param xshift: sequence of the four shift coefficients xshift1 ... xshift4
+    :return: sys_m: array
+    """
+    sys_m = (phase * m_fac + 1.0) * _polynomial_factor(hstp, hst_basis)
+    if shift_basis is not None:
+        sys_m = sys_m * _polynomial_factor(xshift, shift_basis)
+
+    return sys_m
+
+
+def _polynomial_factor(coeffs, basis):
+    """
+    One polynomial factor of the systematic model, 1 + sum_k coeffs[k] * basis[k].
+    :param coeffs: sequence of the coefficients of the powers 1 ... degree
+    :param basis: array, polynomial_basis() of the variable
+    :return: array
+    """
+    return np.dot(np.asarray(coeffs, dtype=float), basis) + 1.0
+
+
 @u.quantity_input(period=u.d)
-def phase_calc(data, epoch, period):
+def phase_calc(data, epoch, period, use_numba=False):
     """
     Convert time array data in terms of phase, with a period, centered on epoch.
     :param data: time array in days (MJD)
     :param epoch: center of period, same unit like data array
     :param period: phase period in days
+    :param use_numba: bool, default=False; whether the Numba-compiled kernel is used if data and epoch are Quantities
     :return: phase: array
     """
 
+    if isinstance(data, u.Quantity) and isinstance(epoch, u.Quantity):
+        # Thin wrapper around the unit-free calculation
+        return u.Quantity(_phase_values(data.to_value(u.d), epoch.to_value(u.d), period.to_value(u.d), use_numba))
+
     phase1 = (data - epoch) / period     # the data point at time "epoch" will be the zero-point; convert int phase by division through period
     phase2 = np.floor(phase1)            # identify integer intervals of phase (where phase is between 0-1, between 1-2, between 2-3 and over 3)
     phase = phase1 - phase2              # make phase be in interval from 0 to 1
@@ -465,6 +1803,26 @@ def phase_calc(data, epoch, period):
     return phase
 
 
+def _phase_values(data, epoch, period, use_numba=False):
+    """
+    Unit-free phase_calc().
+    :param data: array, times in days
+    :param epoch: float, center of period in days
+    :param period: float, phase period in days
+    :param use_numba: bool, default=False; whether the Numba-compiled kernel is used
+    :return: phase: array, in the interval [-0.5, 0.5]
+    """
+    data = np.asarray(data, dtype=float)
+    if use_numba:
+        return jit_kernels.phase_calc(np.atleast_1d(data), float(epoch), float(period)).reshape(data.shape)
+
+    phase1 = (data - epoch) / period
+    phase = np.atleast_1d(phase1 - np.floor(phase1))
+    phase[phase > 0.5] -= 1.0
+
+    return phase.reshape(data.shape)
+
+
 def create_pdf_report(template_vars, outfile):
 
     # Create Jinja environment and get template
@@ -487,6 +1845,49 @@ def calc_sdnr(residuals):
     return sdnr
 
 
+def orbit_bins(x, bin_size, gap=None):
+    """
+    Bins of consecutive exposures that never reach across the gap between two HST orbits.
+
+    A new orbit starts wherever the time between two exposures is longer than gap, and every orbit is split into bins
+    of as equal a size as possible, close to bin_size exposures each.
+    :param x: array, sorted times of the exposures in days
+    :param bin_size: int, number of exposures per bin
+    :param gap: float, time between exposures in days above which a new orbit starts; a quarter of the HST period
+                from the configfile if None
+    :return: bins: array of int, bin number of every exposure
+    """
+    if gap is None:
+        gap = 0.25 * CONFIG_INI.getfloat('constants', 'HST_period')
+    orbits = np.split(np.arange(np.size(x)), np.flatnonzero(np.diff(x) > gap) + 1)
+    bins = np.zeros(np.size(x), dtype=int)
+    nbins = 0
+    for orbit in orbits:
+        for chunk in np.array_split(orbit, max(1, int(round(orbit.size / bin_size)))):
+            bins[chunk] = nbins
+            nbins += 1
+    return bins
+
+
+def bin_light_curve(x, y, err, sh, bins):
+    """
+    Weighted means of a light curve over bins, with the errors propagated from err.
+    :param x: array, times of the exposures
+    :param y: array, flux
+    :param err: array, error on the flux
+    :param sh: array, shifts of the spectra, or None
+    :param bins: array of int, bin number of every exposure, see orbit_bins()
+    :return: x, y, err, sh of the bins; the error of a bin is 1 / sqrt(sum(1 / err^2)), sh is None if it was None
+    """
+    weights = 1. / np.square(err)
+    total = np.bincount(bins, weights)
+
+    def mean(values):
+        return np.bincount(bins, weights * values) / total
+
+    return mean(x), mean(y), 1. / np.sqrt(total), None if sh is None else mean(sh)
+
+
 def noise_calculator(data, maxnbins=None, binstep=1):
     """
     Calculate the noise parameters of the data by using the residuals of the fit
@@ -0,0 +1,131 @@
+"""
+Internal coordinates the optimisers fit the transit parameters in.
+
+The physical parameters of the transit model are badly scaled for an optimiser: the epoch is an absolute MJD near
+57957.97 that moves by minutes, the density msmpr is of order 10^3, and the systematic coefficients multiply bases of
+very different size. A relative finite-difference step like LevMar's then perturbs the epoch by far too much and the
+coefficients by far too little. Reparameterised runs any Sherpa optimiser on internal coordinates instead: the epoch
+offset from tzero in units of the period, log(msmpr), cot(inclin), which like the impact parameter is linear in
+cos(inclin) near 90 degrees, and systematic coefficients scaled by the RMS of their basis. The best fit and the
+covariance matrix are mapped back, so the fit results are in physical parameters as before.
+"""
+
+import numpy as np
+from sherpa.optmethods import OptMethod
+
+from exoticism.least_squares import HUGE
+from exoticism.margmodule import _phase_values
+
+
+class Linear(object):
+    """Internal coordinate u of a parameter p = offset + scale * u."""
+
+    def __init__(self, offset=0., scale=1.):
+        self.offset = offset
+        self.scale = scale
+
+    def internal(self, p):
+        return (p - self.offset) / self.scale
+
+    def physical(self, u):
+        return self.offset + self.scale * u
+
+    def derivative(self, u):
+        return self.scale
+
+
+class Log(object):
+    """Internal coordinate u = log(p) of a positive parameter p."""
+
+    def internal(self, p):
+        return np.log(p)
+
+    def physical(self, u):
+        return np.exp(u)
+
+    def derivative(self, u):
+        return np.exp(u)
+
+
+class Cot(object):
+    """Internal coordinate u = cot(p) of an angle p between 0 and pi, e.g. the inclination."""
+
+    def internal(self, p):
+        return np.cos(p) / np.sin(p)
+
+    def physical(self, u):
+        return np.arctan2(1., u)
+
+    def derivative(self, u):
+        return -1. / (1. + u * u)
+
+
+def transit_transforms(tmodel, x):
+    """
+    Internal coordinates of the parameters of a Transit model fit to the time grid x.
+    :param tmodel: margmodule.Transit, with the input parameter values
+    :param x: array, time grid in days (MJD) the model is fit on
+    :return: dict of the transforms by parameter name; the other parameters are fit as they are
+    """
+    x = np.asarray(x, dtype=float)
+    period = tmodel.period.val
+    transforms = {'epoch': Linear(tmodel.tzero.val, period), 'msmpr': Log(), 'inclin': Cot()}
+
+    def rms(values):
+        scale = np.sqrt(np.mean(np.square(values)))
+        return scale if scale > 0 else 1.
+
+    phase = x if tmodel.x_in_phase else _phase_values(x, tmodel.epoch.val, period, tmodel.use_numba)
+    transforms['m_fac'] = Linear(0., 1. / rms(phase))
+    for k, basis in enumerate(tmodel.hst_basis(x)):
+        transforms['hstp{}'.format(k + 1)] = Linear(0., 1. / rms(basis))
+    if tmodel.shift_basis is not None:
+        for k, basis in enumerate(tmodel.shift_basis):
+            transforms['xshift{}'.format(k + 1)] = Linear(0., 1. / rms(basis))
+    return transforms
+
+
+class Reparameterised(OptMethod):
+    """Sherpa optimiser running another one on internal coordinates of the thawed parameters.
+
+    Set transforms to one transform (or None to fit a parameter as it is) per thawed parameter before every fit. A
+    Jacobian function in the configuration of the wrapped optimiser (see least_squares.LeastSquares) is taken in
+    physical parameters and mapped with the chain rule, and the covariance matrix the optimiser returns is mapped
+    back to physical parameters. Transformed parameters are fit without limits."""
+
+    def __init__(self, method):
+        self.method = method
+        self.transforms = []
+        OptMethod.__init__(self, method.name, method._optfunc)
+        self.config = method.config   # one configuration, shared with the wrapped optimiser
+
+    def fit(self, statfunc, pars, parmins, parmaxes, statargs=(), statkwargs=None):
+        transforms = list(self.transforms) + [None] * (len(pars) - len(self.transforms))
+        if statkwargs is None:
+            statkwargs = {}
+
+        def physical(values):
+            return np.array([value if t is None else t.physical(value) for t, value in zip(transforms, values)])
+
+        def derivative(values):
+            return np.array([1. if t is None else t.derivative(value) for t, value in zip(transforms, values)])
+
+        start = [value if t is None else t.internal(value) for t, value in zip(transforms, pars)]
+        mins = [low if t is None else -HUGE for t, low in zip(transforms, parmins)]
+        maxes = [high if t is None else HUGE for t, high in zip(transforms, parmaxes)]
+
+        def cb(values):
+            return statfunc(physical(values), *statargs, **statkwargs)
+
+        config = dict(self.config)
+        if config.get('jac') is not None:
+            jac = config['jac']
+            config['jac'] = lambda values: jac(physical(values)) * derivative(values)
+
+        success, best, statval, message, extra = self._optfunc(cb, start, mins, maxes, **config)
+        best = np.asarray(best, dtype=float).ravel()
+        if extra.get('covar') is not None:
+            scale = derivative(best)
+            extra['covar'] = extra['covar'] * np.outer(scale, scale)
+
+        return success, physical(best), statval, message, extra
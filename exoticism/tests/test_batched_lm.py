@@ -0,0 +1,31 @@
+import numpy as np
+
+from exoticism.batched_lm import lockstep_lm
+
+
+def test_lockstep_lm():
+    """ Check lockstep fits of a stack of polynomials with different free coefficients against linear least squares. """
+
+    rng = np.random.default_rng(5)
+    x = np.linspace(-1, 1, 100)
+    basis = np.array([np.ones_like(x), x, x ** 2, np.exp(x)])
+    y = 1 + 0.5 * x - 2 * x ** 2 + rng.normal(0, 0.05, x.size)
+    err = 0.05
+
+    free = np.array([[1, 1, 0, 0], [1, 1, 1, 0], [1, 0, 1, 1], [1, 1, 1, 1]], dtype=bool)
+    x0 = rng.normal(0, 0.1, free.shape)
+
+    def residuals(pars, rows):
+        return (pars @ basis - y) / err
+
+    def jacobian(pars, rows):
+        return np.broadcast_to(basis / err, (len(rows),) + basis.shape)
+
+    results = lockstep_lm(residuals, jacobian, x0, free)
+    for row, start, result in zip(free, x0, results):
+        assert result['success']
+        expected = start.copy()
+        expected[row] = np.linalg.lstsq(basis[row].T, y - start[~row] @ basis[~row], rcond=None)[0]
+        assert np.allclose(result['x'], expected, rtol=1e-6, atol=1e-8)
+        assert np.isclose(result['fval'], np.sum(residuals(result['x'], [0]) ** 2), rtol=1e-12)
+        assert np.allclose(result['covar'], np.linalg.inv(basis[row] @ basis[row].T / err ** 2), rtol=1e-6)
@@ -1,7 +1,7 @@
 from exoticism.config import CONFIG_INI
 
 
-STANDARD_SECTIONS = ['data_paths', 'setup', 'smooth_model', 'W17', 'simple_transit', 'constants']
+STANDARD_SECTIONS = ['data_paths', 'setup', 'smooth_model', 'transit_model', 'W17', 'simple_transit', 'constants']
 
 
 def test_main_sections():
@@ -23,7 +23,11 @@ def test_data_paths():
 def test_setup():
     """ Check that all required setup keys exist. """
 
-    setup_keys = ['data_set', 'instrument', 'grating', 'grid_selection', 'ld_model', 'plotting', 'report']
+    setup_keys = ['data_set', 'instrument', 'grating', 'grid_selection', 'ld_model', 'plotting', 'report',
+                  'optimizer', 'profile_flux0', 'warm_start', 'prune_weight', 'prune_delta_aic', 'workers',
+                  'executor', 'search', 'search_beam', 'search_tolerance',
+                  'approximate', 'approx_tolerance', 'first_fit_bin_size', 'reparameterise',
+                  'multi_start', 'multi_start_scale', 'multi_start_tolerance', 'multi_start_cancel']
     for key in setup_keys:
         assert CONFIG_INI.has_option('setup', key)
 
@@ -31,11 +35,22 @@ def test_setup():
 def test_smooth_model():
     """ Check that all keys for smooth model exist. """
 
-    smooth_keys = ['resolution', 'half_range']
+    smooth_keys = ['resolution', 'half_range', 'ld_engine']
     for key in smooth_keys:
         assert CONFIG_INI.has_option('smooth_model', key)
 
 
+def test_transit_model():
+    """ Check that all keys for the transit model kernel exist. """
+
+    transit_keys = ['ld_engine', 'analytic_order', 'table_rl_min', 'table_rl_max', 'table_tolerance',
+                    'quadrature_rtol', 'quadrature_atol', 'batched', 'memory_budget', 'per_point',
+                    'use_numba', 'chunk_size', 'threads', 'exposure_time', 'supersample',
+                    'transit_window']
+    for key in transit_keys:
+        assert CONFIG_INI.has_option('transit_model', key)
+
+
 def test_constants():
     """ Check that all keys for constants exist. """
 
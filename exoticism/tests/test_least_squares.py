@@ -0,0 +1,61 @@
+import numpy as np
+from sherpa.data import Data1D
+from sherpa.fit import Fit
+from sherpa.models.basic import Polynom1D
+from sherpa.optmethods import LevMar
+from sherpa.stats import Chi2
+
+from exoticism.least_squares import LeastSquares, covariance, linearised_fit
+
+
+def test_least_squares():
+    """ Check the LeastSquares optimiser and its covariance matrix against LevMar on a polynomial fit. """
+
+    x = np.linspace(-1, 1, 200)
+    y = 1 + 0.5 * x - 2 * x ** 2 + np.random.default_rng(3).normal(0, 0.05, x.size)
+    err = np.full(x.size, 0.05)
+
+    results = []
+    for opt in [LevMar(), LeastSquares()]:
+        poly = Polynom1D()
+        poly.c1.thaw()
+        poly.c2.thaw()
+        if isinstance(opt, LeastSquares):
+            opt.config['jac'] = lambda pars: np.array([np.ones_like(x), x, x ** 2]).T / err[:, np.newaxis]
+        res = Fit(Data1D('poly', x, y, staterror=err), poly, stat=Chi2(), method=opt).fit()
+        assert res.succeeded
+        results.append((res.parvals, res.statval, res.extra_output['covar']))
+
+    (levmar_pars, levmar_stat, levmar_covar), (lsq_pars, lsq_stat, lsq_covar) = results
+    assert np.allclose(lsq_pars, levmar_pars, rtol=1e-6)
+    assert np.isclose(lsq_stat, levmar_stat, rtol=1e-9)
+    assert np.allclose(lsq_covar, levmar_covar, rtol=1e-4)
+
+
+def test_covariance():
+    """ Check that the covariance drops parameters the residuals do not depend on. """
+
+    jac = np.random.default_rng(4).normal(size=(50, 3))
+    assert np.allclose(covariance(jac), np.linalg.inv(jac.T @ jac))
+
+    jac[:, 1] = 0.
+    covar = covariance(jac)
+    assert covar[1, 1] == 0 and np.all(np.isfinite(covar))
+
+
+def test_linearised_fit():
+    """ Check that the linearised fit of a linear problem with a fixed parameter is its exact least-squares fit. """
+
+    rng = np.random.default_rng(8)
+    basis = rng.normal(size=(60, 4))
+    y = basis @ [1., -2., 0.5, 3.] + rng.normal(0, 0.1, 60)
+    point = np.linalg.lstsq(basis, y, rcond=None)[0]
+    free = np.array([True, True, False, True])
+    fixed = np.array([0., 0., 0.2, 0.])
+
+    step, predicted, covar = linearised_fit(basis, basis @ point - y, free, fixed - point)
+    expected = fixed.copy()
+    expected[free] = np.linalg.lstsq(basis[:, free], y - basis[:, ~free] @ fixed[~free], rcond=None)[0]
+    assert np.allclose(point + step, expected)
+    assert np.isclose(predicted, np.sum((basis @ expected - y) ** 2))
+    assert np.allclose(covar, np.linalg.inv(basis[:, free].T @ basis[:, free]))
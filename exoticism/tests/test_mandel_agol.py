@@ -0,0 +1,47 @@
+import numpy as np
+
+import exoticism.margmodule as marg
+from exoticism.mandel_agol import occultnl_analytic, occultnl_quadrature, occultquad, _integrated_deficits
+
+
+def test_occultnl_analytic():
+    """ Check the analytic engine against the numerical occultnl integration and its own quadrature. """
+
+    b0 = np.linspace(0., 1.3, 300)
+    for rl in [0.01, 0.12169, 0.5]:
+        mulimb0, mulimbf = marg.occultnl(rl, 0.48, 0.11, 0.03, -0.06, b0)
+        mulimb0_analytic, mulimbf_analytic = occultnl_analytic(rl, 0.48, 0.11, 0.03, -0.06, b0)
+        assert np.allclose(mulimb0_analytic, mulimb0, rtol=0, atol=1e-4)
+        # occultnl only converges on the combined model, its components are less accurate for large planets
+        assert np.allclose(mulimbf_analytic, mulimbf, rtol=0, atol=1e-3)
+
+        # The closed-form integer-power components have to agree with a high-order quadrature of the same integrals
+        p, z = np.broadcast_arrays(rl, b0)
+        integrated = _integrated_deficits((2, 4), p, z, 60)
+        assert np.allclose(mulimbf_analytic[2::2], 4. / np.array([[6.], [8.]]) - integrated, rtol=0, atol=1e-8)
+
+        # The quadratic law is a special case of the nonlinear law
+        assert np.allclose(occultquad(rl, 0.3, 0.2, b0)[0], marg.occultnl(rl, 0, 0.7, 0, -0.2, b0)[0], rtol=0,
+                           atol=1e-4)
+
+def test_limb_darkened_transit():
+    """ Check the engine dispatch of limb_darkened_transit(). """
+
+    b0 = np.linspace(0., 1.3, 50)
+    reference, _ = marg.occultnl(0.12169, 0.48, 0.11, 0.03, -0.06, b0)
+    for engine in marg.LD_ENGINES:
+        mulimb0, _ = marg.limb_darkened_transit(0.12169, 0.48, 0.11, 0.03, -0.06, b0, engine)
+        assert np.allclose(mulimb0, reference, rtol=0, atol=1e-4)
+
+
+def test_occultnl_quadrature():
+    """ Check that the error-controlled quadrature meets its tolerance and that its error estimate is an upper bound. """
+
+    b0 = np.linspace(0., 1.3, 300)
+    for rl in [0.01, 0.12169, 0.5]:
+        reference, _ = occultnl_analytic(rl, 0.48, 0.11, 0.03, -0.06, b0, order=60)
+        for rtol in [1e-4, 1e-8]:
+            mulimb0, _mulimbf, error = occultnl_quadrature(rl, 0.48, 0.11, 0.03, -0.06, b0, rtol=rtol, atol=1e-12,
+                                                           return_error=True)
+            assert np.all(np.abs(mulimb0 - reference) <= error + 1e-12)
+            assert np.all(error <= np.maximum(1e-12, rtol * (1 - mulimb0)) + 1e-15)
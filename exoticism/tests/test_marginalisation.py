@@ -1,11 +1,25 @@
 import csv
 import glob
+import inspect
 import os
+import astropy.units as u
 import numpy as np
 
 from exoticism.config import CONFIG_INI
-from exoticism.margmodule import find_data_parent
-from exoticism.marginalisation import total_marg
+from exoticism.margmodule import find_data_parent, nested_parents, wfc3_systematic_model_grid_selection
+from exoticism.marginalisation import total_marg, approximate_grid, first_fit, full_fit, map_grid, multi_start_grid, \
+    search_grid, GridFitter
+
+
+def w17_fitter_args(optimizer='least_squares', profile_flux0=True, reparameterise=False):
+    """GridFitter arguments for the W17 light curve with fixed limb darkening coefficients, as the tuple that the grid
+    functions pass on to the GridFitter of every worker."""
+    data_dir = find_data_parent('data')
+    get_timeseries = CONFIG_INI.get('W17', 'lightcurve_file')
+    x, y, err, sh = np.loadtxt(os.path.join(data_dir, 'data', 'W17', get_timeseries), skiprows=7, unpack=True)
+    return inspect.signature(GridFitter).bind(x, y, err, sh, tzero=x[0] * u.d, msmpr=1800., c1=0.48, c2=0.11,
+                                              c3=0.03, c4=-0.06, flux0=y[0], optimizer=optimizer,
+                                              profile_flux0=profile_flux0, reparameterise=reparameterise).args
 
 
 def test_marginalisation_w17_fit_time():
@@ -80,3 +94,94 @@ def test_marginalisation_w17_fit_time():
     assert np.isclose(float(output_dict['white_noise']), 0.00017134399252019425, rtol=1e-9), 'white_noise value is off'
     assert np.isclose(float(output_dict['red_noise']), 2.9945171057075465e-5, rtol=1e-9), 'red_noise value is off'
     assert np.isclose(float(output_dict['beta']), 1.1389386251150133, rtol=1e-4), 'beta value is off'
+
+
+def test_map_grid_workers():
+    """Test that fitting the systematic grid in worker processes or threads gives the same results as fitting it serially,
+    also when the fits start from the results of their nested parents."""
+
+    grid = wfc3_systematic_model_grid_selection('fit_time')[[0, 1, 5, 6, 24, 49]]
+    parents = nested_parents(grid)
+
+    fitter_args = w17_fitter_args(optimizer=CONFIG_INI.get('setup', 'optimizer'),
+                                  profile_flux0=CONFIG_INI.getboolean('setup', 'profile_flux0'))
+    serial = list(map_grid(first_fit, grid, 1, fitter_args, parents=parents))
+    for executor in ['process', 'thread']:
+        parallel = list(map_grid(first_fit, grid, 2, fitter_args, executor=executor, parents=parents))
+
+        for one, two in zip(serial, parallel):
+            assert np.array_equal(one['params'], two['params']), f'parameters differ between serial and {executor} fits'
+            assert one['rl_err'] == two['rl_err'], f'rl errors differ between serial and {executor} fits'
+
+
+def test_map_grid_batched():
+    """Test that fitting the systematic grid in lockstep finds the same minima as fitting one row after the other."""
+
+    grid = wfc3_systematic_model_grid_selection('fit_time')[[0, 1, 5, 6, 24, 49]]
+    parents = nested_parents(grid)
+
+    serial = list(map_grid(first_fit, grid, 1, w17_fitter_args(optimizer='least_squares'), parents=parents))
+    batched = list(map_grid(first_fit, grid, 1, w17_fitter_args(optimizer='batched_lm'), parents=parents))
+
+    for one, two in zip(serial, batched):
+        assert two['succeeded']
+        assert np.isclose(one['AIC'], two['AIC'], rtol=0, atol=1e-3)
+        assert np.isclose(one['params'][0], two['params'][0], rtol=1e-5)
+
+
+def test_search_grid():
+    """Test that the adaptive search leaves out no more weight than its bound and fits the same models as the
+    exhaustive one."""
+
+    grid = wfc3_systematic_model_grid_selection('fit_time')
+
+    fitter_args = w17_fitter_args(optimizer='least_squares')
+    full = list(map_grid(first_fit, grid, 1, fitter_args, parents=nested_parents(grid)))
+    aic = np.array([result['AIC'] for result in full])
+    weights = np.exp(-0.5 * (aic - np.min(aic)))
+    weights /= np.sum(weights)
+
+    results, unexplored = search_grid(grid, 1, fitter_args, tolerance=1e-3)
+    searched = np.array([result is not None for result in results])
+    assert 0 < np.count_nonzero(searched) < len(grid)
+    assert unexplored <= 1e-3
+    assert np.sum(weights[~searched]) <= unexplored
+    for result, expected in zip(results, aic):
+        if result is not None:
+            assert np.isclose(result['AIC'], expected, rtol=0, atol=1e-3)
+
+
+def test_approximate_grid():
+    """Test that the linearised fits of the systematic grid agree with the full fits."""
+
+    grid = wfc3_systematic_model_grid_selection('fix_time')
+
+    fitter_args = w17_fitter_args(optimizer='least_squares')
+    full = list(map_grid(first_fit, grid, 1, fitter_args, parents=nested_parents(grid)))
+    solutions, refitted = approximate_grid(grid, 1, fitter_args, tolerance=0.5)
+    assert refitted[-1] and np.count_nonzero(refitted) < len(grid)
+
+    for system, one, solution in zip(grid, full, solutions):
+        chi2 = one['AIC'] - np.count_nonzero(system == 0)
+        assert np.isclose(solution['fval'], chi2, rtol=0, atol=0.5)
+        assert np.isclose(solution['x'][0], one['params'][0], rtol=1e-4)
+
+
+def test_multi_start_grid():
+    """Test that fitting from several starts never ends up above the single start, and that the starts that are taken
+    do not depend on the number of workers."""
+
+    grid = wfc3_systematic_model_grid_selection('fit_time')[[0, 6, 24, 49]]
+
+    fitter_args = w17_fitter_args(optimizer='least_squares')
+    single = [full_fit(GridFitter(*fitter_args), system) for system in grid]
+    serial, serial_stats = multi_start_grid(grid, 1, fitter_args, num_starts=3)
+    parallel, parallel_stats = multi_start_grid(grid, 2, fitter_args, executor='thread', num_starts=3)
+
+    for one, many, two in zip(single, serial, parallel):
+        assert many['fval'] <= one['fval'] + 1e-6
+        assert np.array_equal(many['x'], two['x'])
+    for key in serial_stats:
+        assert np.array_equal(serial_stats[key], parallel_stats[key])
+    assert np.all(serial_stats['fitted'] + serial_stats['cancelled'] == 3)
+    assert np.all(serial_stats['improvement'] >= 0)
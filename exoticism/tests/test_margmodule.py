@@ -1,10 +1,15 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+import pytest
 import astropy.units as u
+from sherpa.data import Data1D
 from astropy.constants import G
 
 from exoticism.config import CONFIG_INI
 import exoticism.margmodule as marg
+from exoticism import jit_kernels
+from exoticism.mandel_agol import occultnl_quadrature
 
 
 # Find the local path of the repository so that we can access the data
@@ -53,3 +58,453 @@ def test_wfc3_systematic_model_grid_selection():
     for selec in ['fix_time', 'fit_time', 'fit_inclin', 'fit_msmpr', 'fit_ecc', 'fit_all']:
         full_grid = marg.wfc3_systematic_model_grid_selection(selec)
         assert full_grid.shape == (50, 22)
+
+
+def test_nested_parents():
+    """ Check that every systematic model has a nested parent with one free parameter less, except the first one. """
+
+    grid = marg.wfc3_systematic_model_grid_selection('fit_time')
+    parents = marg.nested_parents(grid)
+    free = grid == 0
+
+    assert parents[0] == -1 and np.all(parents[1:] >= 0)
+    for i, parent in enumerate(parents[1:], start=1):
+        assert np.all(free[parent] <= free[i])
+        assert np.count_nonzero(free[i]) - np.count_nonzero(free[parent]) == 1
+
+
+def test_prune_models():
+    """ Check pruning of systematic models by weight and by AIC difference. """
+
+    aic = np.array([10., 12., 30., 11.])
+    weights = np.exp(-0.5 * (aic - 10)) / np.sum(np.exp(-0.5 * (aic - 10)))
+
+    assert not np.any(marg.prune_models(aic))
+    assert np.array_equal(marg.prune_models(aic, weight=1e-3), weights < 1e-3)
+    assert np.array_equal(marg.prune_models(aic, delta_aic=1.5), [False, True, True, False])
+    assert np.array_equal(marg.prune_models(aic, weight=1e-3, delta_aic=1.5), [False, True, True, False])
+
+
+def test_aic_lower_bounds():
+    """ Check that the AIC bounds of the models that are not fitted hold for chi squared values that decrease with
+    every freed parameter. """
+
+    grid = marg.wfc3_systematic_model_grid_selection('fit_time')
+    free = grid == 0
+    nfree = np.count_nonzero(free, axis=1)
+    assert np.all(marg.nesting_neighbours(grid).sum(axis=1) > 0)
+
+    # Chi squared that drops by a fixed amount per free parameter, so that nested models are never better
+    chi2 = 1000 - free @ np.random.default_rng(7).uniform(0, 20, grid.shape[1])
+    aic = chi2 + nfree
+    fitted = np.zeros(len(grid), dtype=bool)
+    fitted[[49, 44, 48]] = True
+    bounds = marg.aic_lower_bounds(grid, aic, fitted)
+    assert np.all(bounds[fitted] == aic[fitted])
+    assert np.all(bounds <= aic + 1e-9)
+
+    weights = np.exp(-0.5 * (aic - np.min(aic)))
+    assert np.sum(weights[~fitted]) / np.sum(weights) <= marg.unexplored_weight(grid, aic, fitted)
+    assert marg.unexplored_weight(grid, aic, np.ones(len(grid), dtype=bool)) == 0
+
+
+def test_orbit_bins():
+    """ Check that the bins stay within the HST orbits and that the binned errors follow from the weights. """
+
+    bins = marg.orbit_bins(x_data.value, 3)
+    orbits = np.cumsum(np.r_[0, np.diff(x_data.value) > 0.25 * CONFIG_INI.getfloat('constants', 'HST_period')])
+    assert np.all(np.diff(bins) >= 0)
+    for b in np.unique(bins):
+        assert np.unique(orbits[bins == b]).size == 1
+        assert 2 <= np.count_nonzero(bins == b) <= 4
+
+    x, y, error, shifts = marg.bin_light_curve(x_data.value, y_data.value, err.value, sh.value, bins)
+    assert x.size == y.size == error.size == shifts.size == bins.max() + 1
+    weights = 1 / err.value[bins == 0] ** 2
+    assert np.isclose(y[0], np.sum(weights * y_data.value[bins == 0]) / np.sum(weights))
+    assert np.isclose(error[0], 1 / np.sqrt(np.sum(weights)))
+
+
+def test_occultuniform():
+    """ Check the uniform-source occultation in all overlap regimes, for both floats and astropy Quantities. """
+
+    rl = 0.1
+    b0 = np.array([0., 0.5, 0.9, 1.0, 1.1, 1.5])
+    mu = marg.occultuniform(b0, rl)
+
+    assert np.allclose(mu[:3], 1 - rl ** 2)        # planet fully inside the stellar disk
+    assert 1 - rl ** 2 < mu[3] < 1                 # partial overlap
+    assert np.all(mu[4:] == 1.)                    # no overlap
+    assert np.array_equal(mu, marg.occultuniform(b0 * u.dimensionless_unscaled, rl))
+
+    # Occulting body bigger than the star
+    assert np.all(marg.occultuniform(np.array([0., 0.1]), 1.5) == 0.)
+
+
+def test_occultnl_batched():
+    """ Check that the batched occultnl integration agrees with the loop over annuli, also when tiled. """
+
+    b0 = np.linspace(0., 1.3, 200)
+    mulimb0, mulimbf = marg.occultnl(RL, 0.48, 0.11, 0.03, -0.06, b0)
+
+    for budget in [256., 1e-3]:
+        mulimb0_batched, mulimbf_batched = marg.occultnl(RL, 0.48, 0.11, 0.03, -0.06, b0, batched=True,
+                                                         memory_budget=budget)
+        assert np.allclose(mulimb0_batched, mulimb0, rtol=0, atol=1e-13)
+        assert np.allclose(mulimbf_batched, mulimbf, rtol=0, atol=1e-13)
+
+
+def test_occultnl_per_point():
+    """ Check the per-point convergence of occultnl against the global convergence test, and that it is at least as
+    accurate as that one. """
+
+    b0 = np.linspace(0., 1.3, 300)
+    for coefficients in [(0.48, 0.11, 0.03, -0.06), (0.6, -0.3, 0.9, -0.4), (0., 0., 0.4, 0.2)]:
+        mulimb0, _mulimbf, nr = marg.occultnl(RL, *coefficients, b0, return_nr=True)
+        reference, _mulimbf = occultnl_quadrature(RL, *coefficients, b0, rtol=1e-12, atol=1e-14)
+        error = np.max(np.abs(mulimb0 - reference))
+
+        for batched in [False, True]:
+            mulimb0_pp, _mulimbf_pp, nr_pp = marg.occultnl(RL, *coefficients, b0, batched=batched, per_point=True,
+                                                           return_nr=True)
+            assert np.max(np.abs(mulimb0_pp - reference)) <= 1.1 * error
+            assert np.max(np.abs(mulimb0_pp - mulimb0)) <= 2 * error
+            assert np.all(nr_pp[b0 >= 1 + RL] == 0)
+
+
+def test_numba_backend():
+    """ Check that the Numba-compiled kernels agree with the NumPy code. """
+
+    pytest.importorskip('numba')
+
+    b0 = np.linspace(0., 1.3, 200)
+    time_array = np.linspace(57957., 57958., 100) * u.d
+    hst_phase = np.linspace(-0.1, 0.1, 100)
+    shifts = np.linspace(0., 1., 100)
+
+    results = {}
+    for use_numba in [False, True]:
+        phase = marg.phase_calc(time_array, EPOCH, PERIOD, use_numba)
+        results[use_numba] = [marg.occultuniform(b0, RL, use_numba),
+                              marg.occultnl(RL, 0.48, 0.11, 0.03, -0.06, b0, use_numba=use_numba)[0],
+                              phase,
+                              marg.impact_param(PERIOD.to(u.s), MSMPR.to_value(u.kg / u.m ** 3), phase,
+                                                INCLIN.to(u.rad), use_numba),
+                              marg.sys_model(phase, hst_phase, shifts, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9,
+                                             use_numba)]
+
+    for numpy_result, numba_result in zip(results[False], results[True]):
+        assert type(numpy_result) == type(numba_result)
+        assert np.allclose(numba_result, numpy_result, rtol=0, atol=1e-13)
+
+    # The switch belongs to the model, so it can be changed after import
+    models = [marg.Transit(x_data[0].value, MSMPR.to_value(u.kg / u.m ** 3), 0.48, 0.11, 0.03, -0.06, sh=sh.value,
+                           use_numba=use_numba) for use_numba in [False, True]]
+    assert [tmodel.use_numba for tmodel in models] == [False, True]
+    for tmodel in models:
+        tmodel.epoch = EPOCH.value
+        tmodel.inclin = INCLIN.to_value(u.rad)
+        tmodel.period = PERIOD.value
+    assert np.allclose(models[1](x_data.value), models[0](x_data.value), rtol=0, atol=1e-13)
+
+
+def test_limb_darkened_transit_threads():
+    """ Check that the chunked and threaded evaluation of the transit kernels is bitwise identical to the serial one. """
+
+    b0 = np.linspace(0., 1.3, 1000)
+
+    cases = [('occultnl', {'batched': True}), ('occultnl', {'batched': False}), ('analytic', {})]
+    if jit_kernels.NUMBA_AVAILABLE:
+        # The compiled refinement levels run on the threads as well, and agree with the unchunked compiled kernel
+        cases.append(('occultnl', {'use_numba': True}))
+        assert np.array_equal(marg.limb_darkened_transit(RL, 0.48, 0.11, 0.03, -0.06, b0, use_numba=True)[0],
+                              marg.limb_darkened_transit(RL, 0.48, 0.11, 0.03, -0.06, b0, chunk_size=128,
+                                                         use_numba=True)[0])
+
+    for ld_engine, kwargs in cases:
+        serial = marg.limb_darkened_transit(RL, 0.48, 0.11, 0.03, -0.06, b0, ld_engine, chunk_size=128, threads=1,
+                                            **kwargs)
+        threaded = marg.limb_darkened_transit(RL, 0.48, 0.11, 0.03, -0.06, b0, ld_engine, chunk_size=128, threads=3,
+                                              **kwargs)
+        assert np.array_equal(threaded[0], serial[0])
+        assert np.array_equal(threaded[1], serial[1])
+
+
+def test_transit_light_curve_supersampling():
+    """ Check the exposure-time integration of the transit against averaging instantaneous models by hand. """
+
+    phase = np.linspace(-0.05, 0.05, 150)
+    # The analytic engine treats every point independently, unlike the global convergence test of occultnl
+    geometry = (PERIOD, MSMPR.to_value(u.kg / u.m ** 3), INCLIN.to(u.rad), 'analytic')
+    exposure_time = (30 * u.min).to_value(u.d)
+    args = (RL, 0.48, 0.11, 0.03, -0.06)
+
+    instantaneous = marg.transit_light_curve(*args, phase, *geometry)
+    single = marg.transit_light_curve(*args, phase, *geometry, exposure_time=exposure_time, supersample=1)
+    assert np.array_equal(single, instantaneous)
+
+    integrated = marg.transit_light_curve(*args, phase, *geometry, exposure_time=exposure_time, supersample=5)
+    offsets = exposure_time * (np.arange(5) + 0.5) / 5 - exposure_time / 2
+    by_hand = np.mean([marg.transit_light_curve(*args, phase + offset / PERIOD.value, *geometry) for offset in offsets],
+                      axis=0)
+    assert np.allclose(integrated, by_hand, rtol=0, atol=1e-14)
+    assert not np.allclose(integrated, instantaneous, rtol=0, atol=1e-6)
+
+
+def test_transit_window():
+    """ Check that the transit window selects exactly the points whose impact parameter is below 1 + rl. """
+
+    msmpr = MSMPR.to_value(u.kg / u.m ** 3)
+    phase = np.random.default_rng(0).uniform(-0.5, 0.5, 5000)
+    window = marg.TransitWindow()
+
+    for rl, inclin in [(RL, INCLIN), (0.3, 80 * u.deg), (0.1, 60 * u.deg)]:
+        b0 = marg.impact_param(PERIOD.to(u.s), msmpr, phase, inclin.to(u.rad)).value
+        in_transit = window.indices(phase, rl, PERIOD.to_value(u.d), msmpr, inclin.to_value(u.rad))
+        assert np.array_equal(in_transit, np.where(b0 < 1 + rl)[0])
+
+
+def test_transit_model_unit_free():
+    """ Check that the Quantity interface of the transit model agrees with the unit-free Transit.calc and leaves x be. """
+
+    tmodel = marg.Transit(x_data[0].value, MSMPR.to_value(u.kg / u.m ** 3), 0.48, 0.11, 0.03, -0.06,
+                          sh=sh.value, ld_engine='analytic', exposure_time=0, transit_window=False)
+    tmodel.epoch = EPOCH.value
+    tmodel.inclin = INCLIN.to_value(u.rad)
+    tmodel.period = PERIOD.value
+    pars = [par.val for par in tmodel.pars]
+
+    x = x_data.copy()
+    with_units = marg._transit_model(pars, x, sh.value, ld_engine='analytic')
+    assert np.array_equal(x, x_data)
+    assert np.array_equal(with_units, tmodel.calc(pars, x_data.value))
+    assert np.array_equal(marg._transit_model(pars, x_data.value, sh.value, ld_engine='analytic'), with_units)
+
+
+def test_sys_model_basis():
+    """ Check the systematic model on precomputed polynomial bases against sys_model(), and the rebuild on a new sh. """
+
+    rng = np.random.default_rng(1)
+    phase, hst_phase, shifts = rng.uniform(-0.5, 0.5, (3, 500))
+    hstp, xshift = rng.normal(0, 0.1, 4), rng.normal(0, 0.1, 4)
+
+    direct = marg.sys_model(phase, hst_phase, shifts, 0.01, *hstp, *xshift)
+    basis = marg.sys_model_basis(phase, marg.polynomial_basis(hst_phase), marg.polynomial_basis(shifts), 0.01, hstp,
+                                 xshift)
+    assert np.allclose(basis, direct, rtol=1e-14, atol=0)
+
+    tmodel = marg.Transit(x_data[0].value, MSMPR.to_value(u.kg / u.m ** 3), 0.48, 0.11, 0.03, -0.06, sh=sh.value)
+    assert tmodel.shift_basis.flags['C_CONTIGUOUS'] and tmodel.shift_basis.shape == (4, sh.size)
+    tmodel.sh_array = 2 * sh.value
+    assert np.array_equal(tmodel.shift_basis, marg.polynomial_basis(2 * sh.value))
+    assert tmodel.hst_basis(x_data.value) is tmodel.hst_basis(x_data.value)
+
+
+def test_transit_partial_reevaluation(monkeypatch):
+    """ Check that Transit only reruns the limb darkening engine for parameters the transit depends on, with the same
+    result as a full evaluation. """
+
+    tmodel = marg.Transit(x_data[0].value, MSMPR.to_value(u.kg / u.m ** 3), 0.48, 0.11, 0.03, -0.06,
+                          sh=sh.value, ld_engine='analytic')
+    tmodel.epoch = EPOCH.value
+    tmodel.inclin = INCLIN.to_value(u.rad)
+    tmodel.period = PERIOD.value
+    pars = [par.val for par in tmodel.pars]
+    names = [par.name for par in tmodel.pars]
+
+    calls = []
+    engine = marg.limb_darkened_transit
+
+    def counting_engine(*args, **kwargs):
+        calls.append(1)
+        return engine(*args, **kwargs)
+
+    monkeypatch.setattr(marg, 'limb_darkened_transit', counting_engine)
+    for name, step in [(None, 0), ('hstp3', 1e-3), ('xshift2', 1e-2), ('m_fac', 1e-3), ('flux0', 1e-4), ('rl', 1e-4),
+                       ('epoch', 1e-5), ('hstp3', 0)]:
+        if name is not None:
+            pars[names.index(name)] += step
+        ncalls = len(calls)
+        cached = tmodel.calc(pars, x_data.value)
+        assert len(calls) - ncalls == (name in [None, 'rl', 'epoch'])
+        full = marg._transit_model_values(pars, x_data.value, sh.value, tmodel.hst_period, ld_engine='analytic',
+                                          **tmodel.supersample_kwargs)
+        assert np.array_equal(cached, full)
+
+
+def test_transit_threads():
+    """ Check that one Transit evaluated from several threads at once gives the same results as serial evaluations,
+    and does not change its inputs. """
+
+    tmodel = marg.Transit(x_data[0].value, MSMPR.to_value(u.kg / u.m ** 3), 0.48, 0.11, 0.03, -0.06,
+                          sh=sh.value, ld_engine='analytic', transit_window=True)
+    tmodel.epoch = EPOCH.value
+    tmodel.inclin = INCLIN.to_value(u.rad)
+    tmodel.period = PERIOD.value
+    x = x_data.value.copy()
+    base = np.array([par.val for par in tmodel.pars])
+
+    # Every snapshot moves the transit and the systematics, so threads keep replacing each other's cached components
+    rng = np.random.default_rng(3)
+    snapshots = []
+    for _ in range(40):
+        pars = base.copy()
+        pars[[0, 2, 13, 14, 18]] += rng.normal(0, [1e-3, 1e-4, 1e-3, 1e-3, 1e-3])
+        snapshots.append(list(pars))
+    serial = [marg._transit_model_values(pars, x, sh.value, tmodel.hst_period, ld_engine='analytic',
+                                         **tmodel.supersample_kwargs) for pars in snapshots]
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        threaded = list(pool.map(lambda pars: tmodel.calc(pars, x), snapshots * 3))
+
+    for model, expected in zip(threaded, serial * 3):
+        assert np.array_equal(model, expected)
+    assert np.array_equal(x, x_data.value)
+
+
+def test_transit_jacobian():
+    """ Check the analytic Jacobian of the Transit model against central differences. """
+
+    tmodel = marg.Transit(x_data[0].value, MSMPR.to_value(u.kg / u.m ** 3), 0.48, 0.11, 0.03, -0.06,
+                          sh=sh.value, ld_engine='analytic', exposure_time=100, supersample=3)
+    tmodel.epoch = EPOCH.value
+    tmodel.inclin = INCLIN.to_value(u.rad)
+    tmodel.period = PERIOD.value
+    for name in ['epoch', 'inclin', 'msmpr', 'm_fac', 'hstp1', 'hstp2', 'hstp3', 'hstp4', 'xshift1', 'xshift2']:
+        getattr(tmodel, name).thaw()
+    tmodel.m_fac = 0.01
+    tmodel.hstp1 = 0.01
+    tmodel.xshift1 = 0.01
+    pars = np.array([par.val for par in tmodel.pars])
+
+    jac = tmodel.jacobian(list(pars), x_data.value)
+    thawed = [k for k, par in enumerate(tmodel.pars) if not par.frozen]
+    assert jac.shape == (len(thawed), x_data.size)
+    for row, k in zip(jac, thawed):
+        step = 1e-6 * max(abs(pars[k]), 1) if tmodel.pars[k].name != 'epoch' else 1e-6
+        upper, lower = pars.copy(), pars.copy()
+        upper[k] += step
+        lower[k] -= step
+        central = (tmodel.calc(list(upper), x_data.value) - tmodel.calc(list(lower), x_data.value)) / (2 * step)
+        assert np.allclose(row, central, rtol=0, atol=1e-5 * max(np.max(np.abs(central)), 1e-2))
+
+
+def test_transit_partials_engine_mismatch():
+    """ Bound the difference between the analytic transit derivatives that the Jacobian uses and the derivatives of
+    occultnl at its final number of annuli, and its effect on the parameter errors of a fit with occultnl. """
+
+    coefficients = (0.48, 0.11, 0.03, -0.06)
+    c1, c2, c3, c4 = coefficients
+    omega = 4 * ((1 - c1 - c2 - c3 - c4) / 4 + c1 / 5 + c2 / 6 + c3 / 7 + c4 / 8)
+    step = 1e-6
+
+    def occultnl_partials(rl, b0):
+        # Central differences of occultnl with its number of annuli held fixed, which are smooth in rl and b0
+        nr = np.max(marg.occultnl(rl, *coefficients, b0, return_nr=True)[2])
+        rls = np.concatenate([np.full(b0.size, rl + step), np.full(b0.size, rl - step), np.full(2 * b0.size, rl)])
+        zs = np.concatenate([b0, b0, b0 + step, np.abs(b0 - step)])
+        dt = 0.5 * np.pi / nr
+        t = dt * np.arange(nr + 1)
+        mu0 = marg.occultuniform(zs, rls)
+        sums = marg._occultnl_level(rls, zs, mu0, np.sin(t), t + 0.5 * dt, nr)
+        mu = ((1 - c1 - c2 - c3 - c4) * mu0 + (c1 * sums[0] + c2 * sums[1] + c3 * sums[2] + c4 * sums[3]) * dt) / omega
+        mu = mu.reshape(4, b0.size)
+        return (mu[0] - mu[1]) / (2 * step), (mu[2] - mu[3]) / (2 * step)
+
+    tmodel = marg.Transit(x_data[0].value, MSMPR.to_value(u.kg / u.m ** 3), *coefficients, sh=sh.value,
+                          ld_engine='occultnl')
+    tmodel.epoch = EPOCH.value
+    tmodel.inclin = INCLIN.to_value(u.rad)
+    tmodel.period = PERIOD.value
+    for name in ['inclin', 'msmpr', 'ecc']:
+        getattr(tmodel, name).freeze()
+    pars = [par.val for par in tmodel.pars]
+
+    b0 = tmodel._components(pars, x_data.value)['b0']
+    near = b0 < 1 + RL
+    analytic = marg.transit_partials(RL, *coefficients, b0[near])
+    for derivative, reference in zip(analytic, occultnl_partials(RL, b0[near])):
+        assert np.max(np.abs(derivative - reference)) <= 2e-3 * np.max(np.abs(reference))
+
+    def errors(jac):
+        weighted = jac / err.value
+        return np.sqrt(np.diag(np.linalg.inv(weighted @ weighted.T)))
+
+    def partials(rl, c1, c2, c3, c4, b0, order=12):
+        dmu_drl, dmu_db0 = np.zeros(b0.shape), np.zeros(b0.shape)
+        inside = b0 < 1 + rl
+        dmu_drl[inside], dmu_db0[inside] = occultnl_partials(rl, b0[inside])
+        return dmu_drl, dmu_db0
+
+    expected = errors(tmodel.jacobian(pars, x_data.value))
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(marg, 'transit_partials', partials)
+        assert np.allclose(errors(tmodel.jacobian(pars, x_data.value)), expected, rtol=5e-4, atol=0)
+
+
+def test_transit_profile_flux0():
+    """ Check that a profiled flux0 minimises chi squared and that the Jacobian includes its dependence on the other
+    parameters. """
+
+    tmodel = marg.Transit(x_data[0].value, MSMPR.to_value(u.kg / u.m ** 3), 0.48, 0.11, 0.03, -0.06,
+                          sh=sh.value, ld_engine='analytic')
+    tmodel.epoch = EPOCH.value
+    tmodel.inclin = INCLIN.to_value(u.rad)
+    tmodel.period = PERIOD.value
+    for par in tmodel.pars:
+        if par.name not in ['rl', 'epoch', 'hstp1']:
+            par.freeze()
+    data = Data1D('W17', x_data.value, y_data.value, staterror=err.value)
+    tmodel.profile_flux0(data)
+
+    pars = np.array([par.val for par in tmodel.pars])
+    profiled = tmodel.calc(list(pars), x_data.value)
+    assert tmodel.flux0.val == pars[1]   # the evaluation leaves the parameter alone
+    tmodel.set_profiled_flux0()
+    flux0 = tmodel.flux0.val
+    assert flux0 != pars[1] and tmodel.flux0.default_val == pars[1]
+    chi2 = np.sum(((data.y - profiled) / data.staterror) ** 2)
+    for scale in [1 - 1e-6, 1 + 1e-6]:
+        assert chi2 < np.sum(((data.y - scale * profiled) / data.staterror) ** 2)
+
+    jac = tmodel.jacobian(list(pars), x_data.value)
+    for row, k in zip(jac, [0, 2, 14]):
+        step = 1e-6
+        upper, lower = pars.copy(), pars.copy()
+        upper[k] += step
+        lower[k] -= step
+        central = (tmodel.calc(list(upper), x_data.value) - tmodel.calc(list(lower), x_data.value)) / (2 * step)
+        assert np.allclose(row, central, rtol=0, atol=1e-5 * np.max(np.abs(central)))
+
+    # Thawing flux0 goes back to the normal model
+    tmodel.flux0.thaw()
+    pars[1] = 1.
+    assert np.allclose(tmodel.calc(list(pars), x_data.value), profiled / flux0, rtol=1e-14, atol=0)
+
+
+def test_transit_batch():
+    """ Check the batch evaluation of the Transit model and its Jacobian against evaluating every row on its own. """
+
+    grid = marg.wfc3_systematic_model_grid_selection('fit_time')[[0, 7, 30, 49]]
+    data = Data1D('W17', x_data.value, y_data.value, staterror=err.value)
+    for ld_engine in ['analytic', 'occultnl']:
+        tmodel = marg.Transit(x_data[0].value, MSMPR.to_value(u.kg / u.m ** 3), 0.48, 0.11, 0.03, -0.06,
+                              sh=sh.value, ld_engine=ld_engine, exposure_time=100, supersample=3)
+        tmodel.epoch = EPOCH.value
+        tmodel.inclin = INCLIN.to_value(u.rad)
+        tmodel.period = PERIOD.value
+        tmodel.profile_flux0(data)
+        pars = np.tile([par.val for par in tmodel.pars], (len(grid), 1))
+        pars[:, [0, 2, 13, 14]] += np.random.default_rng(6).normal(0, 1e-3, (len(grid), 4))
+        free = (grid == 0) & ~np.array([par.alwaysfrozen for par in tmodel.pars])
+        free[:, 1] = False
+
+        models = tmodel.calc_batch(pars, x_data.value, free)
+        jac = tmodel.jacobian_batch(pars, x_data.value, free)
+        for row, row_free, model, row_jac in zip(pars, free, models, jac):
+            for par, thawed in zip(tmodel.pars, row_free):
+                if not par.alwaysfrozen:
+                    par.frozen = not thawed
+            assert np.allclose(model, tmodel.calc(list(row), x_data.value), rtol=1e-14, atol=0)
+            assert np.allclose(row_jac[row_free], tmodel.jacobian(list(row), x_data.value), rtol=1e-12, atol=1e-12)
+            assert np.all(row_jac[~row_free] == 0)
@@ -0,0 +1,37 @@
+import numpy as np
+
+from exoticism.marginalisation import GridFitter, first_fit
+from exoticism.margmodule import wfc3_systematic_model_grid_selection
+from exoticism.reparameterisation import Cot, Linear, Log
+from exoticism.tests.test_marginalisation import w17_fitter_args
+
+
+def test_transforms():
+    """ Check that the transforms go back and forth and that their derivatives match finite differences. """
+
+    for transform, values in [(Linear(57957.97, 3.7354), np.array([57957.9, 57957.97, 57958.1])),
+                              (Log(), np.array([900., 1800., 3600.])),
+                              (Cot(), np.radians([80., 88., 90., 92.]))]:
+        internal = transform.internal(values)
+        assert np.allclose(transform.physical(internal), values, rtol=1e-14, atol=1e-14)
+
+        step = 1e-6 * np.maximum(np.abs(internal), 1.)
+        numeric = (transform.physical(internal + step) - transform.physical(internal - step)) / (2 * step)
+        assert np.allclose(transform.derivative(internal), numeric, rtol=1e-6)
+
+
+def test_reparameterised_fit():
+    """ Check that LevMar in internal coordinates finds the minima of the analytic least-squares fit, and that the
+    parameters and errors come back in physical units. """
+
+    grid = wfc3_systematic_model_grid_selection('fit_time')[[0, 6, 24, 49]]
+
+    reference = GridFitter(*w17_fitter_args(optimizer='least_squares', profile_flux0=False))
+    reparameterised = GridFitter(*w17_fitter_args(optimizer='levmar', profile_flux0=False, reparameterise=True))
+    for system in grid:
+        one = first_fit(reference, system)
+        two = first_fit(reparameterised, system)
+        assert two['succeeded']
+        assert np.isclose(one['AIC'], two['AIC'], rtol=0, atol=1e-2)
+        assert np.isclose(one['params'][0], two['params'][0], rtol=1e-4)
+        assert np.isclose(one['rl_err'], two['rl_err'], rtol=1e-2)
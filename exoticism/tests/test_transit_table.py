@@ -0,0 +1,25 @@
+import numpy as np
+
+from exoticism.mandel_agol import occultnl_analytic
+from exoticism.transit_table import TransitTable, get_transit_table
+
+
+def test_transit_table():
+    """ Check that the transit table stays within its interpolation error bound, also away from its nodes. """
+
+    coeffs = (0.48, 0.11, 0.03, -0.06)
+    table = TransitTable(*coeffs, rl_min=0.05, rl_max=0.2, tolerance=1e-6)
+    assert table.max_error <= 1e-6
+
+    rng = np.random.default_rng(42)
+    b0 = np.sort(rng.uniform(0., 1.3, 500))
+    for rl in rng.uniform(0.05, 0.2, 10):
+        reference, _ = occultnl_analytic(rl, *coeffs, b0, order=40)
+        assert np.allclose(table(rl, b0), reference, rtol=0, atol=1e-6)
+
+    # Radius ratios outside of the table are computed directly
+    reference, _ = occultnl_analytic(0.3, *coeffs, b0)
+    assert np.array_equal(table(0.3, b0), reference)
+
+    # Tables are built once per set of limb darkening coefficients
+    assert get_transit_table(*coeffs) is get_transit_table(*coeffs)
@@ -0,0 +1,148 @@
+"""
+Precomputed lookup table of the limb-darkened transit for a frozen set of limb darkening coefficients.
+
+During a marginalisation run c1 ... c4 never change (they are always frozen in margmodule.Transit), so the transit
+model only depends on the radius ratio rl and the impact parameter z. The table tabulates it once on a (rl, z) grid
+and the fit evaluates a bicubic spline instead of integrating the transit for every model evaluation.
+
+The (rl, z) plane is split into two regions whose borders are the contact points, so that the kinks of the light curve
+at the second and first contact are grid lines of the table instead of diagonals through its cells:
+- planet fully inside the stellar disk, 0 <= z <= 1 - rl, tabulated over x = z / (1 - rl)
+- planet crossing the stellar limb, 1 - rl <= z <= 1 + rl, tabulated over x = (z - 1 + rl) / (2 * rl)
+Out of transit (z >= 1 + rl) the model is 1. The x nodes are clustered towards the contact points, where the
+light curve changes the fastest.
+
+The table is built from the analytic engine (mandel_agol.py) and checked against it halfway between all nodes, where
+the interpolation error of the spline is largest; the grid is doubled until the maximum error found there is below the
+requested tolerance.
+"""
+
+import functools
+import numpy as np
+import astropy.units as u
+from scipy.interpolate import RectBivariateSpline
+
+from exoticism.mandel_agol import occultnl_analytic
+
+
+class TransitTable(object):
+    """Lookup table of the limb-darkened transit mulimb0(rl, z) for fixed limb darkening coefficients.
+
+    --------
+    Params:
+    c1, c2, c3, c4: float, nonlinear limb darkening coefficients
+    rl_min, rl_max: float, range of radius ratios covered by the table; other radius ratios are computed directly
+    tolerance: float, maximum interpolation error of mulimb0 the table is built for
+    max_nodes: int, maximum number of nodes per axis before the refinement is given up"""
+
+    def __init__(self, c1, c2, c3, c4, rl_min=0.01, rl_max=0.3, tolerance=1e-6, max_nodes=2048):
+
+        if not 0 < rl_min < rl_max < 1:
+            raise ValueError('The radius ratio range of the transit table has to be within (0, 1).')
+
+        self.coeffs = (c1, c2, c3, c4)
+        self.rl_min = rl_min
+        self.rl_max = rl_max
+        self.tolerance = tolerance
+
+        self.splines = []
+        self.max_error = 0.
+        for to_z in (_inside_z, _limb_z):
+            spline, error = self._build_region(to_z, max_nodes)
+            self.splines.append(spline)
+            self.max_error = max(self.max_error, error)
+
+        if self.max_error > tolerance:
+            raise ValueError('Transit table did not reach the tolerance of {} with {} nodes per axis, maximum '
+                             'interpolation error is {}.'.format(tolerance, max_nodes, self.max_error))
+
+    def __call__(self, rl, b0):
+        """
+        Evaluate the tabulated transit model.
+        :param rl: float, radius ratio (Rp/R*)
+        :param b0: impact parameter in stellar radii
+        :return: mulimb0: limb-darkened transit model
+        """
+        if isinstance(b0, u.Quantity):
+            b0 = b0.value
+        if isinstance(rl, u.Quantity):
+            rl = rl.value
+        z = np.atleast_1d(np.asarray(b0, dtype=float))
+
+        if not self.rl_min <= rl <= self.rl_max:
+            return occultnl_analytic(rl, *self.coeffs, z)[0]
+
+        mulimb0 = np.ones(z.shape)
+        inside = z <= 1 - rl
+        limb = ~inside & (z < 1 + rl)
+        mulimb0[inside] = self.splines[0].ev(np.full(np.count_nonzero(inside), rl), z[inside] / (1 - rl))
+        mulimb0[limb] = self.splines[1].ev(np.full(np.count_nonzero(limb), rl), (z[limb] - 1 + rl) / (2 * rl))
+
+        return mulimb0
+
+    def _build_region(self, to_z, max_nodes):
+        """
+        Tabulate one region of the (rl, z) plane, doubling the grid along every axis on which the interpolation error
+        halfway between the nodes is above the tolerance.
+        :param to_z: function, maps (rl, x) of the region to the impact parameter z
+        :param max_nodes: int, maximum number of nodes per axis
+        :return: spline: RectBivariateSpline over (rl, x), error: maximum interpolation error found
+        """
+        n_rl, n_x = 16, 32
+        while True:
+            rl = np.linspace(self.rl_min, self.rl_max, n_rl + 1)
+            x = 0.5 * (1 - np.cos(np.pi * np.arange(n_x + 1) / n_x))
+            spline = RectBivariateSpline(rl, x, self._reference(rl, x, to_z), kx=3, ky=3, s=0)
+
+            rl_mid = 0.5 * (rl[1:] + rl[:-1])
+            x_mid = 0.5 * (x[1:] + x[:-1])
+            error_rl = np.max(np.abs(spline(rl_mid, x) - self._reference(rl_mid, x, to_z)))
+            error_x = np.max(np.abs(spline(rl, x_mid) - self._reference(rl, x_mid, to_z)))
+            error_both = np.max(np.abs(spline(rl_mid, x_mid) - self._reference(rl_mid, x_mid, to_z)))
+            error = max(error_rl, error_x, error_both)
+
+            if error <= self.tolerance or max(n_rl, n_x) >= max_nodes:
+                return spline, error
+            if error_rl > self.tolerance or error_both > self.tolerance:
+                n_rl = min(2 * n_rl, max_nodes)
+            if error_x > self.tolerance or error_both > self.tolerance:
+                n_x = min(2 * n_x, max_nodes)
+
+    def _reference(self, rl, x, to_z):
+        """
+        Compute the transit model on the (rl, x) grid of one region with the analytic engine.
+        :param rl: array, radius ratios
+        :param x: array, region coordinates
+        :param to_z: function, maps (rl, x) of the region to the impact parameter z
+        :return: array of shape (len(rl), len(x))
+        """
+        rl_grid, x_grid = np.meshgrid(rl, x, indexing='ij')
+        mulimb0, _ = occultnl_analytic(rl_grid.ravel(), *self.coeffs, to_z(rl_grid, x_grid).ravel(), order=24)
+        return mulimb0.reshape(rl_grid.shape)
+
+
+def _inside_z(rl, x):
+    return x * (1 - rl)
+
+
+def _limb_z(rl, x):
+    return 1 - rl + 2 * rl * x
+
+
+@functools.lru_cache(maxsize=8)
+def get_transit_table(c1, c2, c3, c4, rl_min=0.01, rl_max=0.3, tolerance=1e-6):
+    """
+    Return the transit table of a set of limb darkening coefficients, building it on first use.
+
+    Tables are cached per set of limb darkening coefficients (and table settings), so a table is built once per run
+    and shared by all models of the grid.
+    :param c1: float, limb darkening parameter 1
+    :param c2: float, limb darkening parameter 2
+    :param c3: float, limb darkening parameter 3
+    :param c4: float, limb darkening parameter 4
+    :param rl_min: float, smallest radius ratio of the table
+    :param rl_max: float, largest radius ratio of the table
+    :param tolerance: float, maximum interpolation error of the table
+    :return: TransitTable
+    """
+    return TransitTable(c1, c2, c3, c4, rl_min=rl_min, rl_max=rl_max, tolerance=tolerance)